@@ -0,0 +1,234 @@
+from typing import Any
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import threading
+from colors import *
+
+
+def status_color(return_code: int) -> str:
+    if 100 <= return_code <= 199:
+        return FC.WHITE
+    if 200 <= return_code <= 299:
+        return FC.LIGHT_RED
+    if 300 <= return_code <= 399:
+        return FC.LIGHT_MAGENTA
+    if 400 <= return_code <= 499:
+        return FC.DARK_RED
+    if 500 <= return_code <= 599:
+        return FC.DARK_CYAN
+    return OPS.RESET
+
+
+class ConsoleSink:
+    """Coloured lines on stdout, the format used by general.log_request"""
+    def __init__(self, stream=None, colors: bool = True):
+        self.stream = stream
+        self.colors = colors
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        lines = []
+        for record in records:
+            if 'dropped' in record:
+                lines.append(f'{FC.LIGHT_RED}WARNING!{OPS.RESET} access log queue full, '
+                             f'{record["dropped"]} records dropped\n')
+                continue
+            status = record.get('status')
+            ext_return_code = f' - {status}' if status is not None else ''
+            line = f' {record["method"]: <7} - {record["path"]}{ext_return_code} '
+            if self.colors:
+                color = record.get('color') or status_color(status or 0)
+                line = f'{color}{line}{OPS.RESET}'
+            lines.append(line + '\n')
+        stream = self.stream or sys.__stdout__
+        stream.write(''.join(lines))
+        stream.flush()
+
+    def close(self) -> None:
+        pass
+
+
+class JSONLSink:
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        """
+        One JSON object per line, rotated by size like logging.handlers.RotatingFileHandler.
+        The file is opened by the first write, in the process that writes it
+        :param path: File to write to, rotated files get a .1, .2, ... suffix
+        :param max_bytes: Size after which the file is rotated, 0 disables the rotation
+        :param backup_count: Number of rotated files kept
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__base_path = path
+        self.__file = None
+
+    def for_worker(self, worker_id: int) -> None:
+        """
+        Called in a forked worker, each worker writes (and rotates) its own file: access.worker0.jsonl, ...
+        the workers would otherwise rotate the files the others are still appending to
+        """
+        if self.__file is not None:
+            # inherited, the master keeps it
+            self.__file.close()
+            self.__file = None
+        root, extension = os.path.splitext(self.__base_path)
+        self.path = f'{root}.worker{worker_id}{extension}'
+
+    def write(self, records: list[dict[str, Any]]) -> None:
+        data = ''.join(json.dumps({k: v for k, v in record.items() if k != 'color'},
+                                  separators=(',', ':')) + '\n' for record in records)
+        if self.__file is None:
+            self.__file = open(self.path, 'a', encoding='utf-8')
+        if self.max_bytes and self.__file.tell() + len(data) > self.max_bytes and self.__file.tell() > 0:
+            self.__rotate()
+        self.__file.write(data)
+        self.__file.flush()
+
+    def __rotate(self) -> None:
+        self.__file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self.__file = open(self.path, 'w', encoding='utf-8')
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class AccessLog:
+    def __init__(self,
+                 sinks: list = None,
+                 queue_size: int = 10000,
+                 batch_size: int = 512,
+                 sample_rate: float = 1.0):
+        """
+        Access log written by a background thread, so a slow stdout or disk never blocks a request
+        :param sinks: Objects with a write(records) and close() method
+        :param queue_size: Records waiting to be written, newer records are dropped (and counted) past this
+        :param batch_size: Maximum records handed to the sinks at once
+        :param sample_rate: Fraction of the records that are kept
+        """
+        self.sinks = sinks if sinks is not None else [ConsoleSink()]
+        self.batch_size = batch_size
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self.written = 0
+
+        self.__queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.__reported_drops = 0
+        self.__thread: threading.Thread = None
+        self.__lock = threading.Lock()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'queued': self.__queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def log(self, record: dict[str, Any]) -> None:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if self.__thread is None:
+            self.start()
+        try:
+            self.__queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self) -> None:
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.__writer, name='access-log', daemon=True)
+            self.__thread.start()
+            atexit.register(self.close)
+
+    def reset_after_fork(self) -> None:
+        """The writer thread doesn't survive a fork, the child starts its own"""
+        self.__queue = queue.Queue(maxsize=self.__queue.maxsize)
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def for_worker(self, worker_id: int) -> None:
+        """Called in a forked worker, before its first record"""
+        for sink in self.sinks:
+            if hasattr(sink, 'for_worker'):
+                sink.for_worker(worker_id)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Writes what's left in the queue and closes the sinks"""
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join(timeout)
+            self.__thread = None
+        for sink in self.sinks:
+            sink.close()
+
+    def __writer(self) -> None:
+        while True:
+            record = self.__queue.get()
+            stop = record is None
+            batch = [] if stop else [record]
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    record = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+
+            if self.dropped != self.__reported_drops:
+                batch.append({'time': time.time(), 'dropped': self.dropped - self.__reported_drops})
+                self.__reported_drops = self.dropped
+            if batch:
+                for sink in self.sinks:
+                    try:
+                        sink.write(batch)
+                    except (OSError, ValueError) as e:
+                        sys.__stderr__.write(f'access log sink {type(sink).__name__} failed: {e!r}\n')
+                self.written += len(batch)
+            if stop:
+                return
+
+
+current: AccessLog = AccessLog()
+
+
+def log(record: dict[str, Any]) -> None:
+    current.log(record)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: current.reset_after_fork())
+
+
+def setup(console: bool = True,
+          console_colors: bool = True,
+          file: str = None,
+          max_bytes: int = 10 * 1024 * 1024,
+          backup_count: int = 5,
+          queue_size: int = 10000,
+          sample_rate: float = 1.0) -> AccessLog:
+    """Replaces the current access log, the one used by general.log_request"""
+    global current
+    sinks = []
+    if console:
+        sinks.append(ConsoleSink(colors=console_colors))
+    if file is not None:
+        sinks.append(JSONLSink(file, max_bytes=max_bytes, backup_count=backup_count))
+    current.close()
+    current = AccessLog(sinks=sinks, queue_size=queue_size, sample_rate=sample_rate)
+    return current
@@ -0,0 +1,60 @@
+"""
+Per-request cost of Loader.call_id('server.request') as the number of plugins grows.
+
+Compares the compiled event table with the previous loop over every plugin,
+run it from the repository root:
+    python benchmarks/plugin_dispatch.py
+"""
+import os
+import sys
+import timeit
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import general  # noqa: F401, imported before the loader like main.py does
+from plugin_loader.v1 import Loader, LoaderState, Plugin, PluginConfiguration, PrefixedStringIO
+from plugin_manager import Manager, ManagerError
+
+PLUGIN_COUNTS = (1, 10, 50, 200)
+CALLS = 20000
+
+
+def legacy_call_id(loader: Loader, id_, *args, **kwargs):
+    for plugin in loader.plugins:
+        try:
+            with contextlib.redirect_stdout(plugin.stdout_buffer):
+                retrn = plugin.manager.call_id(id_, *args, **kwargs)
+                if retrn is not None:
+                    return retrn
+        except ManagerError:
+            continue
+
+
+def make_loader(plugin_count: int, listeners: int) -> Loader:
+    loader = Loader(plugin_directory=os.devnull)
+    for i in range(plugin_count):
+        configuration = PluginConfiguration(name=f'bench-{i}', version=1.0, main_file='main.py',
+                                            id_=f'bench.{i}', loader_required=1.0, loader_preferred=1.0)
+        plugin = Plugin(configuration=configuration, stdout_buffer=PrefixedStringIO(f'bench.{i} '))
+        plugin.manager = Manager()
+        if i < listeners:
+            plugin.manager.on('server.request')(lambda request: None)
+        loader.plugins.append(plugin)
+    loader.plugin_loaded = LoaderState.loaded_managers
+    loader.compile_events()
+    return loader
+
+
+def main() -> None:
+    print(f'{"plugins":>8} {"listeners":>10} {"legacy us/call":>15} {"compiled us/call":>17}')
+    for plugin_count in PLUGIN_COUNTS:
+        for listeners in (0, 1):
+            loader = make_loader(plugin_count, listeners)
+            legacy = timeit.timeit(lambda: legacy_call_id(loader, 'server.request', None), number=CALLS)
+            compiled = timeit.timeit(lambda: loader.call_id('server.request', None), number=CALLS)
+            print(f'{plugin_count:>8} {listeners:>10} {legacy / CALLS * 1e6:>15.2f} {compiled / CALLS * 1e6:>17.2f}')
+
+
+if __name__ == '__main__':
+    main()
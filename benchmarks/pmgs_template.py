@@ -0,0 +1,107 @@
+"""
+Render throughput of a .pmgs template against the same page served as a static file.
+
+Both are served by a Quart app through its test client, the engine alone is measured too,
+run it from the repository root:
+    python benchmarks/pmgs_template.py
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'plugins', 'server-functions'))
+
+from quart import Quart, Response, request
+from pmgs_template import TemplateCache, compile_template
+
+REQUESTS = 5000
+RENDERS = 50000
+ROWS = 20
+
+TEMPLATE = '''<!doctype html>
+<html><head><title>Index</title></head><body>
+<h1>Files</h1>
+<python>
+rows = [(f'file-{i}.txt', i * 1024) for i in range(''' + str(ROWS) + ''')]
+</python>
+<table>
+<python>
+for name, size in rows:
+    print(f'<tr><td>{escape(name)}</td><td>{size}</td></tr>')
+</python>
+</table>
+<p>Requested <python>print(escape(request.path), end='')</python></p>
+</body></html>
+'''
+
+
+def static_page() -> bytes:
+    rows = ''.join(f'<tr><td>file-{i}.txt</td><td>{i * 1024}</td></tr>\n' for i in range(ROWS))
+    return (f'<!doctype html>\n<html><head><title>Index</title></head><body>\n<h1>Files</h1>\n\n'
+            f'<table>\n{rows}\n</table>\n<p>Requested /index.pmgs</p>\n</body></html>\n').encode()
+
+
+def bench_engine(path: str) -> None:
+    cache = TemplateCache()
+
+    class Request:
+        path = '/index.pmgs'
+
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        b''.join(cache.get(path).render({'request': Request}))
+    cached = RENDERS / (time.perf_counter() - start)
+
+    with open(path, 'r') as file:
+        source = file.read()
+    start = time.perf_counter()
+    for _ in range(RENDERS // 10):
+        b''.join(compile_template(source, path).render({'request': Request}))
+    uncached = RENDERS // 10 / (time.perf_counter() - start)
+    print(f'engine:   {cached: >10,.0f} renders/s (compiled once), {uncached: >10,.0f} renders/s (compiled every time)')
+
+
+async def bench_app(path: str) -> None:
+    app = Quart('bench')
+    cache = TemplateCache()
+    page = static_page()
+
+    @app.route('/index.html')
+    async def static_index():
+        return Response(page, 200, mimetype='text/html')
+
+    @app.route('/index.pmgs')
+    async def template_index():
+        parts = cache.get(path).render({'request': request._get_current_object()})
+
+        async def stream():
+            for part in parts:
+                yield part
+
+        return Response(stream(), 200, mimetype='text/html')
+
+    client = app.test_client()
+    results = {}
+    for url in ('/index.html', '/index.pmgs'):
+        # warm up
+        await (await client.get(url)).get_data()
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            await (await client.get(url)).get_data()
+        results[url] = REQUESTS / (time.perf_counter() - start)
+    static_rate, template_rate = results['/index.html'], results['/index.pmgs']
+    print(f'static:   {static_rate: >10,.0f} req/s')
+    print(f'template: {template_rate: >10,.0f} req/s ({template_rate / static_rate * 100:.0f}% of static)')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        template_path = os.path.join(directory, 'index.pmgs')
+        with open(template_path, 'w') as template_file:
+            template_file.write(TEMPLATE)
+        print(f'{ROWS} rows, {len(static_page())} bytes')
+        bench_engine(template_path)
+        asyncio.run(bench_app(template_path))
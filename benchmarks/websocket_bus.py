@@ -0,0 +1,100 @@
+"""
+Throughput and delivery latency of the worker bus as the number of workers grows.
+
+Worker 0 publishes MESSAGES messages through the broker, every other worker receives them,
+run it from the repository root (needs os.fork):
+    python benchmarks/websocket_bus.py
+"""
+import os
+import sys
+import time
+import asyncio
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker_bus
+
+WORKER_COUNTS = (2, 4, 8, 16)
+MESSAGES = 20000
+PAYLOAD = 'x' * 64
+
+
+def receiver(broker: worker_bus.Broker, worker_id: int, ready, results) -> None:
+    async def main():
+        latencies = []
+        done = asyncio.Event()
+
+        def on_frame(kind, name, data):
+            # the send time is the prefix of the payload
+            latencies.append(time.perf_counter() - float(data.split('|', 1)[0]))
+            if len(latencies) == MESSAGES:
+                done.set()
+
+        bus = worker_bus.Bus(broker.worker_socket(worker_id))
+        await bus.start(on_frame)
+        ready.put(worker_id)
+        await done.wait()
+        await bus.stop()
+        results.put((time.perf_counter(), latencies))
+
+    asyncio.run(main())
+
+
+def publisher(broker: worker_bus.Broker, results) -> None:
+    async def main():
+        bus = worker_bus.Bus(broker.worker_socket(0), max_buffer=1 << 30)
+        await bus.start(lambda *args: None)
+        start = time.perf_counter()
+        for i in range(MESSAGES):
+            bus.publish('bench', f'{time.perf_counter()}|{PAYLOAD}')
+            if i % 256 == 0:
+                # lets the transport flush, like a server handling requests would
+                await asyncio.sleep(0)
+        results.put(start)
+        await asyncio.sleep(1)
+        await bus.stop()
+
+    asyncio.run(main())
+
+
+def run(workers: int) -> None:
+    context = multiprocessing.get_context('fork')
+    broker = worker_bus.Broker(workers, max_buffer=1 << 30)
+    ready, results, started = context.Queue(), context.Queue(), context.Queue()
+
+    processes = [context.Process(target=receiver, args=(broker, i, ready, results)) for i in range(1, workers)]
+    for process in processes:
+        process.start()
+    broker.start()
+    for _ in processes:
+        ready.get()
+
+    publishing = context.Process(target=publisher, args=(broker, started))
+    publishing.start()
+    start = started.get()
+
+    end = 0.0
+    latencies = []
+    for _ in processes:
+        finished, worker_latencies = results.get()
+        end = max(end, finished)
+        latencies.extend(worker_latencies)
+    for process in processes + [publishing]:
+        process.join()
+    broker.stop()
+
+    latencies.sort()
+    deliveries = len(latencies)
+    elapsed = end - start
+    print(f'{workers: >3} workers: {MESSAGES / elapsed: >10,.0f} msg/s published, '
+          f'{deliveries / elapsed: >10,.0f} deliveries/s, '
+          f'latency p50 {statistics.median(latencies) * 1e3: >7.3f}ms '
+          f'p99 {latencies[int(deliveries * 0.99)] * 1e3: >7.3f}ms')
+
+
+if __name__ == '__main__':
+    print(f'{MESSAGES} messages of {len(PAYLOAD)} bytes')
+    for count in WORKER_COUNTS:
+        run(count)
@@ -0,0 +1,211 @@
+from typing import Any, AsyncIterator
+import json
+import time
+import asyncio
+from collections import deque
+import shared_store
+
+
+class Event:
+    __slots__ = ('data', 'event', 'id_', 'retry')
+
+    def __init__(self, data: Any, event: str = None, id_: str | int = None, retry: int = None):
+        """
+        A server-sent event, handlers can also yield the data alone
+        :param data: str, bytes or anything JSON serializable
+        :param event: Event type, 'message' on the client if not given
+        :param id_: Sent back by the client as Last-Event-ID when it reconnects
+        :param retry: Reconnection delay for the client in milliseconds
+        """
+        self.data = data
+        self.event = event
+        self.id_ = id_
+        self.retry = retry
+
+
+def format_event(data: Any, event: str = None, id_: str | int = None, retry: int = None) -> bytes:
+    """Formats an event in the text/event-stream format"""
+    if isinstance(data, bytes):
+        data = data.decode()
+    elif not isinstance(data, str):
+        data = json.dumps(data, separators=(',', ':'))
+    lines = []
+    if event is not None:
+        lines.append(f'event: {event}\n')
+    if id_ is not None:
+        lines.append(f'id: {id_}\n')
+    if retry is not None:
+        lines.append(f'retry: {retry}\n')
+    for line in data.splitlines() or ('',):
+        lines.append(f'data: {line}\n')
+    lines.append('\n')
+    return ''.join(lines).encode()
+
+
+def format_item(item: Any) -> bytes:
+    if isinstance(item, Event):
+        return format_event(item.data, item.event, item.id_, item.retry)
+    return format_event(item)
+
+
+KEEP_ALIVE = b': keep-alive\n\n'
+
+
+class Subscriber:
+    def __init__(self, channel: str, queue_size: int = 256):
+        """A client of an event stream, the formatted events are queued until the response sends them"""
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.last_write = time.monotonic()
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, data: bytes) -> bool:
+        try:
+            self.queue.put_nowait(data)
+            self.last_write = time.monotonic()
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def put(self, data: bytes) -> None:
+        """Queues an event of the handler, waiting while the queue is full"""
+        await self.queue.put(data)
+        self.last_write = time.monotonic()
+
+
+class Channel:
+    def __init__(self, name: str, history: int = 100):
+        """
+        Subscribers of a name and the last events, replayed to the clients that reconnect
+        :param history: Events kept for Last-Event-ID
+        """
+        self.name = name
+        self.subscribers: set[Subscriber] = set()
+        self.history: deque[tuple[str, bytes]] = deque(maxlen=history)
+
+    def replay(self, last_event_id: str) -> list[bytes]:
+        """The events after last_event_id, nothing if it's no longer in the history"""
+        events = []
+        found = False
+        for id_, data in self.history:
+            if found:
+                events.append(data)
+            elif id_ == last_event_id:
+                found = True
+        return events
+
+
+class Broadcaster:
+    """Event stream channels of this worker, with a single keep-alive timer for every subscriber"""
+    def __init__(self, keep_alive: float = 15.0, history: int = 100):
+        self.keep_alive = keep_alive
+        self.history = history
+        self.channels: dict[str, Channel] = {}
+        self.sent = 0
+        self.dropped = 0
+        # worker_bus.Bus, forwards the events to the other workers
+        self.bus = None
+        self.__timer: asyncio.Task = None
+
+    def subscribe(self, channel: str, last_event_id: str = None, queue_size: int = 256) -> Subscriber:
+        """Adds a subscriber, with the events it missed already queued"""
+        subscriber = Subscriber(channel, queue_size=queue_size)
+        if (current := self.channels.get(channel)) is None:
+            current = self.channels[channel] = Channel(channel, history=self.history)
+        if last_event_id is not None:
+            for data in current.replay(last_event_id):
+                subscriber.push(data)
+        current.subscribers.add(subscriber)
+        if self.keep_alive and (self.__timer is None or self.__timer.done()):
+            self.__timer = asyncio.ensure_future(self.__keep_alive())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        subscriber.closed = True
+        if (current := self.channels.get(subscriber.channel)) is not None:
+            current.subscribers.discard(subscriber)
+            if not current.subscribers and not current.history:
+                del self.channels[subscriber.channel]
+
+    def publish(self, channel: str, data: Any, event: str = None, id_: str | int = None, retry: int = None) -> int:
+        """
+        Sends an event to every subscriber of channel, in every worker if the bus is running.
+        Without an id, the next number of the channel is used (shared by the workers).
+        :return: The number of subscribers of this worker it was queued for
+        """
+        if id_ is None:
+            id_ = shared_store.get_store().incr(f'event-stream:{channel}')
+        id_ = str(id_)
+        formatted = format_event(data, event, id_, retry)
+        if self.bus is not None:
+            self.bus.event(channel, id_, formatted)
+        return self.deliver(channel, id_, formatted)
+
+    def deliver(self, channel: str, id_: str, formatted: bytes) -> int:
+        """Stores and fans out an already formatted event, a channel nobody subscribed to in this worker is skipped"""
+        if (current := self.channels.get(channel)) is None:
+            return 0
+        current.history.append((id_, formatted))
+        sent = 0
+        for subscriber in tuple(current.subscribers):
+            if subscriber.push(formatted):
+                sent += 1
+        self.sent += sent
+        self.dropped += len(current.subscribers) - sent
+        return sent
+
+    async def __keep_alive(self) -> None:
+        """Writes a comment to the subscribers that got nothing for keep_alive seconds, stops when none is left"""
+        while any(current.subscribers for current in self.channels.values()):
+            await asyncio.sleep(self.keep_alive / 2)
+            now = time.monotonic()
+            for current in tuple(self.channels.values()):
+                for subscriber in tuple(current.subscribers):
+                    if now - subscriber.last_write >= self.keep_alive:
+                        subscriber.push(KEEP_ALIVE)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'channels': len(self.channels),
+            'subscribers': sum(len(current.subscribers) for current in self.channels.values()),
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+
+broadcaster: Broadcaster = Broadcaster()
+
+
+async def stream(channel: str,
+                 last_event_id: str = None,
+                 queue_size: int = 256,
+                 handler: AsyncIterator[Any] = None,
+                 keep_open: bool = True) -> AsyncIterator[bytes]:
+    """
+    Body of an event stream response, the events of handler merged with the ones of the channel.
+    The client is subscribed once the body is sent, and unsubscribed when it ends
+    :param keep_open: Keep sending the channel events after the handler ends, until the client leaves
+    """
+    subscriber = broadcaster.subscribe(channel, last_event_id=last_event_id, queue_size=queue_size)
+
+    async def feed():
+        try:
+            async for item in handler:
+                await subscriber.put(format_item(item))
+        except Exception as e:
+            print(f'Event stream handler failed: {e!r}')
+            await subscriber.queue.put(None)
+            return
+        if not keep_open:
+            await subscriber.queue.put(None)
+
+    task = asyncio.ensure_future(feed()) if handler is not None else None
+    try:
+        while (data := await subscriber.queue.get()) is not None:
+            yield data
+    finally:
+        broadcaster.unsubscribe(subscriber)
+        if task is not None:
+            task.cancel()
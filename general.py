@@ -2,12 +2,19 @@ from typing import Any
 from collections.abc import MutableMapping
 import os
 from pathlib import Path
+import time
+import inspect
 from colors import *
-from quart import Request, request, Response, Websocket, websocket, abort
+import access_log
+import websocket_hub
+import event_stream
+import response_stream
+import request_body
+from quart import Request, request, Response, Websocket, websocket, abort, stream_with_context
 from hashlib import shake_128
+import manifest_cache
 import secrets
 from plugin_loader.v1 import Plugin
-from async_lru import alru_cache
 
 
 # https://www.freecodecamp.org/news/how-to-flatten-a-dictionary-in-python-in-4-different-ways/
@@ -22,6 +29,11 @@ def flatten_dict(d: MutableMapping, parent_key: str = '', sep: str = '.') -> Mut
     return dict(items)
 
 
+def load_yaml(path: str, compile_=None, kind: str = 'yaml') -> Any:
+    """Parses a YAML file, unchanged files come from the manifest cache"""
+    return manifest_cache.load(path, compile_, kind)
+
+
 def replace_variables(x: str, variables: dict[str, str] = None) -> str:
     """Given an x string, replaces the "variables" with the given values"""
     if variables is None:
@@ -69,33 +81,22 @@ def log_request(method: str = None,
                 raw_request: Request = None,
                 raw_response: Response = None,
                 custom_color: str = None) -> None:
-    base_color = OPS.RESET
-
+    """Queues an access log record, written in the background by access_log"""
+    remote_addr = None
     if raw_request is not None:
         method = raw_request.method
         endpoint = raw_request.full_path if len(raw_request.args) > 0 else raw_request.path
         return_code = raw_response.status_code
+        remote_addr = raw_request.remote_addr
 
-    ext_return_code = f' - {return_code}'
-    if return_code is None:
-        ext_return_code = ''
-        return_code = 0
-
-    if 100 <= return_code <= 199:
-        base_color = FC.WHITE
-    if 200 <= return_code <= 299:
-        base_color = FC.LIGHT_RED
-    if 300 <= return_code <= 399:
-        base_color = FC.LIGHT_MAGENTA
-    if 400 <= return_code <= 499:
-        base_color = FC.DARK_RED
-    if 500 <= return_code <= 599:
-        base_color = FC.DARK_CYAN
-
-    if custom_color is not None:
-        base_color = custom_color
-
-    print(f'{base_color} {method: <7} - {endpoint}{ext_return_code} {OPS.RESET}')
+    access_log.log({
+        'time': time.time(),
+        'method': method,
+        'path': endpoint,
+        'status': return_code,
+        'remote': remote_addr,
+        'color': custom_color,
+    })
 
 
 class ServerInformation:
@@ -113,11 +114,44 @@ class ServerInformation:
         return getattr(self, item)
 
 
-class WSWrapper(Websocket):
-    pass
+class WSWrapper:
+    """
+    The websocket given to socket handlers, it behaves like the quart websocket
+    and adds the topics and broadcasts of websocket_hub
+    """
+    def __init__(self, connection: websocket_hub.Connection):
+        self.connection = connection
+
+    def __getattr__(self, item) -> Any:
+        return getattr(self.connection.ws, item)
+
+    async def receive(self) -> str | bytes:
+        return await self.connection.receive()
+
+    async def send(self, data: str | bytes) -> None:
+        """Queued like the broadcasts, waits while the send queue is full"""
+        await self.connection.send(data)
+
+    async def receive_json(self) -> Any:
+        return self.connection.ws.json_module.loads(await self.receive())
+
+    async def send_json(self, data: Any) -> None:
+        await self.send(self.connection.ws.json_module.dumps(data))
+
+    def subscribe(self, topic: str) -> None:
+        websocket_hub.hub.subscribe(self.connection, topic)
+
+    def unsubscribe(self, topic: str) -> None:
+        websocket_hub.hub.unsubscribe(self.connection, topic)
+
+    def publish(self, topic: str, message: Any, include_self: bool = False) -> int:
+        """Sends a message to every subscriber of topic"""
+        return websocket_hub.hub.publish(topic, message, exclude=None if include_self else self.connection)
 
-    async def broadcast(self) -> None:
-        pass
+    def broadcast(self, message: Any, include_self: bool = False) -> int:
+        """Sends a message to every client connected to the same endpoint"""
+        return websocket_hub.hub.broadcast(self.connection.endpoint, message,
+                                           exclude=None if include_self else self.connection)
 
 
 def create_endpoint_function(plugin: Plugin, endpoint, loader, error_handlers):
@@ -125,24 +159,53 @@ def create_endpoint_function(plugin: Plugin, endpoint, loader, error_handlers):
     function_identifier = secrets.token_hex(4)
     function_name = f'{plugin_id}_c{function_identifier}'
 
+    options = plugin.manager.endpoints[endpoint]
+    cache = options['cache']
+    max_body_size = options['max-body-size']
+    # only the functions that ask for it get the body to stream
+    takes_body = 'body' in inspect.signature(options['func']).parameters
+
     async def endpoint_function(*args, **kwargs):
-        retrn = loader.call_id('server.request', request)
+        max_size = max_body_size if max_body_size is not None else request.max_content_length
+        if isinstance(request.body, request_body.Body):
+            if takes_body:
+                # RequestBody checks the total, only a small window is buffered
+                request.body.stream()
+            elif max_body_size is not None:
+                request.body.set_max_size(max_body_size)
+        if max_size is not None and (request.content_length or 0) > max_size:
+            # refused before anything is read
+            abort(413)
+        retrn = await loader.call_id_async('server.request', request)
         if retrn is not None:
             return retrn
-        try:
-            data, return_code = await plugin.manager.call_endpoint(
-                endpoint=endpoint, *args, **kwargs, request=request
+
+        async def compute():
+            body = {'body': request_body.RequestBody(request._get_current_object(), max_size=max_size,
+                                                     spool_threshold=options['spool-threshold'])} if takes_body else {}
+            return await plugin.manager.call_endpoint(
+                endpoint=endpoint, *args, **kwargs, **body, request=request
             )
-        except (ValueError, TypeError):
-            raise ValueError(f'Endpoint "{endpoint}" in {plugin.configuration.id_} does not return 2 values')
+
+        if cache is not None:
+            result = await cache.get_or_compute(request, kwargs, compute)
+        else:
+            result = await compute()
+        if not isinstance(result, tuple) or len(result) not in (2, 3):
+            raise ValueError(f'Endpoint "{endpoint}" in {plugin.configuration.id_} does not return 2 or 3 values')
+        data, return_code, *headers = result
         if return_code in error_handlers:
+            if response_stream.is_stream(data):
+                await response_stream.close(data)
             abort(return_code)
-        return data, return_code
-
-
-    if plugin.manager.endpoints[endpoint]['lru-cache']:
-        endpoint_function = alru_cache()(endpoint_function)
-
+        if response_stream.is_stream(data):
+            # sent while it's produced, in the request context like the event streams
+            response = Response(stream_with_context(response_stream.iterate)(data), return_code,
+                                headers=headers[0] if headers else None)
+            # an export can take longer than RESPONSE_TIMEOUT
+            response.timeout = None
+            return response
+        return result
 
     endpoint_function.__name__ = function_name
     return endpoint_function
@@ -153,14 +216,63 @@ def create_socket_function(plugin, endpoint):
     function_identifier = secrets.token_hex(4)
     function_name = f'{plugin_id}_s{function_identifier}'
 
+    options = plugin.manager.socket_options[endpoint]
+
     async def socket_function(*args, **kwargs):
         # await LOADER.call_id('server.socket', websocket)
         log_request(method='SOCKET',
                     endpoint=websocket.full_path if len(websocket.args) > 0 else websocket.path,
                     return_code=None,
                     custom_color=FC.DARK_GREEN)
-        await plugin.manager.socket(endpoint=endpoint, *args, **kwargs, ws=websocket)
+        if options['max-connections'] is not None and \
+                websocket_hub.hub.count(endpoint) >= options['max-connections']:
+            # refuses the handshake
+            await websocket.close(1013, 'Too many connections')
+            return
+        connection = websocket_hub.hub.register(websocket_hub.Connection(
+            websocket._get_current_object(), endpoint,
+            send_queue_size=options['send-queue-size'],
+            send_queue_bytes=options['send-queue-bytes'],
+            slow_consumer=options['slow-consumer'],
+            max_message_size=options['max-message-size'],
+            idle_timeout=options['idle-timeout']
+        ))
+        try:
+            await plugin.manager.socket(endpoint=endpoint, *args, **kwargs, ws=WSWrapper(connection))
+        except websocket_hub.MessageTooLarge:
+            # already closed with 1009
+            pass
+        finally:
+            websocket_hub.hub.unregister(connection)
 
 
     socket_function.__name__ = function_name
     return socket_function
+
+
+def create_sse_function(plugin, endpoint):
+    plugin_id = 'f' + shake_128(plugin.configuration.id_.encode()).hexdigest(8)
+    function_identifier = secrets.token_hex(4)
+    function_name = f'{plugin_id}_e{function_identifier}'
+
+    options = plugin.manager.event_stream_options[endpoint]
+
+    async def sse_function(*args, **kwargs):
+        last_event_id = request.headers.get('Last-Event-ID')
+        handler = plugin.manager.event_stream(endpoint, *args, **kwargs, last_event_id=last_event_id)
+        # the handler runs in the request context, like the endpoint functions
+        response = Response(stream_with_context(event_stream.stream)(options['channel'],
+                                                                     last_event_id=last_event_id,
+                                                                     queue_size=options['queue-size'],
+                                                                     handler=handler,
+                                                                     keep_open=options['keep-open']),
+                            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # proxies must not buffer the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        # open until the client leaves
+        response.timeout = None
+        return response
+
+    sse_function.__name__ = function_name
+    return sse_function
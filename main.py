@@ -1,7 +1,22 @@
 # - imports
 # general
+from typing import Any
 import os
+import sys
+import time
+import signal
+import warnings
+import socket
+import traceback
 import general
+import access_log
+import shared_store
+import worker_bus
+import event_stream
+import manifest_cache
+import request_body
+from startup_timeline import timeline
+from concurrent.futures import ThreadPoolExecutor
 from colors import *
 
 # server framework
@@ -23,6 +38,7 @@ import secrets
 
 # plugins
 from plugin_loader.v1 import Loader
+from plugin_loader import v2 as plugin_loader_v2
 import textwrap
 from hashlib import shake_128
 # from functools import lru_cache
@@ -41,6 +57,11 @@ plugin_loader: Loader = Loader(
                      plugin_directory=JOIN(ROOT_DIR, 'plugins'),
                      raise_on_error=False
                  )
+# plugins with loader.lazy, imported on their first request
+lazy_plugin_loader: plugin_loader_v2.Loader = plugin_loader_v2.Loader(
+                     plugin_directory=JOIN(ROOT_DIR, 'plugins'),
+                     raise_on_error=False
+                 )
 
 # dynamic
 PORT: general.DynamicValue = general.DynamicValue(int)
@@ -60,12 +81,12 @@ SSL_KEY_PASSWORD: str = None
 print(f'{SERVER_NAME} (version: {VERSION})')
 
 # load config
+timeline.phase('config')
+# parsed and validated yaml files, reused while they don't change
+manifest_cache.setup(JOIN(ROOT_DIR, '.cache', 'manifests.pickle'))
 
 print(f'Loading {FC.LIGHT_GREEN}config.yml{OPS.RESET}')
-with open(JOIN(ROOT_DIR, 'config.yml'), 'r') as conf_file:
-    config: dict = yaml.safe_load(conf_file)
-    config: dict = general.flatten_dict(config)
-del conf_file
+config: dict = general.flatten_dict(general.load_yaml(JOIN(ROOT_DIR, 'config.yml')))
 
 PORT: int = PORT.check_type(config.get('server.port'))
 HTML_DIRECTORY: str = HTML_DIRECTORY.check_type(config.get('server.html-directory'))
@@ -100,42 +121,101 @@ if config.get('server.secret-key') is None:
 
 SERVER: str = SERVER.check_type(config.get('server.base-server'))
 
+WORKERS: int = general.DynamicValue(int).check_type(config.get('server.workers.count', 1))
+WORKER_CPU_AFFINITY: bool = general.DynamicValue(bool).check_type(config.get('server.workers.cpu-affinity', False))
+WORKER_RESTART: bool = general.DynamicValue(bool).check_type(config.get('server.workers.restart', True))
+WORKER_RESTART_DELAY: float = float(config.get('server.workers.restart-delay', 1.0))
+WORKER_BUS: bool = general.DynamicValue(bool).check_type(config.get('server.workers.bus.enabled', True))
+WORKER_BUS_MAX_BUFFER: int = general.DynamicValue(int).check_type(config.get('server.workers.bus.max-buffer', 8388608))
+
+WEBSOCKET_PING_INTERVAL: float = float(config.get('server.websocket.ping-interval', 20.0))
+WEBSOCKET_PING_TIMEOUT: float = float(config.get('server.websocket.ping-timeout', 20.0))
+WEBSOCKET_MAX_MESSAGE_SIZE: int = general.DynamicValue(int).check_type(
+    config.get('server.websocket.max-message-size', 16777216))
+WEBSOCKET_PER_MESSAGE_DEFLATE: bool = general.DynamicValue(bool).check_type(
+    config.get('server.websocket.per-message-deflate', True))
+
+STARTUP_WORKERS: int = general.DynamicValue(int).check_type(config.get('server.startup.workers', 1))
+STARTUP_REPORT: bool = general.DynamicValue(bool).check_type(config.get('server.startup.report', True))
+STARTUP_REPORT_FORMAT: str = general.DynamicValue(str).check_type(config.get('server.startup.report-format', 'text'))
+
+event_stream.broadcaster.keep_alive = float(config.get('server.event-stream.keep-alive', 15.0))
+event_stream.broadcaster.history = general.DynamicValue(int).check_type(config.get('server.event-stream.history', 100))
+
+# created before the plugins are loaded and the workers forked
+shared_store.setup(
+    size=general.DynamicValue(int).check_type(config.get('server.shared-store.size', 16777216)),
+    max_key_size=general.DynamicValue(int).check_type(config.get('server.shared-store.max-key-size', 128)),
+    max_value_size=general.DynamicValue(int).check_type(config.get('server.shared-store.max-value-size', 1024))
+)
+
+ACCESS_LOG_FILE: str = config.get('server.access-log.file')
+if ACCESS_LOG_FILE is not None:
+    ACCESS_LOG_FILE: str = general.DynamicValue(str).check_type(ACCESS_LOG_FILE)
+    ACCESS_LOG_FILE: str = os.path.abspath(general.replace_variables(ACCESS_LOG_FILE,
+                                                                     {'$(ROOT)': ROOT_DIR,
+                                                                      '$(CWD)': CWD}))
+access_log.setup(
+    console=general.DynamicValue(bool).check_type(config.get('server.access-log.console', True)),
+    console_colors=general.DynamicValue(bool).check_type(config.get('server.access-log.console-colors', True)),
+    file=ACCESS_LOG_FILE,
+    max_bytes=general.DynamicValue(int).check_type(config.get('server.access-log.max-bytes', 10485760)),
+    backup_count=general.DynamicValue(int).check_type(config.get('server.access-log.backup-count', 5)),
+    queue_size=general.DynamicValue(int).check_type(config.get('server.access-log.queue-size', 10000)),
+    sample_rate=float(config.get('server.access-log.sample-rate', 1.0))
+)
+if ACCESS_LOG_FILE is not None:
+    print(f'Access log: {FC.LIGHT_GREEN}{ACCESS_LOG_FILE}{OPS.RESET}')
+
 # app init
 print(f'running on: {FC.LIGHT_BLUE}quart{OPS.RESET}/{FC.LIGHT_YELLOW}{SERVER}{OPS.RESET}')
 app = Quart(__name__,
             static_folder=None, template_folder=None)
 app.config['SECRET_KEY'] = SECRET_KEY.check_type(config['server.secret-key'])
+# the plugin routes set the body limits of their requests, a streamed body holds the network back
+app.request_class = request_body.StreamingRequest
+app.asgi_http_class = request_body.StreamingConnection
 # CORS implementation
 app.config['CORS_HEADERS'] = 'Content-Type'
 
 print('Loading plugins')
-plugin_loader.load_plugins()
-plugin_loader.init_plugins()
+timeline.phase('manifests')
+plugin_loader.load_plugins(workers=STARTUP_WORKERS)
+lazy_plugin_loader.load_plugins()
+timeline.phase('imports')
+plugin_loader.init_plugins(workers=STARTUP_WORKERS)
+timeline.phase('managers')
 plugin_loader.load_managers()
 
 #  please don't use this call
 plugin_loader.call_id('plugin._attr')
 
+SERVER_INFORMATION: dict[str, Any] = {
+    'ROOT_DIR': ROOT_DIR,
+    'CWD': CWD,
+    'JOIN': JOIN,
+    'METHODS': METHODS,
+    'SERVER_NAME': SERVER_NAME,
+    'LOADER': plugin_loader,
+    'PORT': PORT,
+    'HTML_DIRECTORY': HTML_DIRECTORY,
+    'SECRET_KEY': SECRET_KEY,
+    'INDEX_FILE': INDEX_FILE,
+    'SERVER': SERVER,
+    'SSL_ENABLED': SSL_ENABLED,
+    'ERROR_CODE_HANDLERS': ERROR_CODE_HANDLERS,
+    'SSL_CERT_FILE': SSL_CERT_FILE,
+    'SSL_KEY_FILE': SSL_KEY_FILE,
+    'SSL_KEY_PASSWORD': SSL_KEY_PASSWORD,
+    'WORKERS': WORKERS,
+    # set in each worker
+    'WORKER_ID': 0,
+}
 for plugin in plugin_loader.plugins:
-    plugin.manager.SERVER_INFORMATION = general.ServerInformation({
-        'ROOT_DIR': ROOT_DIR,
-        'CWD': CWD,
-        'JOIN': JOIN,
-        'METHODS': METHODS,
-        'SERVER_NAME': SERVER_NAME,
-        'LOADER': plugin_loader,
-        'PORT': PORT,
-        'HTML_DIRECTORY': HTML_DIRECTORY,
-        'SECRET_KEY': SECRET_KEY,
-        'INDEX_FILE': INDEX_FILE,
-        'SERVER': SERVER,
-        'SSL_ENABLED': SSL_ENABLED,
-        'ERROR_CODE_HANDLERS': ERROR_CODE_HANDLERS,
-        'SSL_CERT_FILE': SSL_CERT_FILE,
-        'SSL_KEY_FILE': SSL_KEY_FILE,
-        'SSL_KEY_PASSWORD': SSL_KEY_PASSWORD,
-    })
+    plugin.manager.SERVER_INFORMATION = general.ServerInformation(SERVER_INFORMATION)
     plugin.manager.loader = plugin_loader
+lazy_plugin_loader.server_information = general.ServerInformation(SERVER_INFORMATION)
+lazy_plugin_loader.events_loader = plugin_loader
 
 app.before_request(plugin_loader.get_exposed('check_scheme'))
 app.route('/', methods=METHODS, defaults={'file': INDEX_FILE})(
@@ -144,15 +224,20 @@ app.route('/', methods=METHODS, defaults={'file': INDEX_FILE})(
     )
 )
 app.after_request(plugin_loader.get_exposed('server_after_request'))
+app.before_serving(plugin_loader.get_exposed('start_reachability_check'))
+# websocket publish/broadcast reach the other workers, does nothing with a single process
+app.before_serving(worker_bus.start)
+app.after_serving(worker_bus.stop)
 
 print('Loading Error Handlers')
-for handler_file in os.listdir(JOIN(ROOT_DIR, 'error-handlers')):
-    handler_path = JOIN(ROOT_DIR, 'error-handlers', handler_file)
-
-    with open(handler_path, 'r') as f_handler:
-        handler_data = yaml.safe_load(f_handler)
-    del f_handler
-
+timeline.phase('error handlers')
+handler_paths = [JOIN(ROOT_DIR, 'error-handlers', handler_file)
+                 for handler_file in os.listdir(JOIN(ROOT_DIR, 'error-handlers'))]
+with ThreadPoolExecutor(max_workers=STARTUP_WORKERS) as yaml_executor:
+    handlers_data = list(yaml_executor.map(general.load_yaml, handler_paths))
+del yaml_executor
+
+for handler_path, handler_data in zip(handler_paths, handlers_data):
     code_from_name = int(os.path.basename(handler_path).rsplit('.', 1)[0])
 
     error_code = handler_data.get('error-code', code_from_name)
@@ -176,41 +261,27 @@ for handler_file in os.listdir(JOIN(ROOT_DIR, 'error-handlers')):
 
 print(f'Added error handlers for: {', '.join([f'{FC.DARK_CYAN}{x}{OPS.RESET}' for x in ERROR_CODE_HANDLERS])}')
 
+timeline.phase('endpoint registration')
 plugin_loader.call_id('plugin.pre-load')
 
 plugin_loader.print_events()
 plugin_loader.load_endpoints(app, METHODS, ERROR_CODE_HANDLERS)
 plugin_loader.load_sockets(app)
+plugin_loader.load_event_streams(app)
+lazy_plugin_loader.register(app, METHODS, ERROR_CODE_HANDLERS)
+plugin_loader.load_middlewares(app)
 
 plugin_loader.call_id('plugin.loaded')
 plugin_loader.call_id('server.on-load')  # legacy
+timeline.stop()
+manifest_cache.cache.save()
 
-if __name__ == '__main__':
-    nat_addr = plugin_loader.run('get_local_ip')
-    public_addr = plugin_loader.run('get_public_ip')
-
-    protocol = 'http' if PORT != 443 else 'https'
-    link_port = f':{PORT}' if PORT not in (80, 443) else ''
-
-    print('Checking Public IP connection')
-    if public_addr_reachable := plugin_loader.run('check_public_ip', public_addr, PORT):
-        print(f'{FC.LIGHT_GREEN}Public IP is reachable{OPS.RESET}')
-    else:
-        print(f'{FC.LIGHT_RED}Public IP is not reachable{OPS.RESET}')
-
-    print('Starting Webserver, use CTRL+C to exit')
-    print(f'Connect to the server using this links:\n'
-          f'  {FC.LIGHT_BLUE}Local Machine{OPS.RESET}: {protocol}://127.0.0.1{link_port}/\n'
-          f'  {FC.LIGHT_BLUE}Local Network{OPS.RESET}: {protocol}://{nat_addr}{link_port}/')
-    if public_addr_reachable:
-        print(f'  {FC.LIGHT_BLUE}Public{OPS.RESET}       : {protocol}://{public_addr}{link_port}/')
-
-    plugin_loader.call_id('server.start')
-
+def serve_app(sockets: list[socket.socket] = None) -> None:
+    """Runs the selected server until it stops, on the already bound sockets if given"""
     try:
         match SERVER.lower():
             case 'uvicorn':
-                uvicorn.run(
+                uvicorn_config = uvicorn.Config(
                     app,
                     host='0.0.0.0',
                     port=PORT,
@@ -219,8 +290,13 @@ if __name__ == '__main__':
                     access_log=False, log_level=50,
                     ssl_certfile=SSL_CERT_FILE,
                     ssl_keyfile=SSL_KEY_FILE,
-                    ssl_keyfile_password=SSL_KEY_PASSWORD
+                    ssl_keyfile_password=SSL_KEY_PASSWORD,
+                    ws_max_size=WEBSOCKET_MAX_MESSAGE_SIZE,
+                    ws_ping_interval=WEBSOCKET_PING_INTERVAL or None,
+                    ws_ping_timeout=WEBSOCKET_PING_TIMEOUT or None,
+                    ws_per_message_deflate=WEBSOCKET_PER_MESSAGE_DEFLATE
                 )
+                uvicorn.Server(uvicorn_config).run(sockets=sockets[:1] if sockets else None)
             case 'hypercorn':
                 base_config = Config.from_mapping({
                     'certfile': SSL_CERT_FILE,
@@ -228,9 +304,13 @@ if __name__ == '__main__':
                     'keyfile_password': SSL_KEY_PASSWORD,
                     'include_server_header': False,
                     # 'quic_bind': f'0.0.0.0:{PORT}',
-                    'bind': f'0.0.0.0:{PORT}',
-                    'insecure_bind': f'0.0.0.0:80' if SSL_ENABLED and PORT == 443 else None,
+                    'bind': f'fd://{sockets[0].fileno()}' if sockets else f'0.0.0.0:{PORT}',
+                    'insecure_bind': (f'fd://{sockets[1].fileno()}' if sockets else f'0.0.0.0:80')
+                                     if SSL_ENABLED and PORT == 443 else None,
                     'loglevel': 'ERROR',
+                    # hypercorn always negotiates permessage-deflate and has no ping timeout
+                    'websocket_max_message_size': WEBSOCKET_MAX_MESSAGE_SIZE,
+                    'websocket_ping_interval': WEBSOCKET_PING_INTERVAL or None,
                 })
                 asyncio.run(serve(app, base_config))
             case _:
@@ -243,4 +323,148 @@ if __name__ == '__main__':
             print('SSL is enabled but the files could not be found')
             plugin_loader.call_id('server.error.ssl')
 
+
+def bind_socket(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(worker_id: int, sockets: list[socket.socket], broker: worker_bus.Broker = None) -> None:
+    """Body of a forked worker, never returns"""
+    if broker is not None:
+        worker_bus.setup(broker.worker_socket(worker_id), max_buffer=WORKER_BUS_MAX_BUFFER)
+    access_log.current.for_worker(worker_id)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if WORKER_CPU_AFFINITY and hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+    for plugin in plugin_loader.plugins:
+        plugin.manager.SERVER_INFORMATION.WORKER_ID = worker_id
+    lazy_plugin_loader.server_information.WORKER_ID = worker_id
+    exit_code = 0
+    try:
+        plugin_loader.call_id('server.start')
+        serve_app(sockets)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        access_log.current.close()
+        sys.stdout.flush()
+        os._exit(exit_code)
+
+
+def run_workers() -> None:
+    """Forks WORKERS processes sharing the listening sockets, restarting the ones that exit"""
+    sockets = [bind_socket(PORT)]
+    if SSL_ENABLED and PORT == 443 and SERVER.lower() == 'hypercorn':
+        sockets.append(bind_socket(80))
+    broker = worker_bus.Broker(WORKERS, max_buffer=WORKER_BUS_MAX_BUFFER) if WORKER_BUS else None
+    workers: dict[int, int] = {}
+    stopping = False
+
+    def spawn(worker_id: int, restart: bool = False) -> None:
+        if broker is not None and restart:
+            broker.renew(worker_id)
+        with warnings.catch_warnings():
+            # the restarts fork while the bus relay thread runs, it holds no lock the worker uses:
+            # it only reads and writes the non-blocking sockets of the broker, which the worker closes first
+            warnings.simplefilter('ignore', DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:
+            run_worker(worker_id, sockets, broker)
+        if broker is not None:
+            broker.detach(worker_id)
+        workers[pid] = worker_id
+        print(f'Started worker {FC.DARK_CYAN}{worker_id}{OPS.RESET} (pid: {pid})')
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for worker_pid in list(workers):
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for i in range(WORKERS):
+        spawn(i)
+    if broker is not None:
+        broker.start()
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = workers.pop(pid, None)
+        if shared_store.recover(pid):
+            print(f'{FC.LIGHT_RED}WARNING!{OPS.RESET} Worker {worker_id} exited holding the shared store lock, '
+                  f'released')
+        if worker_id is None or stopping:
+            continue
+        print(f'{FC.LIGHT_RED}Worker {worker_id} exited{OPS.RESET} (pid: {pid}, '
+              f'exit code: {os.waitstatus_to_exitcode(status)})')
+        if WORKER_RESTART:
+            # avoids a fork loop if the worker can't start
+            time.sleep(WORKER_RESTART_DELAY)
+            if not stopping:
+                spawn(worker_id, restart=True)
+
+    if broker is not None:
+        broker.stop()
+    for sock in sockets:
+        sock.close()
+
+
+def print_startup_report() -> None:
+    if not STARTUP_REPORT:
+        return
+    if STARTUP_REPORT_FORMAT.lower() == 'json':
+        # a single line, easy to grep in the deploy logs
+        print(f'startup-timeline {timeline.to_json()}')
+    else:
+        print(timeline.report())
+
+
+if __name__ == '__main__':
+    timeline.phase('public-ip checks')
+    nat_addr = plugin_loader.run('get_local_ip')
+    public_addr = plugin_loader.run('get_public_ip')
+
+    protocol = 'http' if PORT != 443 else 'https'
+    link_port = f':{PORT}' if PORT not in (80, 443) else ''
+
+    # result of the last check, a new one runs in the background once the server listens
+    print('Checking Public IP connection in the background')
+    if public_addr_reachable := plugin_loader.run('check_public_ip', public_addr, PORT):
+        print(f'{FC.LIGHT_GREEN}Public IP was reachable{OPS.RESET} (last check)')
+    timeline.stop()
+    print_startup_report()
+
+    print('Starting Webserver, use CTRL+C to exit')
+    print(f'Connect to the server using this links:\n'
+          f'  {FC.LIGHT_BLUE}Local Machine{OPS.RESET}: {protocol}://127.0.0.1{link_port}/\n'
+          f'  {FC.LIGHT_BLUE}Local Network{OPS.RESET}: {protocol}://{nat_addr}{link_port}/')
+    if public_addr_reachable:
+        print(f'  {FC.LIGHT_BLUE}Public{OPS.RESET}       : {protocol}://{public_addr}{link_port}/')
+
+    if WORKERS > 1 and hasattr(os, 'fork'):
+        run_workers()
+    else:
+        if WORKERS > 1:
+            print(f'{FC.LIGHT_RED}WARNING!{OPS.RESET} Workers need os.fork, running a single process')
+        plugin_loader.call_id('server.start')
+        serve_app()
+
     print('Closing WebServer')
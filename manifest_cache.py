@@ -0,0 +1,128 @@
+from typing import Any, Callable
+import os
+import pickle
+import hashlib
+import threading
+import yaml
+
+# bumped when the snapshot layout changes, older snapshots are ignored
+FORMAT = 1
+
+# the libyaml parser when available, several times faster
+YAMLLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class CacheEntry:
+    __slots__ = ('mtime_ns', 'size', 'digest', 'value')
+
+    def __init__(self, mtime_ns: int, size: int, digest: bytes, value: Any):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        self.value = value
+
+    def __getstate__(self):
+        return self.mtime_ns, self.size, self.digest, self.value
+
+    def __setstate__(self, state):
+        self.mtime_ns, self.size, self.digest, self.value = state
+
+
+class ManifestCache:
+    def __init__(self, path: str = None):
+        """
+        Parsed and validated YAML files (plugin.yml, config.yml, error handlers) kept in a pickle snapshot.
+        An entry is reused while the mtime and size of its file don't change, or if its content has the same hash.
+        :param path: Snapshot file, read once by the first lookup and written by .save(), None keeps it in memory
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # (file, kind) -> entry
+        self.__entries: dict[tuple[str, str], CacheEntry] = None
+        self.__dirty = False
+        self.__lock = threading.Lock()
+
+    def __read_snapshot(self) -> dict[tuple[str, str], CacheEntry]:
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'rb') as file:
+                version, entries = pickle.load(file)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError, AttributeError):
+            return {}
+        return entries if version == FORMAT else {}
+
+    def load(self, path: str, compile_: Callable[[Any], Any] = None, kind: str = 'yaml') -> Any:
+        """
+        The YAML file at path, through compile_ if given (a validation, a flattening, ...)
+        :param kind: Name of compile_, files compiled in different ways are cached separately
+        """
+        path = os.path.abspath(path)
+        key = (path, kind)
+        with self.__lock:
+            if self.__entries is None:
+                self.__entries = self.__read_snapshot()
+            entry = self.__entries.get(key)
+
+        stat = os.stat(path)
+        if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+            self.hits += 1
+            # a new object every time, the callers can modify it
+            return pickle.loads(entry.value)
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        digest = hashlib.sha256(data).digest()
+        if entry is not None and entry.digest == digest:
+            # touched but not changed
+            self.hits += 1
+            value = entry.value
+        else:
+            self.misses += 1
+            compiled = yaml.load(data, Loader=YAMLLoader)
+            if compile_ is not None:
+                compiled = compile_(compiled)
+            value = pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self.__lock:
+            self.__entries[key] = CacheEntry(stat.st_mtime_ns, stat.st_size, digest, value)
+            self.__dirty = True
+        return pickle.loads(value)
+
+    def save(self) -> None:
+        """Writes the snapshot if something changed, replaced atomically"""
+        with self.__lock:
+            if not self.__dirty or self.path is None:
+                return
+            # the files that no longer exist are dropped
+            entries = {key: entry for key, entry in self.__entries.items() if os.path.exists(key[0])}
+            self.__dirty = False
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as file:
+                pickle.dump((FORMAT, entries), file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print(f'Manifest cache could not be saved: {e!r}')
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries or ()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+cache: ManifestCache = ManifestCache()
+
+
+def setup(path: str = None) -> ManifestCache:
+    global cache
+    cache = ManifestCache(path)
+    return cache
+
+
+def load(path: str, compile_: Callable[[Any], Any] = None, kind: str = 'yaml') -> Any:
+    return cache.load(path, compile_, kind)
@@ -3,15 +3,19 @@ from dataclasses import dataclass
 from types import ModuleType
 from typing import Any
 import general
-from yaml import safe_load
 import io
 import sys
 import importlib.util
 import contextlib
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from colors import FC, OPS
 from plugin_manager import Manager, ManagerError
 from enum import Enum
-from quart import Quart
+from quart import Quart, Response, request
 
 
 def check_requirements_from_dict(data: dict) -> bool:
@@ -20,9 +24,6 @@ def check_requirements_from_dict(data: dict) -> bool:
     # for key in flatten_dict(data).keys():
     #     if not (key in required_attrs):
     #         return False
-    for required_attr in required_attrs:
-        if not (required_attr in general.flatten_dict(data).keys()):
-            return False
     flatten_data = general.flatten_dict(data)
     for attr in required_attrs:
         if flatten_data.get(attr) is None:
@@ -30,6 +31,11 @@ def check_requirements_from_dict(data: dict) -> bool:
     return True
 
 
+def compile_manifest(data: dict) -> tuple[dict, bool]:
+    """What the manifest cache keeps of a plugin.yml, the data and whether it's complete"""
+    return data, isinstance(data, dict) and check_requirements_from_dict(data=data)
+
+
 @dataclass
 class PluginConfiguration:
     name: str
@@ -38,6 +44,8 @@ class PluginConfiguration:
     id_: str
     loader_required: float
     loader_preferred: float
+    # ids of the plugins imported before this one by a parallel .init_plugins()
+    depends: tuple[str, ...] = ()
 
     def from_dict(self, data: dict):
         # if check_requirements_from_dict(data=data):
@@ -48,6 +56,7 @@ class PluginConfiguration:
         self.id_ = flatten_data.get('plugin.id')
         self.loader_required = flatten_data.get('loader.required-version')
         self.loader_preferred = flatten_data.get('loader.preferred-version')
+        self.depends = tuple(flatten_data.get('loader.depends') or ())
 
 
 class PrefixedStringIO(io.StringIO):
@@ -66,6 +75,22 @@ class PrefixedStringIO(io.StringIO):
             self.added = False
 
 
+class ThreadStdout(io.TextIOBase):
+    """
+    sys.stdout while the plugins are imported in parallel, redirect_stdout can't be used by several threads,
+    the writes of a thread go to the buffer of the plugin it's importing
+    """
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def write(self, s):
+        return (getattr(self.local, 'target', None) or self.default).write(s)
+
+    def flush(self):
+        self.default.flush()
+
+
 class Plugin:
     def __init__(self,
                  configuration: PluginConfiguration,
@@ -88,13 +113,17 @@ class Plugin:
     def inject_attr(self, attr: Any, attr_name: str) -> None:
         self.injected_attrs.append((attr, attr_name))
 
-    def init(self) -> None:
+    def init(self, redirect_stdout: bool = True) -> None:
+        """
+        Imports the main file of the plugin
+        :param redirect_stdout: Redirect sys.stdout to the plugin buffer, False if the caller routes it
+        """
         name = self.main_file.split(os.sep)[-1].split('.')[0]
         spec = importlib.util.spec_from_file_location(name, self.main_file)
         module = importlib.util.module_from_spec(spec)
         for attr, name in self.injected_attrs:
             setattr(module, name, attr)
-        with contextlib.redirect_stdout(self.stdout_buffer):
+        with contextlib.redirect_stdout(self.stdout_buffer) if redirect_stdout else contextlib.nullcontext():
             spec.loader.exec_module(module)
         self.module = module
 
@@ -110,6 +139,12 @@ class Plugin:
                 raise ValueError(f'{self.configuration.name} : Manager Not Found')
 
 
+def path_in_prefix(path: str, prefix: str) -> bool:
+    """If path is prefix or below it on a segment boundary, "/api" covers "/api/users" but not "/apix"."""
+    prefix = prefix.rstrip('/')
+    return path == prefix or path.startswith(prefix + '/')
+
+
 class PluginError(Exception):
     def __init__(self, _type: str, message: str):
         self._type = _type
@@ -135,23 +170,50 @@ class Loader:
         self.plugin_loaded = LoaderState.base
         self.roe = raise_on_error
         self.exposed = {}
+        # event -> [(plugin, handler), ...] in plugin order, built by .load_managers()
+        self.events: dict[str, list[tuple[Plugin, Any]]] = {}
+        self.observers: dict[str, list[tuple[Plugin, Any]]] = {}
+        self.background_tasks: set[asyncio.Future] = set()
+        # (plugin id, event) already warned about an async handler called with .call_id()
+        self.__async_call_warned: set[tuple[str, str]] = set()
+        # url rule -> ([(plugin, func, prefix or None), ...] before, [...] after), built by .load_middlewares()
+        self.middlewares: dict[str, tuple[list[tuple[Plugin, Any, str | None]],
+                                          list[tuple[Plugin, Any, str | None]]]] = {}
         self.longest_endpoint = 0
         self.longest_id = 0
 
-    def load_plugins(self):
-        for plugin in os.listdir(self.directory):
-            plugin_path = os.path.join(self.directory, plugin)
-            if not os.path.exists(os.path.join(plugin_path, 'plugin.yml')):
+    def __read_manifest(self, plugin: str) -> tuple[dict, bool] | None:
+        plugin_path = os.path.join(self.directory, plugin)
+        if not os.path.exists(os.path.join(plugin_path, 'plugin.yml')):
+            return None
+        return general.load_yaml(os.path.join(plugin_path, 'plugin.yml'), compile_manifest, kind='v1-manifest')
+
+    def load_plugins(self, workers: int = 1):
+        """
+        Reads the plugin.yml of every plugin
+        :param workers: Manifests parsed at the same time
+        """
+        names = os.listdir(self.directory)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='manifest') as executor:
+                manifests = list(executor.map(self.__read_manifest, names))
+        else:
+            manifests = [self.__read_manifest(plugin) for plugin in names]
+
+        for plugin, manifest in zip(names, manifests):
+            if manifest is None:
                 if self.roe:
                     raise PluginError('Loader', f'Plugin "{plugin}" doesn\'t contain a "plugin.yml" file')
                 print(str(PluginError('Loader', f'Plugin "{plugin}" doesn\'t contain a "plugin.yml" file')))
                 continue
-            with open(os.path.join(plugin_path, 'plugin.yml'), 'r') as _f_plugin_configuration:
-                plugin_configuration = safe_load(_f_plugin_configuration)
-            if check_requirements_from_dict(data=plugin_configuration):
+            plugin_configuration, complete = manifest
+            if complete:
                 if not plugin_configuration.get('loader').get('enable-plugin', True):
                     # Plugin disabled
                     continue
+                if plugin_configuration.get('loader').get('lazy', False):
+                    # imported on its first request by plugin_loader.v2.Loader
+                    continue
                 plugin_conf = PluginConfiguration(
                     name=None,
                     version=None,
@@ -177,16 +239,56 @@ class Loader:
             self.plugins.append(plg)
         self.plugin_loaded = LoaderState.load_plugins
 
-    def init_plugins(self):
+    def init_plugins(self, workers: int = 1):
+        """
+        Imports the plugins
+        :param workers: Plugins imported at the same time, a plugin waits for the ones in its loader.depends
+        """
         if self.plugin_loaded < LoaderState.load_plugins:
             if self.roe:
                 raise PluginError('Loader', f'Use .load_plugins() before')
             print(str(PluginError('Loader', f'Use .load_plugins() before')))
             return
-        for plugin in self.plugins:
-            plugin.init()
+        if workers > 1 and len(self.plugins) > 1:
+            self.__init_plugins_parallel(workers)
+        else:
+            for plugin in self.plugins:
+                plugin.init()
         self.plugin_loaded = LoaderState.init_plugins
 
+    def __init_plugins_parallel(self, workers: int) -> None:
+        stdout = ThreadStdout(sys.stdout)
+
+        def init(plugin: Plugin) -> None:
+            stdout.local.target = plugin.stdout_buffer
+            try:
+                plugin.init(redirect_stdout=False)
+            finally:
+                stdout.local.target = None
+
+        ids = {plugin.configuration.id_ for plugin in self.plugins}
+        remaining = list(self.plugins)
+        done: set[str] = set()
+        with contextlib.redirect_stdout(stdout), \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix='plugin-import') as executor:
+            while remaining:
+                # every plugin whose dependencies are imported
+                wave = [plugin for plugin in remaining
+                        if all(dependency in done or dependency not in ids
+                               for dependency in plugin.configuration.depends)]
+                if not wave:
+                    error = PluginError('Loader', 'Circular loader.depends between '
+                                                  f'{", ".join(plugin.configuration.id_ for plugin in remaining)}')
+                    if self.roe:
+                        raise error
+                    print(str(error))
+                    wave = remaining
+                # .result() raises the import errors like the sequential import
+                for future in [executor.submit(init, plugin) for plugin in wave]:
+                    future.result()
+                done.update(plugin.configuration.id_ for plugin in wave)
+                remaining = [plugin for plugin in remaining if plugin not in wave]
+
     def load_managers(self):
         if self.plugin_loaded < LoaderState.init_plugins:
             if self.roe:
@@ -208,29 +310,133 @@ class Loader:
                         f'Function "{name}" is already present, enable override ({plugin.configuration.name})')
                 self.exposed[name] = func
 
+        self.compile_events()
+
         all_endpoints = [endpoint for plugin in self.plugins for endpoint in
-                         (list(plugin.manager.endpoints.keys()) + list(plugin.manager.sockets.keys()))]
+                         (list(plugin.manager.endpoints.keys()) + list(plugin.manager.sockets.keys()) +
+                          list(plugin.manager.event_streams.keys()))]
         self.longest_endpoint = len(max(all_endpoints, key=len)) if all_endpoints else 0
 
         all_ids = [plugin.configuration.id_ for plugin in self.plugins]
         self.longest_id = len(max(all_ids, key=len)) if all_ids else 0
 
+    def compile_events(self) -> None:
+        """Builds the event -> handlers table used by .call_id(), run it again if a manager changes its events"""
+        events: dict[str, list[tuple[Plugin, Any]]] = {}
+        observers: dict[str, list[tuple[Plugin, Any]]] = {}
+        for plugin in self.plugins:
+            for event, func in plugin.manager.functions.items():
+                table = observers if event in plugin.manager.observers else events
+                table.setdefault(event, []).append((plugin, func))
+        self.events = events
+        self.observers = observers
+
+    def add_events(self, plugin) -> None:
+        """
+        Adds the events and the exposed functions of a plugin imported after .init_plugins() (a lazy one),
+        the exposed functions already given to the app (get_exposed) stay the same
+        """
+        for name, (func, overrideable) in plugin.manager._exposed.items():
+            if name in self.exposed and not overrideable:
+                raise SyntaxError(
+                    f'Function "{name}" is already present, enable override ({plugin.configuration.id_})')
+            self.exposed[name] = func
+        for event, func in plugin.manager.functions.items():
+            table = self.observers if event in plugin.manager.observers else self.events
+            table.setdefault(event, []).append((plugin, func))
+
     def call_id(self, id_, *args, **kwargs):
+        """
+        Calls the handlers of an event until one returns something,
+        async handlers are run to completion only if no event loop is running, use .call_id_async() there
+        """
         if self.plugin_loaded < LoaderState.loaded_managers:
             if self.roe:
                 raise PluginError('Loader', f'Use .init_plugins() before')
             print(str(PluginError('Loader', f'Use .init_plugins() before')))
             return
-        for plugin in self.plugins:
+        if (observers := self.observers.get(id_)) is not None:
+            self.__observe(observers, args, kwargs)
+        handlers = self.events.get(id_)
+        if handlers is None:
+            return
+        for plugin, func in handlers:
             try:
                 with contextlib.redirect_stdout(plugin.stdout_buffer):
-                    retrn = plugin.manager.call_id(id_, *args, **kwargs)
-                    if retrn is not None:
-                        return retrn
+                    retrn = func(*args, **kwargs)
+                    if asyncio.iscoroutine(retrn):
+                        retrn = self.__run_coroutine(plugin, id_, retrn)
             except ManagerError:
-                # if e._type == 'FunctionNotFound':
-                #     pass
                 continue
+            if retrn is not None:
+                return retrn
+
+    async def call_id_async(self, id_, *args, **kwargs):
+        """Same as .call_id(), but async handlers are awaited"""
+        if self.plugin_loaded < LoaderState.loaded_managers:
+            if self.roe:
+                raise PluginError('Loader', f'Use .init_plugins() before')
+            print(str(PluginError('Loader', f'Use .init_plugins() before')))
+            return
+        if (observers := self.observers.get(id_)) is not None:
+            self.__observe(observers, args, kwargs)
+        handlers = self.events.get(id_)
+        if handlers is None:
+            return
+        for plugin, func in handlers:
+            try:
+                with contextlib.redirect_stdout(plugin.stdout_buffer):
+                    retrn = func(*args, **kwargs)
+                if asyncio.iscoroutine(retrn):
+                    # awaited outside the redirect, other requests could print meanwhile
+                    retrn = await retrn
+            except ManagerError:
+                continue
+            if retrn is not None:
+                return retrn
+
+    def __run_coroutine(self, plugin: Plugin, id_: str, coroutine) -> Any:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        self.__track(plugin, asyncio.ensure_future(coroutine))
+        if (plugin.configuration.id_, id_) in self.__async_call_warned:
+            return
+        self.__async_call_warned.add((plugin.configuration.id_, id_))
+        print(str(PluginError('Loader', f'Async handler of {plugin.configuration.id_} for "{id_}" called with '
+                                        f'.call_id() inside an event loop, its return value is ignored')))
+
+    def __observe(self, observers: list[tuple[Plugin, Any]], args: tuple, kwargs: dict) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for plugin, func in observers:
+            if loop is None:
+                # nothing to run them on, called in place
+                try:
+                    with contextlib.redirect_stdout(plugin.stdout_buffer):
+                        retrn = func(*args, **kwargs)
+                        if asyncio.iscoroutine(retrn):
+                            asyncio.run(retrn)
+                except Exception as e:
+                    print(str(PluginError('Observer', f'{plugin.configuration.id_}: {e!r}')))
+            elif asyncio.iscoroutinefunction(func):
+                self.__track(plugin, asyncio.ensure_future(func(*args, **kwargs)))
+            else:
+                # the output of sync observers is not prefixed, they run in another thread
+                context = contextvars.copy_context()
+                self.__track(plugin, loop.run_in_executor(None, partial(context.run, func, *args, **kwargs)))
+
+    def __track(self, plugin: Plugin, future: asyncio.Future) -> None:
+        def done(_future: asyncio.Future):
+            self.background_tasks.discard(_future)
+            if not _future.cancelled() and (e := _future.exception()) is not None:
+                print(str(PluginError('Observer', f'{plugin.configuration.id_}: {e!r}')))
+
+        self.background_tasks.add(future)
+        future.add_done_callback(done)
 
     def get_exposed(self, function: str):
         if self.plugin_loaded < LoaderState.loaded_managers:
@@ -271,10 +477,12 @@ class Loader:
             for endpoint in plugin.manager.endpoints:
                 new_function = general.create_endpoint_function(plugin, endpoint, self, error_handlers)
                 doc = plugin.manager.endpoints[endpoint]['func'].__doc__ or 'No docs included'
+                cache = plugin.manager.endpoints[endpoint]['cache']
+                cache_info = f'ttl {cache.ttl}s, vary: {', '.join(cache.vary) or '-'}' if cache is not None else 'disabled'
                 doc = doc.replace('\n', '\n         ')
                 print(f'Adding endpoint       : {FC.DARK_YELLOW}{endpoint: <{self.longest_endpoint + 3}}{OPS.RESET} | '
                       f'{plugin.configuration.id_: <{self.longest_id + 3}} | {new_function.__name__}\n'
-                      f' - lru cache enabled: {str(plugin.manager.endpoints[endpoint]['lru-cache']).lower()}\n'
+                      f' - response cache: {cache_info}\n'
                       f' - docs: {doc}')
                 app.route(endpoint, methods=methods)(new_function)
 
@@ -296,3 +504,82 @@ class Loader:
 
             with contextlib.redirect_stdout(plugin.stdout_buffer):
                 plugin.manager.functions.get('plugin.loading.post-sockets', lambda: None)()
+
+    def load_event_streams(self, app: Quart) -> None:
+        for plugin in self.plugins:
+            for endpoint in plugin.manager.event_streams:
+                new_function = general.create_sse_function(plugin, endpoint)
+                doc = plugin.manager.event_streams[endpoint].__doc__ or 'No docs included'
+                doc = doc.replace('\n', '\n         ')
+                print(f'Adding endpoint       : {FC.DARK_YELLOW}{endpoint: <{self.longest_endpoint + 3}}{OPS.RESET} | '
+                      f'{plugin.configuration.id_: <{self.longest_id + 3}} | {new_function.__name__}\n - docs: {doc}')
+                app.route(endpoint, methods=['GET'])(new_function)
+
+    def load_middlewares(self, app: Quart) -> None:
+        """
+        Compiles the middlewares of every plugin into a list per url rule of the app,
+        call it after every route has been added
+        """
+        middlewares = sorted(
+            ((plugin, middleware) for plugin in self.plugins for middleware in plugin.manager.middlewares),
+            key=lambda x: -x[1]['priority']
+        )
+        if not middlewares:
+            return
+
+        for rule in app.url_map.iter_rules():
+            if rule.websocket:
+                continue
+            # the part of the rule known before matching
+            static_part = rule.rule.split('<', 1)[0]
+            before, after = [], []
+            for plugin, middleware in middlewares:
+                prefix = middleware['prefix']
+                if '<' not in rule.rule:
+                    if not path_in_prefix(rule.rule, prefix):
+                        continue
+                    check = None
+                elif static_part.startswith(prefix.rstrip('/') + '/'):
+                    # every path of the rule is below the prefix
+                    check = None
+                elif prefix.startswith(static_part) or static_part == prefix.rstrip('/'):
+                    # decided on the path of each request
+                    check = prefix
+                else:
+                    continue
+                (after if middleware['after'] else before).append((plugin, middleware['func'], check))
+            if not (before or after):
+                continue
+            self.middlewares[rule.rule] = (before, after)
+            print(f'Adding middlewares    : {FC.DARK_YELLOW}{rule.rule: <{self.longest_endpoint + 3}}{OPS.RESET} | '
+                  f'before: {len(before)}, after: {len(after)}')
+
+        app.before_request(self.__run_before_middlewares)
+        app.after_request(self.__run_after_middlewares)
+
+    async def __run_before_middlewares(self):
+        if request.url_rule is None or (chain := self.middlewares.get(request.url_rule.rule)) is None:
+            return
+        for plugin, func, prefix in chain[0]:
+            if prefix is not None and not path_in_prefix(request.path, prefix):
+                continue
+            with contextlib.redirect_stdout(plugin.stdout_buffer):
+                retrn = func(request)
+            if asyncio.iscoroutine(retrn):
+                retrn = await retrn
+            if retrn is not None:
+                return retrn
+
+    async def __run_after_middlewares(self, response: Response) -> Response:
+        if request.url_rule is None or (chain := self.middlewares.get(request.url_rule.rule)) is None:
+            return response
+        for plugin, func, prefix in chain[1]:
+            if prefix is not None and not path_in_prefix(request.path, prefix):
+                continue
+            with contextlib.redirect_stdout(plugin.stdout_buffer):
+                retrn = func(request, response)
+            if asyncio.iscoroutine(retrn):
+                retrn = await retrn
+            if retrn is not None:
+                response = retrn
+        return response
@@ -1,5 +1,10 @@
 import io
-from utils import Importer
+import importlib.util
+import threading
+import secrets
+from hashlib import shake_128
+import asyncio
+from functools import partial
 from typing import Union, Any, Optional, Type
 import os
 import sys
@@ -8,7 +13,9 @@ from pathlib import Path
 from types import ModuleType
 from colors import *
 
-from plugin_manager import Manager
+from quart import Quart, abort
+import general
+from plugin_manager import Manager, ManagerError
 
 
 CWD = os.getcwd()
@@ -23,10 +30,19 @@ SCHEMA = {
     'loader': {
         'required-version': float,
         'preferred-version': float,
+        # imported on the first request to one of the declared routes, sockets or event streams
+        '?lazy': bool,
+        '?routes': [str],
+        '?sockets': [str],
+        '?event-streams': [str],
     },
 }
 
 
+# manifest cache kind of the validated manifests, changes with the schema
+SCHEMA_KIND = 'v2-manifest-' + shake_128(repr(SCHEMA).encode()).hexdigest(4)
+
+
 class PrefixedStringIO(io.StringIO):
     def __init__(self, prefix, *args, **kwargs):
         self.prefix = prefix
@@ -52,6 +68,10 @@ class Plugin:
 
         self.__config: Plugin.Configuration = None
         self.__prefix_io: PrefixedStringIO = None
+        self.__manager: Manager = None
+        self.__lock = threading.Lock()
+        # the import shared by the concurrent first requests
+        self.__loading: asyncio.Future = None
 
     class PluginError(Exception):
         pass
@@ -151,6 +171,10 @@ class Plugin:
         def __getitem__(self, item) -> Any:
             return self.__base_data[item]
 
+        @property
+        def id_(self) -> str:
+            return self.__base_data['plugin']['id']
+
         def __repr__(self) -> str:
             return repr(self.__base_data)
 
@@ -162,10 +186,13 @@ class Plugin:
         Loads the configuration of the plugin
         :return:
         """
-        with open(os.path.join(self.__directory, 'plugin.yml'), 'r') as file:
-            self.__config: Plugin.Configuration = Plugin.Configuration(yaml.safe_load(file))
+        # the schema check is cached with the file, until the file or SCHEMA changes
+        data, valid = general.load_yaml(os.path.join(self.__directory, 'plugin.yml'),
+                                        lambda data_: (data_, Plugin.Configuration(data_).verify_schema(SCHEMA)),
+                                        kind=SCHEMA_KIND)
+        self.__config: Plugin.Configuration = Plugin.Configuration(data)
 
-        if not self.__config.verify_schema(SCHEMA):
+        if not valid:
             raise Plugin.PluginError('Configuration invalid schema')
 
         self.__prefix_io: PrefixedStringIO = PrefixedStringIO(
@@ -178,15 +205,161 @@ class Plugin:
                 f'version: {self.__config.get('version', 'N/A')}, '
                 f'required loader: {self.__config['loader']['required-version']})')
 
-    def load(self) -> None:
-        importer = Importer(self.__main_file)
-        if self.__config['plugin'].get('inject-manager'):
-            print(f'Injecting manager in {str(self)}')
-            raise NotImplementedError()
+    @property
+    def configuration(self) -> 'Plugin.Configuration':
+        return self.__config
 
-        self.__module: ModuleType = importer.load()
+    @property
+    def stdout_buffer(self) -> PrefixedStringIO:
+        return self.__prefix_io
+
+    @property
+    def loaded(self) -> bool:
+        return self.__module is not None
+
+    @property
+    def lazy(self) -> bool:
+        return bool(self.__config['loader'].get('lazy', False))
+
+    def load(self) -> None:
+        """Imports the main file, only once even if called by several threads"""
+        with self.__lock:
+            if self.__module is not None:
+                return
+            if self.__config['plugin'].get('inject-manager'):
+                print(f'Injecting manager in {str(self)}')
+                raise NotImplementedError()
+
+            name = os.path.basename(self.__main_file).rsplit('.', 1)[0]
+            spec = importlib.util.spec_from_file_location(name, self.__main_file)
+            module = importlib.util.module_from_spec(spec)
+            # prefixed prints without redirecting sys.stdout, the import can run in a thread
+            module.print = partial(print, file=self.__prefix_io)
+            spec.loader.exec_module(module)
+            self.__module: ModuleType = module
+
+    async def load_async(self) -> None:
+        """Imports the main file in a thread, the concurrent callers wait for the same import"""
+        if self.__module is not None:
+            return
+        if self.__loading is None:
+            self.__loading = asyncio.get_running_loop().run_in_executor(None, self.load)
+        try:
+            await asyncio.shield(self.__loading)
+        except Exception:
+            # the next request tries again
+            self.__loading = None
+            raise
 
     def get_manager(self) -> Manager:
+        """The manager of the module, imported if needed"""
+        if self.__manager is not None:
+            return self.__manager
+        self.load()
+        manager = getattr(self.__module, 'manager', None)
+        if not isinstance(manager, Manager):
+            for value in self.__module.__dict__.values():
+                if isinstance(value, Manager):
+                    manager = value
+                    break
+            else:
+                raise Plugin.PluginError(f'{self.__config.id_} : Manager Not Found')
+        self.__manager = manager
+        return manager
+
+    @property
+    def manager(self) -> Manager:
+        return self.get_manager()
+
+
+class Loader:
+    def __init__(self, plugin_directory: str = 'plugins', raise_on_error: bool = False):
+        """
+        Loads the lazy plugins (loader.lazy in plugin.yml), their routes, sockets and event streams are
+        registered from the manifest and the module is imported on the first request to one of them.
+        Once imported, their events and exposed functions are added to the events loader,
+        middlewares are refused. The other plugins are left to the eager v1 loader.
+        """
+        self.directory = plugin_directory
+        self.roe = raise_on_error
+        self.plugins: list[Plugin] = []
+        # set by main.py, given to the managers once imported
+        self.server_information: general.ServerInformation = None
+        self.events_loader = None
+
+    def load_plugins(self) -> None:
+        for directory in os.listdir(self.directory):
+            path = os.path.join(self.directory, directory)
+            if not os.path.exists(os.path.join(path, 'plugin.yml')):
+                continue
+            if not (general.load_yaml(os.path.join(path, 'plugin.yml')) or {}).get('loader', {}).get('lazy', False):
+                continue
+            plugin = Plugin(path)
+            try:
+                plugin.init()
+            except Plugin.PluginError as e:
+                if self.roe:
+                    raise
+                print(f'Plugin<{directory}> {e}')
+                continue
+            self.plugins.append(plugin)
+
+    async def __manager(self, plugin: Plugin) -> Manager:
+        if not plugin.loaded:
+            await plugin.load_async()
+        if plugin.manager.loader is None:
+            if plugin.manager.middlewares:
+                # compiled per url rule at startup, before the plugin is imported
+                raise Plugin.PluginError(f'{plugin.configuration.id_} : A lazy plugin can\'t have middlewares, '
+                                         f'set loader.lazy to false')
+            print(f'Loaded lazy plugin {FC.LIGHT_MAGENTA}{plugin.configuration.id_}{OPS.RESET}')
+            plugin.manager.SERVER_INFORMATION = self.server_information
+            plugin.manager.loader = self.events_loader
+            # its handlers get the events from now on, server.start has already been sent
+            self.events_loader.add_events(plugin)
+            try:
+                plugin.manager.call_id('plugin.loaded')
+            except ManagerError:
+                pass
+        return plugin.manager
+
+    def __lazy_view(self, plugin: Plugin, endpoint: str, kind: str, create):
+        """A view importing the plugin on its first call, then built once by create(plugin, endpoint)"""
+        view = None
+
+        async def lazy_view(*args, **kwargs):
+            nonlocal view
+            if view is None:
+                manager = await self.__manager(plugin)
+                declared = {'route': manager.endpoints, 'socket': manager.sockets,
+                            'event-stream': manager.event_streams}[kind]
+                if endpoint not in declared:
+                    print(f'Plugin<{plugin.configuration.id_}> declares the {kind} "{endpoint}" '
+                          f'but doesn\'t define it')
+                    abort(404)
+                view = create(plugin, endpoint)
+            return await view(*args, **kwargs)
+
+        lazy_view.__name__ = f'lazy_{secrets.token_hex(4)}'
+        return lazy_view
+
+    def register(self, app: Quart, methods: list[str], error_handlers: list[int]) -> None:
+        """Adds the declared routes, sockets and event streams without importing the plugins"""
+        for plugin in self.plugins:
+            loader_config = plugin.configuration['loader']
+            for endpoint in loader_config.get('routes', []):
+                app.route(endpoint, methods=methods)(self.__lazy_view(
+                    plugin, endpoint, 'route',
+                    lambda plugin_, endpoint_: general.create_endpoint_function(
+                        plugin_, endpoint_, self.events_loader, error_handlers)))
+            for endpoint in loader_config.get('sockets', []):
+                app.websocket(endpoint)(self.__lazy_view(plugin, endpoint, 'socket', general.create_socket_function))
+            for endpoint in loader_config.get('event-streams', []):
+                app.route(endpoint, methods=['GET'])(self.__lazy_view(
+                    plugin, endpoint, 'event-stream', general.create_sse_function))
+            print(f'Registered lazy plugin: {FC.LIGHT_MAGENTA}{plugin.configuration.id_}{OPS.RESET} '
+                  f'({len(loader_config.get("routes", []))} routes, {len(loader_config.get("sockets", []))} sockets, '
+                  f'{len(loader_config.get("event-streams", []))} event streams)')
 
 
 if __name__ == '__main__':
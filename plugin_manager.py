@@ -6,6 +6,11 @@ import inspect
 from typing import Callable, Any
 
 import general
+from response_cache import ResponseCache
+from request_body import SPOOL_THRESHOLD
+import shared_store
+import websocket_hub
+import event_stream
 
 warnings.simplefilter('once', DeprecationWarning)
 
@@ -76,8 +81,13 @@ class Manager:
     def __init__(self):
         from plugin_loader.v1 import Loader
         self._functions = {}
+        self._observers = set()
         self._endpoints = {}
         self._sockets = {}
+        self._socket_options = {}
+        self._event_streams = {}
+        self._event_stream_options = {}
+        self._middlewares = []
         self._exposed = {}
         self.SERVER_INFORMATION: general.ServerInformation = general.ServerInformation({})
         self.loader: Loader = None
@@ -100,7 +110,27 @@ class Manager:
         return run
 
 
-    def websocket(self, endpoint: str):
+    def websocket(self,
+                  endpoint: str,
+                  send_queue_size: int = 64,
+                  send_queue_bytes: int = None,
+                  slow_consumer: str = 'drop',
+                  max_connections: int = None,
+                  max_message_size: int = None,
+                  idle_timeout: float = None):
+        """
+        Links an async function to a websocket endpoint, it's called with ws (a general.WSWrapper).
+        The limits are per worker, None means no limit.
+        :param endpoint: Url rule
+        :param send_queue_size: Messages waiting to be sent to a client, ws.send waits while it's full
+        :param send_queue_bytes: Bytes waiting to be sent to a client, ws.send waits while they are over it
+        :param slow_consumer: When the queue of a client is full, publish/broadcast 'drop' the message
+                              or 'disconnect' the client
+        :param max_connections: Open connections, the handshake of the others is refused
+        :param max_message_size: Received messages larger than this (in bytes or characters) close the connection,
+                                 ws.receive raises websocket_hub.MessageTooLarge
+        :param idle_timeout: Seconds without a received message after which the connection is closed
+        """
         def decorator(func):
             # shit
             # if asyncio.iscoroutinefunction(func):
@@ -113,7 +143,43 @@ class Manager:
             if endpoint in self._sockets:
                 raise SyntaxError(f'Endpoint "{endpoint}" is already linked to a function '
                                   f'({self._sockets[endpoint].__name__})')
+            if slow_consumer not in ('drop', 'disconnect'):
+                raise SyntaxError(f'Unknown slow consumer policy "{slow_consumer}"')
             self._sockets[endpoint] = func
+            self._socket_options[endpoint] = {
+                'send-queue-size': send_queue_size,
+                'send-queue-bytes': send_queue_bytes,
+                'slow-consumer': slow_consumer,
+                'max-connections': max_connections,
+                'max-message-size': max_message_size,
+                'idle-timeout': idle_timeout
+            }
+
+            return func
+        return decorator
+
+    def sse(self, endpoint: str, channel: str = None, keep_open: bool = True, queue_size: int = 256):
+        """
+        Links an async generator to a server-sent events endpoint, it's called with last_event_id
+        and yields the events of its client (event_stream.Event or the data alone)
+        :param endpoint: Url rule
+        :param channel: Events published to this channel (Manager.sse_publish) are sent to every client,
+                        the endpoint if not given
+        :param keep_open: Keep sending the channel events after the generator ends
+        :param queue_size: Events waiting to be sent to a client, the channel events are dropped past this
+        """
+        def decorator(func):
+            if not inspect.isasyncgenfunction(func):
+                raise SyntaxError(f'Function "{func.__name__}" is not an async generator')
+            if endpoint in self._event_streams:
+                raise SyntaxError(f'Endpoint "{endpoint}" is already linked to a function '
+                                  f'({self._event_streams[endpoint].__name__})')
+            self._event_streams[endpoint] = func
+            self._event_stream_options[endpoint] = {
+                'channel': channel if channel is not None else endpoint,
+                'keep-open': keep_open,
+                'queue-size': queue_size
+            }
 
             return func
         return decorator
@@ -121,26 +187,129 @@ class Manager:
     def route(self,
               endpoint: str,
               enable_cross_origin: bool = False,
-              enable_lru_cache: bool = False):
+              enable_lru_cache: bool = False,
+              cache_ttl: float = None,
+              cache_max_entries: int = 1024,
+              cache_max_bytes: int = 16 * 1024 * 1024,
+              cache_stale_while_revalidate: float = 0.0,
+              cache_vary: tuple[str, ...] = ('query',),
+              max_body_size: int = None,
+              spool_threshold: int = SPOOL_THRESHOLD):
+        """
+        Links a function to an endpoint, it's called with the view arguments and the request
+        and returns (data, return_code) or (data, return_code, headers).
+        data can also be an async iterator, an iterator or a file object, the body is then streamed
+        while it's produced instead of being built in memory (never cached).
+        A function with a "body" parameter gets a RequestBody, to read the request body as it arrives
+        (chunks, multipart parts, spooled to a temporary file) instead of as a whole
+        :param endpoint: Url rule
+        :param enable_cross_origin:
+        :param enable_lru_cache: Legacy, same as cache_ttl=300
+        :param cache_ttl: Seconds the responses of the endpoint are cached for, None disables the cache
+        :param cache_max_entries: Maximum number of cached responses
+        :param cache_max_bytes: Maximum total size of the cached responses
+        :param cache_stale_while_revalidate: Seconds after the ttl in which the stale response is sent
+                                             while it's computed again in the background
+        :param cache_vary: Parts of the request the cache key is made of, besides the view arguments
+                           ('method', 'path', 'query', 'header:<name>', 'cookie:<name>')
+        :param max_body_size: Bytes of request body accepted, a bigger Content-Length is refused with 413
+                              before the function is called, a bigger chunked body while body is read
+        :param spool_threshold: Size after which body.spool() writes to a temporary file instead of memory
+        """
+        if enable_lru_cache and cache_ttl is None:
+            cache_ttl = 300
+
         def decorator(func):
             if endpoint in self._endpoints:
                 raise SyntaxError(f'Endpoint "{endpoint}" is already linked to a function '
-                                  f'({self._endpoints[endpoint].__name__})')
+                                  f'({self._endpoints[endpoint]['func'].__name__})')
             self._endpoints[endpoint] = {
                 'func': func,
                 'cross-origin': enable_cross_origin,
-                'lru-cache': enable_lru_cache
+                'lru-cache': cache_ttl is not None,
+                'cache': ResponseCache(
+                    ttl=cache_ttl,
+                    max_entries=cache_max_entries,
+                    max_bytes=cache_max_bytes,
+                    stale_while_revalidate=cache_stale_while_revalidate,
+                    vary=cache_vary
+                ) if cache_ttl is not None else None,
+                'max-body-size': max_body_size,
+                'spool-threshold': spool_threshold
             }
 
             return func
         return decorator
 
-    def on(self, event: str):
+    @staticmethod
+    def publish(topic: str, message: Any) -> int:
+        """Sends a message to every websocket subscribed to topic, encoded once"""
+        return websocket_hub.hub.publish(topic, message)
+
+    @staticmethod
+    def broadcast(endpoint: str, message: Any) -> int:
+        """Sends a message to every websocket connected to endpoint, encoded once"""
+        return websocket_hub.hub.broadcast(endpoint, message)
+
+    @staticmethod
+    def sse_publish(channel: str, data: Any, event: str = None, id_: str | int = None) -> int:
+        """Sends a server-sent event to every client of channel, formatted once"""
+        return event_stream.broadcaster.publish(channel, data, event=event, id_=id_)
+
+    @staticmethod
+    def websocket_stats() -> dict[str, Any]:
+        """Open connections and queued messages/bytes of this worker, in total and per endpoint"""
+        return websocket_hub.hub.stats()
+
+    @staticmethod
+    def shared(namespace: str) -> shared_store.SharedNamespace:
+        """
+        Key/value store shared by every worker process, with ttl entries and atomic counters.
+        get/set/add/incr/delete block while another worker holds the lock, async code awaits their *_async versions
+        :param namespace: Prefix of the keys, usually the plugin id
+        """
+        return shared_store.SharedNamespace(shared_store.get_store(), namespace)
+
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        """Statistics of the response cache of every cached endpoint"""
+        return {endpoint: data['cache'].stats()
+                for endpoint, data in self._endpoints.items() if data['cache'] is not None}
+
+    def middleware(self, prefix: str = '/', priority: int = 0, after: bool = False):
+        """
+        Adds a function to the request pipeline of the routes under prefix, the function can be async.
+        Before the view it's called with the request, returning something other than None stops the request
+        and sends that as the response. After the view it's called with the request and the response,
+        returning a response replaces it.
+        :param prefix: Path prefix of the routes the middleware runs for, matched on whole segments
+        :param priority: Middlewares with higher priorities run first
+        :param after: Run after the view instead of before
+        """
+        def decorator(func):
+            self._middlewares.append({
+                'func': func,
+                'prefix': prefix,
+                'priority': priority,
+                'after': after
+            })
+
+            return func
+        return decorator
+
+    def on(self, event: str, observer: bool = False):
+        """
+        Links a function to an event, the function can be async
+        :param event: Event id
+        :param observer: The function only observes the event, it runs in the background
+                         and its return value is ignored
+        """
         def decorator(func):
             if event in self._functions:
                 raise SyntaxError(f'Event "{event}" is already linked to a function '
                                   f'({self._functions[event].__name__})')
             self._functions[event] = func
+            if observer:
+                self._observers.add(event)
 
             return func
         return decorator
@@ -196,12 +365,18 @@ class Manager:
         else:
             raise FunctionNotFound('Cannot find the requested id_')
 
-    def call_endpoint(self, endpoint: str, *args, **kwargs) -> tuple[str, int]:
+    def call_endpoint(self, endpoint: str, *args, **kwargs) -> tuple[Any, int] | tuple[Any, int, dict[str, str]]:
         if self._endpoints.get(endpoint) is not None:
             return self._endpoints[endpoint]['func'](*args, **kwargs)
         else:
             raise FunctionNotFound('Cannot find the requested endpoint')
 
+    def event_stream(self, endpoint: str, *args, **kwargs):
+        if self._event_streams.get(endpoint) is not None:
+            return self._event_streams[endpoint](*args, **kwargs)
+        else:
+            raise FunctionNotFound('Cannot find the requested endpoint')
+
     def socket(self, endpoint: str, *args, **kwargs):
         if self._sockets.get(endpoint) is not None:
             return self._sockets[endpoint](*args, **kwargs)
@@ -212,6 +387,10 @@ class Manager:
     def functions(self):
         return self._functions
 
+    @property
+    def observers(self):
+        return self._observers
+
     @property
     def endpoints(self):
         return self._endpoints
@@ -220,6 +399,22 @@ class Manager:
     def sockets(self):
         return self._sockets
 
+    @property
+    def socket_options(self):
+        return self._socket_options
+
+    @property
+    def event_streams(self):
+        return self._event_streams
+
+    @property
+    def event_stream_options(self):
+        return self._event_stream_options
+
+    @property
+    def middlewares(self):
+        return self._middlewares
+
 
 class ManagerV2(Manager):
     def __init__(self):
@@ -0,0 +1,97 @@
+import os
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+
+def make_etag(stat: os.stat_result) -> str:
+    """Strong validator of a file version, built from inode, mtime and size"""
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def encoded_etag(etag: str, encoding: str | None) -> str:
+    """ETag of the same file version sent with a content-encoding"""
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+@lru_cache(maxsize=256)
+def parse_http_date(value: str) -> float | None:
+    """Returns the timestamp of an HTTP-date, None if it is malformed"""
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+    if date.tzinfo is None:
+        return None
+    return date.timestamp()
+
+
+@lru_cache(maxsize=256)
+def parse_etags(value: str) -> tuple[tuple[bool, str], ...]:
+    """Splits an If-Match/If-None-Match value into (weak, opaque-tag) pairs, '*' is kept as it is"""
+    tags = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        weak = part.startswith('W/')
+        if weak:
+            part = part[2:]
+        tags.append((weak, part))
+    return tuple(tags)
+
+
+def etag_matches(value: str, etag: str, weak_comparison: bool) -> bool:
+    for weak, tag in parse_etags(value):
+        if tag == '*':
+            return True
+        if weak and not weak_comparison:
+            continue
+        # the encoded variants ("...-gzip") are other representations, they never match
+        if tag == etag:
+            return True
+    return False
+
+
+def evaluate_preconditions(method: str, headers, etag: str, mtime: float) -> int | None:
+    """
+    Evaluates the conditional headers in the order given by RFC 9110 (section 13.2.2)
+    :param method: Request method
+    :param headers: Request headers
+    :param etag: Strong ETag of the representation that would be sent, with its encoding
+    :param mtime: Modification time of the file
+    :return: 304 or 412 if the request should stop there, else None
+    """
+    last_modified = int(mtime)
+
+    if (if_match := headers.get('If-Match')) is not None:
+        if not etag_matches(if_match, etag, weak_comparison=False):
+            return 412
+    elif (if_unmodified_since := headers.get('If-Unmodified-Since')) is not None:
+        date = parse_http_date(if_unmodified_since)
+        if date is not None and last_modified > date:
+            return 412
+
+    if (if_none_match := headers.get('If-None-Match')) is not None:
+        if etag_matches(if_none_match, etag, weak_comparison=True):
+            return 304 if method in ('GET', 'HEAD') else 412
+    elif method in ('GET', 'HEAD') and (if_modified_since := headers.get('If-Modified-Since')) is not None:
+        date = parse_http_date(if_modified_since)
+        if date is not None and last_modified <= date:
+            return 304
+
+    return None
+
+
+def if_range_matches(headers, etag: str, mtime: float) -> bool:
+    """True if the Range header should be honored"""
+    if_range = headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # a weak validator never matches
+        return if_range == etag
+    date = parse_http_date(if_range)
+    return date is not None and int(mtime) == date
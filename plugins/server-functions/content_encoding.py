@@ -0,0 +1,270 @@
+import os
+import gzip
+import asyncio
+import mimetypes
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable
+from conditional import encoded_etag, make_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# encoding -> (compress function, sibling file suffix), in order of preference.
+# Fast levels, a miss is compressed while the client waits
+ENCODERS: dict[str, tuple[Callable[[bytes], bytes], str]] = {}
+# encoding -> compress function, the best levels, for the siblings written ahead of time
+PRECOMPRESSORS: dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    ENCODERS['br'] = (lambda data: brotli.compress(data, quality=5), '.br')
+    PRECOMPRESSORS['br'] = lambda data: brotli.compress(data, quality=11)
+if zstandard is not None:
+    ENCODERS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data), '.zst')
+    PRECOMPRESSORS['zstd'] = lambda data: zstandard.ZstdCompressor(level=19).compress(data)
+ENCODERS['gzip'] = (lambda data: gzip.compress(data, compresslevel=6, mtime=0), '.gz')
+PRECOMPRESSORS['gzip'] = lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+
+COMPRESSIBLE_TYPES: tuple[str, ...] = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/manifest+json',
+    'application/wasm',
+    'image/svg+xml',
+)
+
+
+def is_compressible(mimetype: str) -> bool:
+    return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def is_sibling(path: str) -> bool:
+    """True for a compressed sibling (index.html.gz, ...) next to its source, it's never served as it is"""
+    for _, suffix in ENCODERS.values():
+        if path.endswith(suffix):
+            return os.path.isfile(path[:-len(suffix)])
+    return False
+
+
+@lru_cache(maxsize=256)
+def parse_accept_encoding(header: str) -> tuple[str, ...]:
+    """Returns the encodings of ENCODERS the client accepts, in order of preference"""
+    accepted: dict[str, float] = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name] = quality
+
+    wildcard = accepted.get('*')
+    result = []
+    for encoding in ENCODERS:
+        quality = accepted.get(encoding, wildcard)
+        if quality is not None and quality > 0:
+            result.append((quality, encoding))
+    # stable sort keeps the server preference between equal qualities
+    result.sort(key=lambda x: -x[0])
+    return tuple(encoding for _, encoding in result)
+
+
+class Encoded:
+    """A file compressed with an encoding, sibling is the stat of the precompressed file it was read from"""
+    __slots__ = ('data', 'sibling')
+
+    def __init__(self, data: bytes | None, sibling: os.stat_result = None):
+        self.data = data
+        self.sibling = sibling
+
+
+class CompressionCache:
+    def __init__(self,
+                 max_bytes: int = 32 * 1024 * 1024,
+                 max_entries: int = 4096,
+                 max_file_size: int = 4 * 1024 * 1024,
+                 min_size: int = 256):
+        """
+        Bounded LRU cache of compressed file contents, keyed by path, mtime, size and encoding.
+        Sibling files (index.html.gz, index.html.br, ...) newer than the source are used as they are,
+        otherwise the file is compressed once per version.
+        :param max_bytes: Total budget of compressed contents
+        :param max_entries: Maximum number of entries, the files not worth compressing included
+        :param max_file_size: Files bigger than this are never compressed
+        :param min_size: Files smaller than this are never compressed
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.min_size = min_size
+
+        # a None data means the encoding does not make the file smaller
+        self.__entries: OrderedDict[tuple[str, float, int, str], Encoded] = OrderedDict()
+        self.__bytes = 0
+        # key -> compression running in the executor
+        self.__pending: dict[tuple[str, float, int, str], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    async def get(self,
+                  path: str,
+                  size: int,
+                  mtime: float,
+                  encoding: str,
+                  etag: str,
+                  data: bytes = None) -> tuple[bytes, str] | None:
+        """
+        Returns the file encoded with the given encoding and its ETag, None if it's not worth it.
+        A miss is compressed in the default executor, once for the requests that wait for the same key
+        :param etag: ETag of the source file, the one of a compressed copy derives from it
+        :param data: Contents of the file if they are already in memory
+        """
+        if size < self.min_size or size > self.max_file_size or encoding not in ENCODERS:
+            return None
+        key = (path, mtime, size, encoding)
+        if (encoded := self.__entries.get(key)) is not None and not self.__sibling_changed(path, encoding, encoded):
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        elif key in self.__pending:
+            self.hits += 1
+            encoded = await asyncio.shield(self.__pending[key])
+        else:
+            encoded = await self.__load(key, data)
+        if encoded.data is None:
+            return None
+        if encoded.sibling is not None:
+            # edited on its own, it's its own version
+            etag = make_etag(encoded.sibling)
+        return encoded.data, encoded_etag(etag, encoding)
+
+    async def __load(self, key: tuple[str, float, int, str], data: bytes | None) -> Encoded:
+        self.misses += 1
+        future = asyncio.get_running_loop().run_in_executor(None, self.__compress, *key, data)
+        self.__pending[key] = future
+        try:
+            encoded = await asyncio.shield(future)
+        finally:
+            self.__pending.pop(key, None)
+
+        if (old := self.__entries.pop(key, None)) is not None:
+            self.__bytes -= len(old.data or b'')
+        self.__entries[key] = encoded
+        self.__bytes += len(encoded.data or b'')
+        while self.__entries and (self.__bytes > self.max_bytes or len(self.__entries) > self.max_entries):
+            _, old = self.__entries.popitem(last=False)
+            self.__bytes -= len(old.data or b'')
+            self.evictions += 1
+        return encoded
+
+    @staticmethod
+    def __sibling_changed(path: str, encoding: str, encoded: Encoded) -> bool:
+        if encoded.sibling is None:
+            return False
+        try:
+            sibling = os.stat(path + ENCODERS[encoding][1])
+        except OSError:
+            return True
+        return (sibling.st_ino, sibling.st_mtime_ns, sibling.st_size) != \
+            (encoded.sibling.st_ino, encoded.sibling.st_mtime_ns, encoded.sibling.st_size)
+
+    @classmethod
+    def __compress(cls, path: str, mtime: float, size: int, encoding: str, data: bytes | None) -> Encoded:
+        sibling, compressed = cls.__read_sibling(path, mtime, encoding)
+        if compressed is None:
+            if data is None:
+                try:
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                except OSError:
+                    return Encoded(None)
+            compressed = ENCODERS[encoding][0](data)
+        if len(compressed) >= size:
+            return Encoded(None)
+        return Encoded(compressed, sibling)
+
+    def invalidate(self) -> None:
+        self.__entries.clear()
+        self.__bytes = 0
+
+    @staticmethod
+    def __read_sibling(path: str, mtime: float, encoding: str) -> tuple[os.stat_result | None, bytes | None]:
+        sibling = path + ENCODERS[encoding][1]
+        try:
+            with open(sibling, 'rb') as file:
+                sibling_stat = os.fstat(file.fileno())
+                if sibling_stat.st_mtime < mtime:
+                    # outdated
+                    return None, None
+                return sibling_stat, file.read()
+        except OSError:
+            return None, None
+
+
+def precompress_directory(root: str,
+                          encodings: tuple[str, ...] = None,
+                          min_size: int = 256) -> int:
+    """
+    Writes a sibling compressed file, at the best level, for every compressible file under root
+    that doesn't have an up-to-date one already. The static handler never serves the siblings themselves
+    :return: Number of files written
+    """
+    if encodings is None:
+        encodings = tuple(ENCODERS)
+    suffixes = tuple(suffix for _, suffix in ENCODERS.values())
+    written = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(suffixes):
+                continue
+            path = os.path.join(directory, name)
+            mimetype = mimetypes.guess_type(path)[0]
+            if mimetype is None or not is_compressible(mimetype):
+                continue
+            try:
+                source_stat = os.stat(path)
+                if source_stat.st_size < min_size:
+                    continue
+                data = None
+                for encoding in encodings:
+                    compress, suffix = PRECOMPRESSORS[encoding], ENCODERS[encoding][1]
+                    sibling = path + suffix
+                    if os.path.exists(sibling) and os.stat(sibling).st_mtime >= source_stat.st_mtime:
+                        continue
+                    if data is None:
+                        with open(path, 'rb') as file:
+                            data = file.read()
+                    compressed = compress(data)
+                    if len(compressed) >= len(data):
+                        continue
+                    with open(sibling, 'wb') as file:
+                        file.write(compressed)
+                    written += 1
+            except OSError:
+                continue
+    return written
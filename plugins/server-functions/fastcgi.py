@@ -0,0 +1,556 @@
+from typing import AsyncIterable, AsyncIterator
+import os
+import sys
+import signal
+import socket
+import struct
+import asyncio
+import tempfile
+import subprocess
+import ctypes
+from types import TracebackType
+
+from quart.wrappers.response import ResponseBody
+
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+
+FCGI_REQUEST_COMPLETE = 0
+
+# version, type, request id, content length, padding length, reserved
+RECORD_HEADER = struct.Struct('>BBHHBx')
+# role, flags, reserved
+BEGIN_REQUEST_BODY = struct.Struct('>HB5x')
+# application status, protocol status, reserved
+END_REQUEST_BODY = struct.Struct('>IB3x')
+
+MAX_CONTENT = 65535
+# stdout chunks queued for a response before the connection stops reading
+RESPONSE_QUEUE_SIZE = 64
+
+
+class FastCGIError(Exception):
+    pass
+
+
+def encode_record(type_: int, request_id: int, content: bytes = b'') -> bytes:
+    """One or more records of type_, content is split in records of at most 65535 bytes"""
+    records = []
+    view = memoryview(content)
+    while True:
+        part = view[:MAX_CONTENT]
+        view = view[MAX_CONTENT:]
+        # the content is padded to a multiple of 8
+        padding = -len(part) % 8
+        records.append(RECORD_HEADER.pack(FCGI_VERSION_1, type_, request_id, len(part), padding))
+        records.append(part.tobytes())
+        records.append(b'\x00' * padding)
+        if not view:
+            break
+    return b''.join(records)
+
+
+def encode_length(length: int) -> bytes:
+    if length < 128:
+        return bytes((length,))
+    return struct.pack('>I', length | 0x80000000)
+
+
+def encode_params(params: dict[str, str]) -> bytes:
+    """Name-value pairs of a FCGI_PARAMS or FCGI_GET_VALUES record"""
+    data = []
+    for name, value in params.items():
+        name, value = name.encode(), str(value).encode()
+        data.append(encode_length(len(name)))
+        data.append(encode_length(len(value)))
+        data.append(name)
+        data.append(value)
+    return b''.join(data)
+
+
+def decode_params(data: bytes) -> dict[str, str]:
+    params = {}
+    position = 0
+    while position < len(data):
+        lengths = []
+        for _ in range(2):
+            if data[position] & 0x80:
+                lengths.append(struct.unpack_from('>I', data, position)[0] & 0x7fffffff)
+                position += 4
+            else:
+                lengths.append(data[position])
+                position += 1
+        name = data[position:position + lengths[0]]
+        position += lengths[0]
+        value = data[position:position + lengths[1]]
+        position += lengths[1]
+        params[name.decode()] = value.decode()
+    return params
+
+
+def parse_cgi_headers(head: bytes) -> tuple[int, list[tuple[str, str]]]:
+    """
+    Status and headers of a CGI response, Status: sets the status code,
+    a Location without it is a redirect
+    """
+    status = None
+    headers = []
+    for line in head.decode('latin-1').splitlines():
+        if not line.strip():
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise FastCGIError(f'Invalid header line "{line}"')
+        name, value = name.strip(), value.strip()
+        if name.lower() == 'status':
+            try:
+                status = int(value.split(' ', 1)[0])
+            except ValueError:
+                raise FastCGIError(f'Invalid status "{value}"')
+            continue
+        headers.append((name, value))
+    if status is None:
+        status = 302 if any(name.lower() == 'location' for name, _ in headers) else 200
+    return status, headers
+
+
+def find_header_end(data: bytes) -> tuple[int, int]:
+    """(end of the headers, start of the body), (-1, -1) if the headers are not complete"""
+    candidates = [(index, index + len(separator))
+                  for separator in (b'\r\n\r\n', b'\n\n')
+                  if (index := data.find(separator)) != -1]
+    return min(candidates) if candidates else (-1, -1)
+
+
+class FastCGIRequest:
+    def __init__(self, request_id: int):
+        """A request of a connection, the stdout records are queued until the response body reads them"""
+        self.id_ = request_id
+        self.stdout: asyncio.Queue = asyncio.Queue(maxsize=RESPONSE_QUEUE_SIZE)
+        self.stderr = bytearray()
+        self.ended: asyncio.Future = asyncio.get_running_loop().create_future()
+        # the client left, the rest of the output is dropped
+        self.aborted = False
+
+    async def feed(self, data: bytes | None) -> None:
+        if not self.aborted:
+            await self.stdout.put(data)
+
+    def end(self, error: BaseException = None, app_status: int = 0) -> None:
+        if self.ended.done():
+            return
+        if error is not None:
+            self.ended.set_exception(error)
+            # consumed by the reader of the body if any, not an unretrieved exception
+            self.ended.exception()
+        else:
+            self.ended.set_result(app_status)
+        if not self.aborted:
+            try:
+                self.stdout.put_nowait(None)
+            except asyncio.QueueFull:
+                # the reader is behind, it will see .ended once the queue is drained
+                pass
+
+    async def read(self) -> bytes | None:
+        """The next stdout chunk, None at the end of the output"""
+        if self.ended.done() and self.stdout.empty():
+            return None
+        return await self.stdout.get()
+
+
+class FastCGIConnection:
+    def __init__(self, address: str):
+        """
+        A connection to a FastCGI application, its requests are multiplexed
+        if the application says it can (FCGI_MPXS_CONNS), php-fpm and php-cgi handle one at a time
+        :param address: Path of a unix socket or host:port
+        """
+        self.address = address
+        self.max_requests = 1
+        self.requests: dict[int, FastCGIRequest] = {}
+        self.closed = False
+        self.__reader: asyncio.StreamReader = None
+        self.__writer: asyncio.StreamWriter = None
+        self.__task: asyncio.Task = None
+        self.__values: asyncio.Future = None
+        self.__next_id = 1
+
+    async def connect(self, timeout: float = 5.0) -> 'FastCGIConnection':
+        host, sep, port = self.address.rpartition(':')
+        if sep and port.isdigit() and os.sep not in self.address:
+            connection = asyncio.open_connection(host, int(port))
+        else:
+            connection = asyncio.open_unix_connection(self.address)
+        self.__reader, self.__writer = await asyncio.wait_for(connection, timeout)
+        self.__task = asyncio.ensure_future(self.__read_records())
+        # how many requests the application takes on a connection
+        self.__values = asyncio.get_running_loop().create_future()
+        self.__writer.write(encode_record(FCGI_GET_VALUES, 0, encode_params(
+            {'FCGI_MAX_REQS': '', 'FCGI_MPXS_CONNS': ''})))
+        try:
+            values = await asyncio.wait_for(self.__values, min(timeout, 1.0))
+        except asyncio.TimeoutError:
+            # not every application answers, one request at a time is always fine
+            values = {}
+        if self.closed:
+            # accepted by a process that was exiting
+            raise FastCGIError(f'Connection to {self.address} closed')
+        if values.get('FCGI_MPXS_CONNS') == '1':
+            try:
+                self.max_requests = max(1, int(values.get('FCGI_MAX_REQS') or 1))
+            except ValueError:
+                pass
+        return self
+
+    @property
+    def available(self) -> bool:
+        return not self.closed and len(self.requests) < self.max_requests
+
+    def __new_id(self) -> int:
+        while self.__next_id in self.requests or self.__next_id == 0:
+            self.__next_id = (self.__next_id + 1) & 0xffff
+        request_id = self.__next_id
+        self.__next_id = (self.__next_id + 1) & 0xffff
+        return request_id
+
+    async def __read_records(self) -> None:
+        error = None
+        try:
+            while True:
+                header = await self.__reader.readexactly(RECORD_HEADER.size)
+                _, type_, request_id, length, padding = RECORD_HEADER.unpack(header)
+                content = await self.__reader.readexactly(length + padding)
+                content = content[:length]
+                if request_id == 0:
+                    if type_ == FCGI_GET_VALUES_RESULT and self.__values is not None and not self.__values.done():
+                        self.__values.set_result(decode_params(content))
+                    continue
+                if (current := self.requests.get(request_id)) is None:
+                    continue
+                if type_ == FCGI_STDOUT:
+                    if content:
+                        await current.feed(content)
+                elif type_ == FCGI_STDERR:
+                    current.stderr += content
+                elif type_ == FCGI_END_REQUEST:
+                    app_status, protocol_status = END_REQUEST_BODY.unpack(content)
+                    self.requests.pop(request_id, None)
+                    if protocol_status != FCGI_REQUEST_COMPLETE:
+                        current.end(FastCGIError(f'Request rejected by {self.address} ({protocol_status})'))
+                    else:
+                        current.end(app_status=app_status)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = FastCGIError(f'Connection to {self.address} lost: {e!r}')
+        except asyncio.CancelledError:
+            error = FastCGIError(f'Connection to {self.address} closed')
+        finally:
+            self.closed = True
+            for current in self.requests.values():
+                current.end(error or FastCGIError(f'Connection to {self.address} closed'))
+            self.requests.clear()
+            if self.__values is not None and not self.__values.done():
+                self.__values.set_result({})
+            self.__writer.close()
+
+    async def request(self, params: dict[str, str], body: AsyncIterable[bytes] | bytes = b'') -> FastCGIRequest:
+        """Starts a responder request, the params and the body (stdin) are sent before returning"""
+        if not self.available:
+            raise FastCGIError(f'No request available on {self.address}')
+        current = FastCGIRequest(self.__new_id())
+        self.requests[current.id_] = current
+        try:
+            self.__writer.write(encode_record(FCGI_BEGIN_REQUEST, current.id_,
+                                              BEGIN_REQUEST_BODY.pack(FCGI_RESPONDER, FCGI_KEEP_CONN)))
+            if params:
+                self.__writer.write(encode_record(FCGI_PARAMS, current.id_, encode_params(params)))
+            self.__writer.write(encode_record(FCGI_PARAMS, current.id_))
+            if isinstance(body, (bytes, bytearray)):
+                if body:
+                    self.__writer.write(encode_record(FCGI_STDIN, current.id_, bytes(body)))
+            else:
+                async for chunk in body:
+                    if chunk:
+                        self.__writer.write(encode_record(FCGI_STDIN, current.id_, chunk))
+                        await self.__writer.drain()
+            self.__writer.write(encode_record(FCGI_STDIN, current.id_))
+            await self.__writer.drain()
+        except (OSError, RuntimeError) as e:
+            self.requests.pop(current.id_, None)
+            self.close()
+            raise FastCGIError(f'Request to {self.address} failed: {e!r}') from e
+        return current
+
+    def abort(self, current: FastCGIRequest) -> None:
+        """Drops the rest of the output, the request is released when the application ends it"""
+        current.aborted = True
+        # unblocks the reader if it waits on a full queue
+        while not current.stdout.empty():
+            current.stdout.get_nowait()
+        if not current.ended.done() and not self.closed:
+            self.__writer.write(encode_record(FCGI_ABORT_REQUEST, current.id_))
+
+    def close(self) -> None:
+        if self.__task is not None and not self.__task.done():
+            self.__task.cancel()
+        elif self.__writer is not None:
+            self.__writer.close()
+        self.closed = True
+
+
+class FastCGIBody(ResponseBody):
+    def __init__(self, connection: FastCGIConnection, current: FastCGIRequest, first: bytes = b''):
+        """Streams the output of a request after its headers"""
+        self.connection = connection
+        self.current = current
+        self.first = first
+
+    async def __aenter__(self) -> 'FastCGIBody':
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        if not self.current.ended.done():
+            self.connection.abort(self.current)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.__iterate()
+
+    async def __iterate(self) -> AsyncIterator[bytes]:
+        if self.first:
+            yield self.first
+        while (chunk := await self.current.read()) is not None:
+            yield chunk
+        if (error := self.current.ended.exception()) is not None:
+            # the output was cut, the client must not take it for the whole response
+            print(f'FastCGI response of {self.connection.address} cut: {error}')
+            raise error
+
+
+class FastCGIResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers: list[tuple[str, str]], body: FastCGIBody):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def stderr(self) -> bytes:
+        return bytes(self.body.current.stderr)
+
+
+# prctl option, the signal a process gets when its parent dies
+PR_SET_PDEATHSIG = 1
+
+
+def die_with_parent() -> None:
+    """Linux only, a server worker killed with SIGTERM takes its php-cgi processes with it"""
+    try:
+        ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        pass
+
+
+class Worker:
+    def __init__(self, command: list[str], address: str, env: dict[str, str] = None):
+        """A php-cgi process bound to address, started again if it exits"""
+        self.command = command
+        self.address = address
+        self.env = env
+        self.process: subprocess.Popen = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        if self.running:
+            return
+        if os.sep in self.address and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.process = subprocess.Popen([*self.command, '-b', self.address],
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL,
+                                        stdin=subprocess.DEVNULL,
+                                        env=self.env,
+                                        preexec_fn=die_with_parent if sys.platform == 'linux' else None)
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if os.sep in self.address and os.path.exists(self.address):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+def free_address(directory: str, index: int) -> str:
+    """A unix socket in directory, a local port where there are none"""
+    if hasattr(socket, 'AF_UNIX') and sys.platform != 'win32':
+        return os.path.join(directory, f'php-{index}.sock')
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return f'127.0.0.1:{s.getsockname()[1]}'
+
+
+class FastCGIPool:
+    def __init__(self,
+                 addresses: list[str] = None,
+                 executable: str = None,
+                 workers: int = 4,
+                 max_requests: int = 500,
+                 connect_timeout: float = 5.0,
+                 response_timeout: float = 30.0):
+        """
+        Long-lived connections to FastCGI applications, a request waits for a free one.
+        :param addresses: Sockets of running applications (php-fpm), one connection each
+        :param executable: php-cgi, used when no address is given, workers processes are started on the first request
+        :param max_requests: Requests served by a php-cgi process before it's replaced (PHP_FCGI_MAX_REQUESTS)
+        :param response_timeout: Seconds to wait for the headers of a response
+        """
+        self.executable = executable
+        self.max_requests = max_requests
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self.workers: list[Worker] = []
+        self.directory: str = None
+        if not addresses:
+            if executable is None:
+                raise FastCGIError('An address or the php-cgi executable is needed')
+            self.directory = tempfile.mkdtemp(prefix='pmgs-php-')
+            env = {**os.environ, 'PHP_FCGI_CHILDREN': '0', 'PHP_FCGI_MAX_REQUESTS': str(max_requests)}
+            self.workers = [Worker([executable], free_address(self.directory, index), env=env)
+                            for index in range(workers)]
+            addresses = [worker.address for worker in self.workers]
+        self.addresses = addresses
+        self.connections: list[FastCGIConnection | None] = [None] * len(addresses)
+        self.requests = 0
+        self.failures = 0
+        self.__free: asyncio.Condition = None
+        self.__connecting: set[int] = set()
+
+    async def __connect(self, index: int) -> FastCGIConnection:
+        address = self.addresses[index]
+        worker = self.workers[index] if self.workers else None
+        # a worker that just started needs some time to listen, one that reached max_requests is replaced
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        while True:
+            if worker is not None and not worker.running:
+                worker.start()
+            try:
+                return await FastCGIConnection(address).connect(timeout=self.connect_timeout)
+            except (OSError, asyncio.TimeoutError, FastCGIError) as e:
+                if worker is None or loop.time() > deadline:
+                    raise FastCGIError(f'Could not connect to {address}: {e!r}') from e
+                await asyncio.sleep(0.05)
+
+    async def acquire(self) -> FastCGIConnection:
+        """A connection with a free request slot, connected (and its worker started) if needed"""
+        if self.__free is None:
+            self.__free = asyncio.Condition()
+        async with self.__free:
+            while True:
+                for connection in self.connections:
+                    if connection is not None and connection.available:
+                        # the caller takes the slot before awaiting anything
+                        return connection
+                index = next((index for index, connection in enumerate(self.connections)
+                              if (connection is None or connection.closed) and index not in self.__connecting), None)
+                if index is not None:
+                    self.__connecting.add(index)
+                    break
+                await self.__free.wait()
+        try:
+            connection = self.connections[index] = await self.__connect(index)
+        except FastCGIError:
+            self.failures += 1
+            # someone else may have more luck with another address
+            await self.release()
+            raise
+        finally:
+            self.__connecting.discard(index)
+        return connection
+
+    async def release(self) -> None:
+        if self.__free is not None:
+            async with self.__free:
+                self.__free.notify_all()
+
+    async def request(self, params: dict[str, str], body: AsyncIterable[bytes] | bytes = b'') -> FastCGIResponse:
+        """Sends a request and waits for the headers of its response, the body is streamed"""
+        connection = await self.acquire()
+        self.requests += 1
+        try:
+            current = await connection.request(params, body)
+        except FastCGIError:
+            self.failures += 1
+            await self.release()
+            raise
+        current.ended.add_done_callback(lambda _: asyncio.ensure_future(self.release()))
+
+        head = b''
+        try:
+            while True:
+                chunk = await asyncio.wait_for(current.read(), self.response_timeout)
+                if chunk is None:
+                    # ended before the headers, only the errors can tell why
+                    if current.ended.exception() is not None:
+                        raise current.ended.exception()
+                    end, start = find_header_end(head)
+                    if end == -1:
+                        end = start = len(head)
+                    break
+                head += chunk
+                end, start = find_header_end(head)
+                if end != -1:
+                    break
+            status, headers = parse_cgi_headers(head[:end])
+        except (FastCGIError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            connection.abort(current)
+            if isinstance(e, asyncio.TimeoutError):
+                raise FastCGIError(f'No response from {connection.address} '
+                                   f'in {self.response_timeout}s') from e
+            raise
+        return FastCGIResponse(status, headers, FastCGIBody(connection, current, head[start:]))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'connections': sum(1 for connection in self.connections if connection is not None and not connection.closed),
+            'active': sum(len(connection.requests) for connection in self.connections if connection is not None),
+            'workers': sum(1 for worker in self.workers if worker.running),
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+    def close(self) -> None:
+        """Closes the connections and stops the workers"""
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+        for worker in self.workers:
+            worker.stop()
+        if self.directory is not None:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
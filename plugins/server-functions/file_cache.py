@@ -0,0 +1,131 @@
+import os
+import time
+import mimetypes
+from collections import OrderedDict
+from conditional import make_etag
+
+
+DEFAULT_MIMETYPE = 'application/octet-stream'
+
+
+class CachedFile:
+    """A file kept in memory, together with the stat values used to validate it and sent with it"""
+    __slots__ = ('path', 'data', 'size', 'mtime', 'etag', 'mimetype', 'checked')
+
+    def __init__(self, path: str, data: bytes, file_stat: os.stat_result):
+        self.path = path
+        self.data = data
+        self.size = file_stat.st_size
+        self.mtime = file_stat.st_mtime
+        self.etag = make_etag(file_stat)
+        self.mimetype = mimetypes.guess_type(path)[0] or DEFAULT_MIMETYPE
+        self.checked = time.monotonic()
+
+
+class FileCache:
+    def __init__(self,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 max_file_size: int = 1024 * 1024,
+                 revalidate_after: float = 1.0):
+        """
+        In-memory LRU cache of file contents, bounded by the total size in bytes
+        :param max_bytes: Total budget of cached file contents
+        :param max_file_size: Files bigger than this are never cached
+        :param revalidate_after: Seconds between two stat calls on the same entry,
+                                 an entry is dropped as soon as its mtime or size changes
+        """
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_after = revalidate_after
+
+        self.__entries: OrderedDict[str, CachedFile] = OrderedDict()
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.__entries
+
+    @property
+    def total_bytes(self) -> int:
+        return self.__bytes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def get(self, path: str) -> CachedFile | None:
+        """Returns the cached file if it is still valid, else None"""
+        entry = self.__entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        if now - entry.checked >= self.revalidate_after:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.invalidate(path)
+                self.misses += 1
+                return None
+            if stat.st_mtime != entry.mtime or stat.st_size != entry.size:
+                self.invalidate(path)
+                self.misses += 1
+                return None
+            entry.checked = now
+
+        self.__entries.move_to_end(path)
+        self.hits += 1
+        return entry
+
+    def load(self, path: str, stat: os.stat_result = None) -> CachedFile | None:
+        """Reads the file and stores it, returns None if the file cannot be cached"""
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+        if stat.st_size > self.max_file_size or stat.st_size > self.max_bytes:
+            return None
+
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        # the file changed while reading it
+        if len(data) != stat.st_size:
+            return None
+
+        self.invalidate(path)
+        entry = CachedFile(path, data, stat)
+        self.__entries[path] = entry
+        self.__bytes += entry.size
+        self.__evict()
+        return entry
+
+    def invalidate(self, path: str = None) -> None:
+        """Drops a single path, or the whole cache if no path is given"""
+        if path is None:
+            self.__entries.clear()
+            self.__bytes = 0
+            return
+        entry = self.__entries.pop(path, None)
+        if entry is not None:
+            self.__bytes -= entry.size
+
+    def __evict(self) -> None:
+        while self.__bytes > self.max_bytes and self.__entries:
+            _, entry = self.__entries.popitem(last=False)
+            self.__bytes -= entry.size
+            self.evictions += 1
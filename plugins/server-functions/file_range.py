@@ -0,0 +1,154 @@
+import os
+import asyncio
+import secrets
+from types import TracebackType
+from typing import AsyncIterator
+
+from quart.wrappers.response import ResponseBody
+
+
+MAX_RANGES = 16
+CHUNK_SIZE = 256 * 1024
+
+
+def pread(fd: int, length: int, offset: int) -> bytes:
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    # windows
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def parse_range_header(value: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parses a "bytes=" Range header
+    :param value: Value of the Range header
+    :param size: Size of the file
+    :return: Sorted, non-overlapping (start, end) pairs with end excluded,
+             an empty list if no range can be satisfied,
+             None if the header is malformed and should be ignored
+    """
+    unit, _, ranges_spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    ranges: list[tuple[int, int]] = []
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                # suffix range, the last N bytes
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix == 0:
+                    continue
+                ranges.append((max(size - suffix, 0), size))
+                continue
+            start = int(first)
+            end = int(last) + 1 if last != '' else max(size, start + 1)
+        except ValueError:
+            return None
+        if start < 0 or end <= start:
+            return None
+        if start >= size:
+            # unsatisfiable
+            continue
+        ranges.append((start, min(end, size)))
+
+    if len(ranges) > MAX_RANGES:
+        # too many ranges, send the whole file
+        return None
+
+    ranges.sort()
+    merged: list[tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FileRangeBody(ResponseBody):
+    """
+    Streams one or more byte ranges of a file, the ranges are read with pread
+    in the default executor so at most one chunk is held in memory.
+    With data, the ranges are sliced from the file contents already in memory.
+    With more than one range the body is a multipart/byteranges document.
+    """
+
+    def __init__(self,
+                 path: str,
+                 size: int,
+                 ranges: list[tuple[int, int]],
+                 content_type: str = None,
+                 chunk_size: int = CHUNK_SIZE,
+                 data: bytes = None):
+        self.path = path
+        self.data = data
+        self.size = size
+        self.ranges = ranges
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.boundary = secrets.token_hex(16) if len(ranges) > 1 else None
+        self.__fd: int | None = None
+
+    def __part_header(self, start: int, end: int) -> bytes:
+        return (f'\r\n--{self.boundary}\r\n'
+                f'Content-Type: {self.content_type}\r\n'
+                f'Content-Range: bytes {start}-{end - 1}/{self.size}\r\n\r\n').encode()
+
+    def __closing(self) -> bytes:
+        return f'\r\n--{self.boundary}--\r\n'.encode()
+
+    @property
+    def content_length(self) -> int:
+        length = sum(end - start for start, end in self.ranges)
+        if self.boundary is not None:
+            length += sum(len(self.__part_header(start, end)) for start, end in self.ranges)
+            length += len(self.__closing())
+        return length
+
+    async def __aenter__(self) -> 'FileRangeBody':
+        if self.data is not None:
+            return self
+        self.__fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.__iterate()
+
+    async def __iterate(self) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        for start, end in self.ranges:
+            if self.boundary is not None:
+                yield self.__part_header(start, end)
+            if self.data is not None:
+                yield self.data[start:end]
+                continue
+            offset = start
+            while offset < end:
+                chunk = await loop.run_in_executor(None, pread, self.__fd,
+                                                   min(self.chunk_size, end - offset), offset)
+                if not chunk:
+                    # the file was truncated
+                    return
+                offset += len(chunk)
+                yield chunk
+        if self.boundary is not None:
+            yield self.__closing()
+
+    async def make_conditional(self, begin: int, end: int | None) -> int:
+        # ranges are already resolved by parse_range_header
+        return self.size
@@ -7,21 +7,33 @@ from plugin_manager import Manager
 
 # Gets Nat and Public addresses
 import socket
-import http.client
+import secrets
+import asyncio
 
-# CGI and Custom templates
-# from bs4 import BeautifulSoup
-# import textwrap
+# CGI
 # import io
 # import platform
+from types import SimpleNamespace
 
 from quart import Response, make_response, Request, Quart, request, redirect, send_file, abort
+import shutil
 import subprocess
 from functools import lru_cache
 
 from async_lru import alru_cache
 import general
-from datetime import datetime
+import response_stream
+from datetime import datetime, timezone, timedelta
+from file_cache import FileCache, CachedFile
+from path_cache import PathCache
+from content_encoding import CompressionCache, is_compressible, is_sibling, parse_accept_encoding, precompress_directory
+from conditional import evaluate_preconditions, if_range_matches, make_etag
+from file_range import FileRangeBody, parse_range_header
+from reachability import ResultCache, fetch_public_ip, probe
+from fastcgi import FastCGIError, FastCGIPool
+from script_pool import ScriptError, ScriptPool, ScriptTimeout
+from pmgs_template import TEMPLATE_EXTENSION, TemplateCache, TemplateError, compile_template, describe_error
+import mimetypes
 
 
 BASE_PHP_PATH = os.path.join(os.path.dirname(__file__), 'php')
@@ -34,10 +46,84 @@ upgrade_proc = None
 CACHE_ENABLED = True
 CACHE_TIMEOUT = 300
 
+# in-memory cache of the files in HTML_DIRECTORY
+FILE_CACHE_ENABLED = True
+FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FILE_CACHE_MAX_FILE_SIZE = 1024 * 1024
+FILE_CACHE_REVALIDATE = 1.0
+file_cache = FileCache(max_bytes=FILE_CACHE_MAX_BYTES,
+                       max_file_size=FILE_CACHE_MAX_FILE_SIZE,
+                       revalidate_after=FILE_CACHE_REVALIDATE)
+
+# url path -> resolved file, misses are remembered for PATH_CACHE_NEGATIVE_TTL in a separate, smaller LRU
+PATH_CACHE_MAX_ENTRIES = 8192
+PATH_CACHE_TTL = 1.0
+PATH_CACHE_NEGATIVE_TTL = 5.0
+PATH_CACHE_MAX_NEGATIVE_ENTRIES = 1024
+path_cache: PathCache = None
+
+# gzip (and br/zstd when available), siblings like index.html.gz are preferred
+COMPRESSION_ENABLED = True
+COMPRESSION_CACHE_MAX_BYTES = 32 * 1024 * 1024
+COMPRESSION_CACHE_MAX_ENTRIES = 4096
+COMPRESSION_MAX_FILE_SIZE = 4 * 1024 * 1024
+COMPRESSION_MIN_SIZE = 256
+# writes the compressed siblings of every file in HTML_DIRECTORY on server.start
+PRECOMPRESS_ON_START = False
+compression_cache = CompressionCache(max_bytes=COMPRESSION_CACHE_MAX_BYTES,
+                                     max_entries=COMPRESSION_CACHE_MAX_ENTRIES,
+                                     max_file_size=COMPRESSION_MAX_FILE_SIZE,
+                                     min_size=COMPRESSION_MIN_SIZE)
+
+# public address and reachability, checked in the background once the server listens
+PUBLIC_IP_URL = os.environ.get('PMGS_PUBLIC_IP_URL', 'https://ipv4.icanhazip.com/')
+REACHABILITY_TIMEOUT = 3.0
+REACHABILITY_CACHE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                       '.cache', 'reachability.json')
+REACHABILITY_CACHE_TTL = 3600.0
+# the probe must get this back, not just any answer from that address
+REACHABILITY_TOKEN = secrets.token_hex(16)
+reachability_cache = ResultCache(REACHABILITY_CACHE_FILE, ttl=REACHABILITY_CACHE_TTL)
+reachability_task: asyncio.Task = None
+
+# .php files go to long-lived FastCGI workers: the php-fpm sockets given (comma separated)
+# or PHP_WORKERS php-cgi processes started on the first request, each worker has its own
+PHP_ENABLED = True
+PHP_FASTCGI_ADDRESSES = [address.strip() for address in os.environ.get('PMGS_PHP_FASTCGI', '').split(',')
+                         if address.strip()]
+PHP_WORKERS = 4
+# a php-cgi process is replaced after this many requests
+PHP_MAX_REQUESTS = 500
+PHP_RESPONSE_TIMEOUT = 30.0
+php_pool: FastCGIPool = None
+
+# .py pages run in warm interpreters of PYTHON_EXECUTABLE, each worker has its own
+PYTHON_SCRIPTS_ENABLED = True
+PYTHON_WORKERS = 4
+PYTHON_MAX_REQUESTS = 1000
+# an interpreter above this resident memory is replaced after its script
+PYTHON_MAX_MEMORY = 256 * 1024 * 1024
+PYTHON_TIMEOUT = 30.0
+# imported when an interpreter starts
+PYTHON_PRELOAD = ['json', 'html', 'datetime', 'urllib.parse']
+script_pool: ScriptPool = None
+
+# .pmgs files are HTML with <python> blocks, compiled once and run in this process
+TEMPLATES_ENABLED = True
+TEMPLATE_CACHE_MAX_ENTRIES = 256
+template_cache = TemplateCache(max_entries=TEMPLATE_CACHE_MAX_ENTRIES)
+
 
 @manager.on('server.start')
 def on_start():
     global upgrade_proc
+    if manager.SERVER_INFORMATION.get('WORKER_ID', 0) != 0:
+        # done once, by the first worker
+        return
+    if PRECOMPRESS_ON_START:
+        written = precompress_directory(manager.SERVER_INFORMATION.HTML_DIRECTORY, min_size=COMPRESSION_MIN_SIZE)
+        print(f'Precompressed {written} files')
+
     if manager.SERVER_INFORMATION.SERVER.lower() == 'hypercorn':
         # integrated
         return
@@ -65,6 +151,10 @@ def on_start():
 @manager.on('server.end')
 def on_exit():
     global upgrade_proc
+    if php_pool is not None:
+        php_pool.close()
+    if script_pool is not None:
+        script_pool.close()
     if upgrade_proc:
         try:
             upgrade_proc.kill()
@@ -72,23 +162,36 @@ def on_exit():
             pass
 
 
+def get_path_cache() -> PathCache:
+    global path_cache
+    if path_cache is None:
+        path_cache = PathCache(root=manager.SERVER_INFORMATION.HTML_DIRECTORY,
+                               index_file=manager.SERVER_INFORMATION.INDEX_FILE,
+                               max_entries=PATH_CACHE_MAX_ENTRIES,
+                               ttl=PATH_CACHE_TTL,
+                               negative_ttl=PATH_CACHE_NEGATIVE_TTL,
+                               max_negative_entries=PATH_CACHE_MAX_NEGATIVE_ENTRIES)
+    return path_cache
+
+
 @manager.expose(name='get_public_ip')
-@lru_cache()
-def get_public_ip() -> str:
-    conn = http.client.HTTPSConnection('ipv4.icanhazip.com')
-    conn.request('GET', '/')
-    public_addr = conn.getresponse().read().decode('utf-8').strip()
-    del conn
-    return public_addr
+def get_public_ip() -> str | None:
+    """The public address of the last check (cached on disk), None if unknown, never blocks"""
+    result = reachability_cache.read(manager.SERVER_INFORMATION.PORT)
+    return result['public_ip'] if result is not None else None
 
 
 @manager.expose(name='get_local_ip')
 @lru_cache()
 def get_local_ip() -> str:
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.connect(('8.8.8.8', 80))
-        nat_addr = s.getsockname()[0]
-    del s
+    # no packet is sent, it only picks the interface of the default route
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('8.8.8.8', 80))
+            nat_addr = s.getsockname()[0]
+        del s
+    except OSError:
+        nat_addr = '127.0.0.1'
     return nat_addr
 
 
@@ -121,115 +224,211 @@ def parse_http_headers(header_string):
 # return Response(response.read(len(data)), response.status, dict(headers))
 
 
-# @manager.on('server.request._cgi')
-# def cgi_request(raw_path: str, f: str, request: Request) -> Response | tuple[str, int] | None:
-#     global PHP_EXECUTABLE, PYTHON_EXECUTABLE
-#     if f.rsplit('.', 1)[1] in ('php', 'py', 'pyw', 'py3'):
-#         env = {'SCRIPT_URL': request.path,
-#                'SCRIPT_URI': request.base_url,
-#                'HTTP_HOST': request.host,
-#                'HTTP_CONNECTION': request.headers['Connection'],
-#                'HTTP_DNT': request.headers['DNT'],
-#                'HTTP_UPGRADE_INSECURE_REQUESTS': request.headers['Upgrade-Insecure-Requests'],
-#                'HTTP_USER_AGENT': request.user_agent.string,
-#                'HTTP_ACCEPT': request.headers['Accept'],
-#                'HTTP_ACCEPT_ENCODING': request.headers['Accept-Encoding'],
-#                'HTTP_ACCEPT_LANGUAGE': request.headers['Accept-Language'],
-#                'PATH': '',
-#                'SERVER_SIGNATURE': f'PMgS (Python {platform.python_version()}) on {platform.platform(aliased=True)}',
-#                'SERVER_SOFTWARE': 'PMgS',
-#                'SERVER_NAME': get_public_ip(),
-#                'SERVER_ADDR': get_public_ip(),
-#                'SERVER_PORT': str(manager.SERVER_INFORMATION['PORT']),
-#                'REMOTE_ADDR': request.remote_addr,
-#                'DOCUMENT_ROOT': manager.SERVER_INFORMATION['HTML_DIRECTORY'],
-#                'REQUEST_SCHEME': request.scheme,
-#                # CONTEXT_PREFIX
-#                'CONTEXT_DOCUMENT_ROOT': manager.SERVER_INFORMATION['HTML_DIRECTORY'],
-#                # SERVER_ADMIN
-#                'SCRIPT_FILENAME': f,
-#                # REMOTE_PORT
-#                'GATEWAY_INTERFACE': 'CGI/1.1',
-#                'SERVER_PROTOCOL': 'HTTP/1.1',
-#                'REQUEST_METHOD': request.method,
-#                'QUERY_STRING': request.query_string.decode(),
-#                'REQUEST_URI': request.full_path,
-#                'SCRIPT_NAME': raw_path,
-#                'PHP_SELF': raw_path,
-#                # what
-#                'REDIRECT_STATUS': '0'
-#                }
-#         match f.rsplit('.', 1)[1]:
-#             case 'php':
-#                 if not os.path.exists(PHP_EXECUTABLE):
-#                     return
-#                 proc = subprocess.run([PHP_EXECUTABLE, '--no-header', f],
-#                                       stdout=subprocess.PIPE,
-#                                       stderr=subprocess.PIPE,
-#                                       stdin=subprocess.DEVNULL,
-#                                       cwd=os.path.dirname(f),
-#                                       env=env)
-#                 # goddamn header
-#                 return proc.stdout.decode()[64:], 200
-#             case 'py' | 'pyw' | 'py3':
-#                 if not os.path.exists(PYTHON_EXECUTABLE):
-#                     return
-#                 proc = subprocess.run([PYTHON_EXECUTABLE, f],
-#                                       stdout=subprocess.PIPE,
-#                                       stderr=subprocess.PIPE,
-#                                       stdin=subprocess.DEVNULL,
-#                                       cwd=os.path.dirname(f),
-#                                       env=env)
-#                 return proc.stdout.decode(), 200
-#     return '', 500
-
-manager.on('server.request._cgi')(lambda x: ('', 500))
-
-# @manager.expose
-# def parse_pmgs_template(file: str = None) -> str:
-#     # file as file_data
-#     if file is None:
-#         return ''
-#
-#     # lxml
-#     bs_file = BeautifulSoup(file, features='html.parser')
-#     for p_tag in bs_file.find_all('python'):
-#         python_code = textwrap.dedent(str(p_tag)[8:-9])
-#         proc = subprocess.run([sys.executable, '-c', python_code],
-#                               stdout=subprocess.PIPE,
-#                               stderr=subprocess.PIPE,
-#                               stdin=subprocess.DEVNULL)
-#         p_tag.replace_with(proc.stdout.decode())
-#     return str(bs_file)
+def cgi_environment(raw_path: str, f: str, request: Request) -> dict[str, str]:
+    html_directory = manager.SERVER_INFORMATION.HTML_DIRECTORY
+    env = {'GATEWAY_INTERFACE': 'CGI/1.1',
+           'SERVER_SOFTWARE': 'PMgS',
+           'SERVER_PROTOCOL': f'HTTP/{request.http_version}',
+           'SERVER_NAME': request.host.rsplit(':', 1)[0] if not request.host.endswith(']') else request.host,
+           'SERVER_PORT': str(manager.SERVER_INFORMATION.PORT),
+           'REQUEST_SCHEME': request.scheme,
+           'HTTPS': 'on' if request.scheme == 'https' else '',
+           'REQUEST_METHOD': request.method,
+           'REQUEST_URI': request.full_path if request.query_string else request.path,
+           'QUERY_STRING': request.query_string.decode('latin-1'),
+           'SCRIPT_URL': request.path,
+           'SCRIPT_URI': request.base_url,
+           'SCRIPT_NAME': f'/{raw_path}',
+           'PHP_SELF': f'/{raw_path}',
+           'SCRIPT_FILENAME': f,
+           'DOCUMENT_ROOT': html_directory,
+           'CONTEXT_DOCUMENT_ROOT': html_directory,
+           'REMOTE_ADDR': request.remote_addr or '',
+           # php-cgi refuses to run a script that was not given by the server (cgi.force_redirect)
+           'REDIRECT_STATUS': '200'}
+    if (content_type := request.headers.get('Content-Type')) is not None:
+        env['CONTENT_TYPE'] = content_type
+    if request.content_length is not None:
+        env['CONTENT_LENGTH'] = str(request.content_length)
+    for name, value in request.headers.items():
+        name = name.upper().replace('-', '_')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH', 'PROXY'):
+            # Proxy: would end up as HTTP_PROXY (httpoxy)
+            continue
+        key = f'HTTP_{name}'
+        env[key] = f'{env[key]}, {value}' if key in env else value
+    return env
+
+
+def get_php_pool() -> FastCGIPool | None:
+    """The FastCGI pool of this worker, None if there is neither php-fpm nor php-cgi"""
+    global php_pool
+    if php_pool is None:
+        executable = PHP_EXECUTABLE if os.path.exists(PHP_EXECUTABLE) else shutil.which('php-cgi')
+        if not PHP_FASTCGI_ADDRESSES and executable is None:
+            return None
+        php_pool = FastCGIPool(addresses=PHP_FASTCGI_ADDRESSES,
+                               executable=executable,
+                               workers=PHP_WORKERS,
+                               max_requests=PHP_MAX_REQUESTS,
+                               response_timeout=PHP_RESPONSE_TIMEOUT)
+    return php_pool
+
+
+def get_script_pool() -> ScriptPool:
+    global script_pool
+    if script_pool is None:
+        script_pool = ScriptPool(python=PYTHON_EXECUTABLE,
+                                 workers=PYTHON_WORKERS,
+                                 max_requests=PYTHON_MAX_REQUESTS,
+                                 max_memory=PYTHON_MAX_MEMORY,
+                                 timeout=PYTHON_TIMEOUT,
+                                 preload=PYTHON_PRELOAD)
+    return script_pool
+
+
+async def php_request(raw_path: str, f: str, request: Request) -> Response | tuple[str, int]:
+    pool = get_php_pool()
+    if pool is None:
+        return '', 500
+    if request.max_content_length is not None and (request.content_length or 0) > request.max_content_length:
+        # refused before php gets any of it
+        abort(413)
+    env = cgi_environment(raw_path, f, request)
+    if request.content_length is not None:
+        body = request.body
+    else:
+        # chunked, php needs CONTENT_LENGTH
+        body = await request.get_data(cache=False)
+        env['CONTENT_LENGTH'] = str(len(body))
+    try:
+        result = await pool.request(env, body)
+    except FastCGIError as e:
+        print(f'PHP request for {raw_path} failed: {e}')
+        return '', 502
+    if result.stderr:
+        print(result.stderr.decode(errors='replace').rstrip())
+    response = Response(result.body, result.status, headers=result.headers)
+    # the output of a script is streamed, as long as it takes
+    response.timeout = None
+    return response
+
+
+async def python_request(raw_path: str, f: str, request: Request) -> Response | tuple[str, int]:
+    env = cgi_environment(raw_path, f, request)
+    body = await request.get_data(cache=False)
+    env['CONTENT_LENGTH'] = str(len(body))
+    try:
+        result = await get_script_pool().run(f, env, body)
+    except ScriptTimeout:
+        print(f'{raw_path} took more than {PYTHON_TIMEOUT}s')
+        return '', 504
+    except ScriptError as e:
+        print(f'{raw_path} failed: {e}')
+        return '', 502
+    response = Response(result.body, result.status, headers=result.headers)
+    # PYTHON_TIMEOUT already limits the script
+    response.timeout = None
+    return response
+
+
+@manager.on('server.request._cgi')
+async def cgi_request(raw_path: str, f: str, request: Request) -> Response | tuple[str, int] | None:
+    match f.rsplit('.', 1)[-1].lower():
+        case 'php' if PHP_ENABLED:
+            return await php_request(raw_path, f, request)
+        case 'py' | 'pyw' | 'py3' if PYTHON_SCRIPTS_ENABLED:
+            return await python_request(raw_path, f, request)
+
+
+@lru_cache(maxsize=64)
+def compile_template_source(source: str):
+    return compile_template(source, '<parse_pmgs_template>')
+
+
+@manager.expose
+def parse_pmgs_template(file: str = None, **context) -> str:
+    """Renders the content of a template, the compiled templates of the last sources are reused"""
+    if file is None:
+        return ''
+    return b''.join(compile_template_source(file).render(context)).decode()
+
+
+def template_context(request: Request) -> dict:
+    """What the blocks of a template know about the request, taken before the response is streamed"""
+    return {'request': SimpleNamespace(method=request.method,
+                                       path=request.path,
+                                       full_path=request.full_path,
+                                       args=request.args.to_dict(),
+                                       headers=dict(request.headers),
+                                       cookies=dict(request.cookies),
+                                       remote_addr=request.remote_addr),
+            'server': manager.SERVER_INFORMATION}
+
+
+def template_response(f: str, request: Request) -> Response | tuple[str, int]:
+    try:
+        template = template_cache.get(f)
+    except FileNotFoundError:
+        abort(404)
+    except TemplateError as e:
+        print(f'Template error: {e}')
+        return '', 500
+    context = template_context(request)
+
+    def render():
+        try:
+            yield from template.render(context)
+        except Exception as e:
+            # the headers are gone already, the page ends here
+            print(f'Template error: {describe_error(e, f)}')
 
-manager.expose(name='parse_pmgs_template')(lambda file=None: '')
+    # the blocks run in the default executor, a slow one (or time.sleep) doesn't block the server
+    return Response(response_stream.iterate(render()), 200, mimetype='text/html')
 
 
 @manager.expose(name='check_public_ip')
-@lru_cache()
-def check_public_ip(ip: str, port: int) -> bool:
-    process = subprocess.run([sys.executable, '-c',
-                              f'import sys\n'
-                              f'sys.path = {sys.path}\n'
-                              f'from ip_checker import run\n'
-                              f'from threading import Thread\n'
-                              f'import requests\n'
-                              f'def is_server_up(server_url, timeout=3, max_retries=2):\n'
-                              f'    for _ in range(max_retries):\n'
-                              f'        try:\n'
-                              f'            response = requests.get(server_url, timeout=timeout)\n'
-                              f'            return response.status_code == 200\n'
-                              f'        except (requests.ConnectionError, requests.Timeout):\n'
-                              f'            continue\n'
-                              f'    return False\n'
-                              f'Thread(target=run, args=("0.0.0.0", {port}), daemon=True).start()\n'
-                              f'if is_server_up("http://{ip}:{port}"):\n'
-                              f'    exit(0)\n'
-                              f'exit(1)'],
-                             stdout=subprocess.DEVNULL,
-                             stderr=subprocess.STDOUT,
-                             stdin=subprocess.DEVNULL)
-    return process.returncode == 0
+def check_public_ip(ip: str, port: int) -> bool | None:
+    """Reachability of the last check (cached on disk), None if unknown, never blocks"""
+    result = reachability_cache.read(port)
+    if result is None or result['public_ip'] != ip:
+        return None
+    return result['reachable']
+
+
+@manager.route('/.pmgs/reachability/<token>')
+async def reachability_probe(request: Request, token: str) -> tuple[str, int]:
+    """Answers the reachability probe"""
+    if token != REACHABILITY_TOKEN:
+        return '', 404
+    return REACHABILITY_TOKEN, 200
+
+
+async def check_reachability() -> None:
+    port = manager.SERVER_INFORMATION.PORT
+    public_ip = await fetch_public_ip(PUBLIC_IP_URL, timeout=REACHABILITY_TIMEOUT)
+    if public_ip is None:
+        print('Public IP could not be found')
+        reachability_cache.write(None, port, False)
+        return
+    protocol = 'https' if manager.SERVER_INFORMATION.SSL_ENABLED and port == 443 else 'http'
+    link_port = f':{port}' if port not in (80, 443) else ''
+    reachable = await probe(f'{protocol}://{public_ip}{link_port}/.pmgs/reachability/{REACHABILITY_TOKEN}',
+                            REACHABILITY_TOKEN, timeout=REACHABILITY_TIMEOUT)
+    reachability_cache.write(public_ip, port, reachable)
+    if reachable:
+        print(f'Public IP is reachable: {protocol}://{public_ip}{link_port}/')
+    else:
+        print(f'Public IP ({public_ip}) is not reachable')
+
+
+@manager.expose
+async def start_reachability_check() -> None:
+    """before_serving handler, the checks run in the background so the server listens right away"""
+    global reachability_task
+    if manager.SERVER_INFORMATION.get('WORKER_ID', 0) != 0:
+        return
+    reachability_task = asyncio.ensure_future(check_reachability())
 
 
 @manager.expose
@@ -239,34 +438,109 @@ async def check_scheme():
         return redirect(url, code=301)
 
 
+def set_cache_headers(response: Response, mimetype: str, mtime: float, etag: str) -> Response:
+    if COMPRESSION_ENABLED and is_compressible(mimetype):
+        response.vary.add('Accept-Encoding')
+    response.headers['ETag'] = etag
+    response.accept_ranges = 'bytes'
+    response.last_modified = mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_TIMEOUT
+    response.expires = datetime.now(timezone.utc) + timedelta(seconds=CACHE_TIMEOUT)
+    return response
+
+
+def file_response(data: bytes, mimetype: str, mtime: float, etag: str, encoding: str = None) -> Response:
+    response = Response(data, 200, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return set_cache_headers(response, mimetype, mtime, etag)
+
+
+def file_range_response(path: str,
+                        size: int,
+                        mimetype: str,
+                        mtime: float,
+                        etag: str,
+                        ranges: list[tuple[int, int]],
+                        partial: bool = True,
+                        data: bytes = None) -> Response:
+    body = FileRangeBody(path, size, ranges, content_type=mimetype, data=data)
+    response = Response(body, 206 if partial else 200, mimetype=mimetype)
+    if body.boundary is not None:
+        response.content_type = f'multipart/byteranges; boundary={body.boundary}'
+    elif partial:
+        response.headers['Content-Range'] = f'bytes {ranges[0][0]}-{ranges[0][1] - 1}/{size}'
+    response.content_length = body.content_length
+    # big downloads must not be cut by RESPONSE_TIMEOUT
+    response.timeout = None
+    return set_cache_headers(response, mimetype, mtime, etag)
+
+
 @manager.expose
 async def http_index(file: str):
-    retrn = manager.loader.call_id('server.request', request)
+    retrn = await manager.loader.call_id_async('server.request', request)
     if retrn is not None:
         return retrn
     del retrn
-    f = general.resolve_directory_path(JOIN(manager.SERVER_INFORMATION.HTML_DIRECTORY, *file.split('/')))
-    if general.is_in_directory(manager.SERVER_INFORMATION.HTML_DIRECTORY, f):
-        if os.path.isdir(f) and os.path.exists(JOIN(f, manager.SERVER_INFORMATION.INDEX_FILE)):
-            # with open(JOIN(f, INDEX_FILE), 'r') as file:
-            #     return LOADER.run('parse_pmgs_template', file=file.read()), 200
-            return await send_file(f, cache_timeout=CACHE_TIMEOUT), 200
-        elif os.path.exists(f):
-            if (modified_client := request.headers.get('If-Modified-Since')) and CACHE_ENABLED:
-                client_time = datetime.strptime(modified_client, '%a, %d %b %Y %H:%M:%S %Z')
-                if client_time <= datetime.fromtimestamp(os.path.getmtime(f)):
-                    return '', 304
-            # Check if the file size is greater than 1MB
-            if os.path.getsize(f) > 1000000:
-                return await send_file(f, conditional=True), 206
-            # retrn = LOADER.call_id('server.request._cgi', file, f, request)
-            # if retrn is not None:
-            #     return retrn
-            # del retrn
-            # with open(f, 'r') as file:
-            #     return LOADER.run('parse_pmgs_template', file=file.read()), 200
-            return await send_file(f, cache_timeout=CACHE_TIMEOUT), 200
-    abort(404)
+    entry = get_path_cache().lookup(file)
+    if entry is None or is_sibling(entry.path):
+        # the compressed siblings are sent with their Content-Encoding, for their source
+        abort(404)
+    f = entry.path
+    retrn = await manager.loader.call_id_async('server.request._cgi', file, f, request)
+    if retrn is not None:
+        return retrn
+    del retrn
+    if TEMPLATES_ENABLED and f.endswith(TEMPLATE_EXTENSION):
+        return template_response(f, request)
+    cached: CachedFile | None = None
+    if FILE_CACHE_ENABLED:
+        cached = file_cache.get(f) or file_cache.load(f)
+    # the validators come from the same stat as the bytes that are sent,
+    # the path cache entry can be older than the file for its ttl
+    if cached is not None:
+        size, mtime, file_etag = cached.size, cached.mtime, cached.etag
+    else:
+        try:
+            file_stat = os.stat(f)
+        except FileNotFoundError:
+            # removed while its resolution was still cached
+            get_path_cache().invalidate(file)
+            abort(404)
+        size, mtime, file_etag = file_stat.st_size, file_stat.st_mtime, make_etag(file_stat)
+    mimetype = cached.mimetype if cached is not None else (mimetypes.guess_type(f)[0] or 'application/octet-stream')
+    ranged = 'Range' in request.headers and if_range_matches(request.headers, file_etag, mtime)
+    # negotiated first, the validators are the ones of the variant that would be sent
+    encoding: str | None = None
+    data: bytes | None = None
+    etag = file_etag
+    if COMPRESSION_ENABLED and not ranged and is_compressible(mimetype):
+        for accepted in parse_accept_encoding(request.headers.get('Accept-Encoding', '')):
+            encoded = await compression_cache.get(f, size, mtime, accepted, file_etag,
+                                                  data=cached.data if cached is not None else None)
+            if encoded is not None:
+                encoding = accepted
+                data, etag = encoded
+                break
+    if CACHE_ENABLED and (status := evaluate_preconditions(request.method, request.headers,
+                                                           etag, mtime)) is not None:
+        if status == 304:
+            return set_cache_headers(Response(status=304), mimetype, mtime, etag)
+        return Response(status=status)
+    if data is not None:
+        return file_response(data, mimetype, mtime, etag, encoding=encoding)
+    if ranged and (ranges := parse_range_header(request.headers['Range'], size)) is not None:
+        if not ranges:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        return file_range_response(f, size, mimetype, mtime, file_etag, ranges,
+                                   data=cached.data if cached is not None else None)
+    if cached is not None:
+        return file_response(cached.data, mimetype, mtime, file_etag)
+    # too big for the file cache, streamed from disk
+    return file_range_response(f, size, mimetype, mtime, file_etag, [(0, size)], partial=False)
 
 
 @manager.expose
@@ -0,0 +1,120 @@
+import os
+import stat
+import time
+from collections import OrderedDict
+from conditional import make_etag
+
+
+class PathEntry:
+    """A resolved file inside the root directory"""
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'checked')
+
+    def __init__(self, path: str, path_stat: os.stat_result):
+        self.path = path
+        self.size = path_stat.st_size
+        self.mtime = path_stat.st_mtime
+        self.etag = make_etag(path_stat)
+        self.checked = time.monotonic()
+
+
+class PathCache:
+    def __init__(self,
+                 root: str,
+                 index_file: str,
+                 max_entries: int = 8192,
+                 ttl: float = 1.0,
+                 negative_ttl: float = 5.0,
+                 max_negative_entries: int = 1024):
+        """
+        Maps an url path to the file it resolves to, with its size, mtime and ETag.
+        Paths that resolve outside the root or to nothing are remembered as misses, in their own
+        smaller LRU: a scan of unique missing paths doesn't evict the files being served.
+        :param root: Directory the files are served from
+        :param index_file: File served when the path is a directory
+        :param max_entries: Maximum number of remembered files
+        :param ttl: Seconds a resolved file is trusted without a new stat
+        :param negative_ttl: Seconds a miss is remembered
+        :param max_negative_entries: Maximum number of remembered misses
+        """
+        self.root = os.path.realpath(root)
+        self.__root_prefix = os.path.join(self.root, '')
+        self.index_file = index_file
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_entries = max_negative_entries
+
+        # url path -> (entry, expiration)
+        self.__entries: OrderedDict[str, tuple[PathEntry, float]] = OrderedDict()
+        # url path -> expiration of the miss
+        self.__negative: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries) + len(self.__negative)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries),
+            'negative-entries': len(self.__negative),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def is_in_root(self, path: str) -> bool:
+        return path == self.root or path.startswith(self.__root_prefix)
+
+    def lookup(self, url_path: str) -> PathEntry | None:
+        """Returns the file an url path resolves to, None if it cannot be served"""
+        now = time.monotonic()
+        cached = self.__entries.get(url_path)
+        if cached is not None and cached[1] > now:
+            self.__entries.move_to_end(url_path)
+            self.hits += 1
+            return cached[0]
+        expires = self.__negative.get(url_path)
+        if expires is not None and expires > now:
+            self.__negative.move_to_end(url_path)
+            self.hits += 1
+            return None
+
+        self.misses += 1
+        entry = self.__resolve(url_path)
+        if entry is not None:
+            self.__negative.pop(url_path, None)
+            self.__entries[url_path] = (entry, now + self.ttl)
+            self.__entries.move_to_end(url_path)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        else:
+            self.__entries.pop(url_path, None)
+            self.__negative[url_path] = now + self.negative_ttl
+            self.__negative.move_to_end(url_path)
+            while len(self.__negative) > self.max_negative_entries:
+                self.__negative.popitem(last=False)
+        return entry
+
+    def invalidate(self, url_path: str = None) -> None:
+        """Forgets a single url path, or every path if none is given"""
+        if url_path is None:
+            self.__entries.clear()
+            self.__negative.clear()
+        else:
+            self.__entries.pop(url_path, None)
+            self.__negative.pop(url_path, None)
+
+    def __resolve(self, url_path: str) -> PathEntry | None:
+        path = os.path.realpath(os.path.join(self.root, *url_path.split('/')))
+        if not self.is_in_root(path):
+            return None
+        try:
+            path_stat = os.stat(path)
+            if stat.S_ISDIR(path_stat.st_mode):
+                path = os.path.join(path, self.index_file)
+                path_stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        if not stat.S_ISREG(path_stat.st_mode):
+            return None
+        return PathEntry(path, path_stat)
@@ -0,0 +1,154 @@
+from typing import Any, Iterator
+import os
+import re
+import html
+import builtins
+import textwrap
+import traceback
+from types import CodeType
+from collections import OrderedDict
+
+TEMPLATE_EXTENSION = '.pmgs'
+
+BLOCK = re.compile(r'<python>(.*?)</python>', re.S | re.I)
+
+# what the blocks can use, they run in the server process: templates are trusted files, this is not a sandbox
+SAFE_BUILTINS = (
+    'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'bytes', 'callable', 'chr', 'dict', 'divmod', 'enumerate',
+    'filter', 'float', 'format', 'frozenset', 'getattr', 'hasattr', 'hash', 'hex', 'int', 'isinstance',
+    'issubclass', 'iter', 'len', 'list', 'map', 'max', 'min', 'next', 'oct', 'ord', 'pow', 'range', 'repr',
+    'reversed', 'round', 'set', 'slice', 'sorted', 'str', 'sum', 'tuple', 'zip', 'True', 'False', 'None',
+    'Exception', 'ArithmeticError', 'AttributeError', 'IndexError', 'KeyError', 'LookupError', 'StopIteration',
+    'TypeError', 'ValueError', 'ZeroDivisionError',
+)
+ALLOWED_MODULES = frozenset((
+    'math', 'json', 'datetime', 'time', 'random', 'html', 're', 'string', 'itertools', 'functools',
+    'collections', 'urllib', 'statistics', 'decimal', 'fractions',
+))
+
+
+class TemplateError(Exception):
+    pass
+
+
+def restricted_import(name: str, globals_=None, locals_=None, fromlist=(), level: int = 0):
+    if level != 0 or name.split('.', 1)[0] not in ALLOWED_MODULES:
+        raise ImportError(f'"{name}" can\'t be imported by a template')
+    return __import__(name, globals_, locals_, fromlist, level)
+
+
+TEMPLATE_BUILTINS = {name: getattr(builtins, name) for name in SAFE_BUILTINS}
+TEMPLATE_BUILTINS['__import__'] = restricted_import
+
+
+class Template:
+    __slots__ = ('name', 'parts')
+
+    def __init__(self, name: str, parts: list[bytes | CodeType]):
+        """
+        A compiled template, the HTML between the blocks is kept as bytes
+        and every <python> block is a code object
+        """
+        self.name = name
+        self.parts = parts
+
+    def render(self, context: dict[str, Any] = None) -> Iterator[bytes]:
+        """
+        Runs the blocks in order in a namespace they share, yielding the HTML and what the blocks print.
+        :param context: Names given to the blocks (request, ...)
+        """
+        output: list[str] = []
+
+        def print_(*values, sep: str = ' ', end: str = '\n', **_) -> None:
+            output.append(sep.join(map(str, values)) + end)
+
+        namespace = {
+            '__builtins__': TEMPLATE_BUILTINS,
+            '__name__': '__pmgs__',
+            'print': print_,
+            'write': output.append,
+            'escape': html.escape,
+        }
+        if context:
+            namespace.update(context)
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            exec(part, namespace)
+            if output:
+                yield ''.join(output).encode()
+                output.clear()
+
+
+def compile_template(source: str, name: str = '<template>') -> Template:
+    """
+    Compiles the <python> blocks of source, the code objects keep the line numbers of the template
+    :raise TemplateError: A block has a syntax error
+    """
+    parts: list[bytes | CodeType] = []
+    position = 0
+    for match in BLOCK.finditer(source):
+        if match.start() > position:
+            parts.append(source[position:match.start()].encode())
+        code = match.group(1)
+        line = source.count('\n', 0, match.start(1))
+        if code.startswith(('\r\n', '\n')):
+            # the code starts on the line after the tag
+            line += 1
+            code = code.lstrip('\r\n')
+        try:
+            # padded so that the errors point to the line in the template
+            parts.append(compile('\n' * line + textwrap.dedent(code), name, 'exec'))
+        except SyntaxError as e:
+            raise TemplateError(f'{name}, line {e.lineno}: {e.msg}') from e
+        position = match.end()
+    if position < len(source):
+        parts.append(source[position:].encode())
+    return Template(name, parts)
+
+
+def describe_error(error: BaseException, name: str) -> str:
+    """The error of a block with its line in the template"""
+    lines = [frame.lineno for frame in traceback.extract_tb(error.__traceback__) if frame.filename == name]
+    return f'{name}, line {lines[-1]}: {error!r}' if lines else f'{name}: {error!r}'
+
+
+class TemplateCache:
+    def __init__(self, max_entries: int = 256):
+        """Compiled templates by path, compiled again when the mtime or the size of the file changes"""
+        self.max_entries = max_entries
+        # path -> (mtime_ns, size, template)
+        self.__entries: OrderedDict[str, tuple[int, int, Template]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str) -> Template:
+        """
+        :raise OSError: The file can't be read
+        :raise TemplateError: The template has a syntax error
+        """
+        path_stat = os.stat(path)
+        entry = self.__entries.get(path)
+        if entry is not None and entry[0] == path_stat.st_mtime_ns and entry[1] == path_stat.st_size:
+            self.hits += 1
+            self.__entries.move_to_end(path)
+            return entry[2]
+        self.misses += 1
+        with open(path, 'r', encoding='utf-8') as file:
+            template = compile_template(file.read(), path)
+        self.__entries[path] = (path_stat.st_mtime_ns, path_stat.st_size, template)
+        self.__entries.move_to_end(path)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+        return template
+
+    def invalidate(self, path: str) -> None:
+        self.__entries.pop(path, None)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,108 @@
+from typing import Any
+import os
+import ssl
+import json
+import time
+import asyncio
+from urllib.parse import urlsplit
+
+
+class HTTPCheckError(Exception):
+    pass
+
+
+async def http_get(url: str, timeout: float = 3.0, max_body: int = 64 * 1024, verify: bool = True) -> tuple[int, bytes]:
+    """
+    Minimal GET on the event loop, enough for the public-ip service and the reachability probe
+    :param verify: Verify the certificate of https urls
+    :return: (status code, body)
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise HTTPCheckError(f'Unsupported scheme "{parts.scheme}"')
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+
+    async def get() -> tuple[int, bytes]:
+        context = None
+        if secure:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=context)
+        try:
+            writer.write(f'GET {path} HTTP/1.0\r\n'
+                         f'Host: {parts.netloc}\r\n'
+                         f'User-Agent: PMgS-reachability\r\n'
+                         f'Connection: close\r\n\r\n'.encode())
+            await writer.drain()
+            data = b''
+            # the headers and at most max_body of the body
+            while len(data) < max_body + 8192 and (chunk := await reader.read(65536)):
+                data += chunk
+        finally:
+            writer.close()
+        head, _, body = data.partition(b'\r\n\r\n')
+        try:
+            status = int(head.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            raise HTTPCheckError(f'Invalid response from {url}')
+        return status, body[:max_body]
+
+    try:
+        return await asyncio.wait_for(get(), timeout)
+    except (OSError, asyncio.TimeoutError, ssl.SSLError) as e:
+        raise HTTPCheckError(f'{url}: {e!r}') from e
+
+
+async def fetch_public_ip(url: str, timeout: float = 3.0) -> str | None:
+    """The address returned by a what-is-my-ip service, None if it can't be reached in time"""
+    try:
+        status, body = await http_get(url, timeout=timeout)
+    except HTTPCheckError:
+        return None
+    if status != 200:
+        return None
+    return body.decode('utf-8', errors='replace').strip() or None
+
+
+async def probe(url: str, token: str, timeout: float = 3.0) -> bool:
+    """True if url answers with token, the server is the one answering and not something else on that address"""
+    try:
+        # an address has no certificate, the token is what proves it's this server
+        status, body = await http_get(url, timeout=timeout, verify=False)
+    except HTTPCheckError:
+        return False
+    return status == 200 and body.strip() == token.encode()
+
+
+class ResultCache:
+    def __init__(self, path: str, ttl: float = 3600.0):
+        """
+        Last result of the checks as JSON, shown at startup until a new check ends
+        :param ttl: Seconds a result is considered current
+        """
+        self.path = path
+        self.ttl = ttl
+
+    def read(self, port: int) -> dict[str, Any] | None:
+        try:
+            with open(self.path, 'r') as file:
+                result = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if result.get('port') != port or time.time() - result.get('checked', 0) > self.ttl:
+            return None
+        return result
+
+    def write(self, public_ip: str | None, port: int, reachable: bool) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                json.dump({'public_ip': public_ip, 'port': port, 'reachable': reachable, 'checked': time.time()}, file)
+            os.replace(temporary, self.path)
+        except OSError:
+            pass
@@ -0,0 +1,273 @@
+from typing import AsyncIterator
+import os
+import re
+import sys
+import json
+import asyncio
+from types import TracebackType
+
+from quart.wrappers.response import ResponseBody
+
+from fastcgi import die_with_parent, find_header_end, parse_cgi_headers
+from script_worker import FRAME, KIND_BODY, KIND_END, KIND_OUTPUT, KIND_REQUEST
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'script_worker.py')
+
+# the first line of an output that starts with CGI headers
+HEADER_LINE = re.compile(rb'^[A-Za-z0-9-]+:')
+
+
+class ScriptError(Exception):
+    pass
+
+
+class ScriptTimeout(ScriptError):
+    pass
+
+
+class ScriptWorker:
+    def __init__(self, python: str, preload: list[str] = None, env: dict[str, str] = None):
+        """A warm interpreter running one script at a time"""
+        self.python = python
+        self.preload = preload or []
+        self.env = env
+        self.requests = 0
+        self.rss = 0
+        self.process: asyncio.subprocess.Process = None
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self) -> 'ScriptWorker':
+        self.process = await asyncio.create_subprocess_exec(
+            self.python, WORKER_SCRIPT, *self.preload,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=self.env,
+            preexec_fn=die_with_parent if sys.platform == 'linux' else None)
+        return self
+
+    def send(self, script: str, env: dict[str, str], body: bytes) -> None:
+        request = json.dumps({'script': script, 'env': env}).encode()
+        self.process.stdin.write(FRAME.pack(KIND_REQUEST, len(request)) + request)
+        self.process.stdin.write(FRAME.pack(KIND_BODY, len(body)) + body)
+
+    async def read_frame(self) -> tuple[int, bytes]:
+        try:
+            kind, length = FRAME.unpack(await self.process.stdout.readexactly(FRAME.size))
+            return kind, await self.process.stdout.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            raise ScriptError(f'Worker {self.process.pid} exited') from e
+
+    def kill(self) -> None:
+        if self.running:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    def stop(self) -> None:
+        """Closes stdin, the worker exits after the current script"""
+        if self.running:
+            self.process.stdin.close()
+
+
+class ScriptRun:
+    def __init__(self, pool: 'ScriptPool', worker: ScriptWorker, deadline: float):
+        """A script being run by a worker, the worker goes back to the pool when its output ends"""
+        self.pool = pool
+        self.worker = worker
+        self.deadline = deadline
+        self.status: int = None
+        self.finished = False
+
+    async def read(self) -> bytes | None:
+        """The next output chunk, None at the end"""
+        if self.finished:
+            return None
+        remaining = self.deadline - asyncio.get_running_loop().time()
+        try:
+            kind, data = await asyncio.wait_for(self.worker.read_frame(), max(remaining, 0))
+        except asyncio.TimeoutError:
+            self.finish(kill=True)
+            raise ScriptTimeout(f'Script took more than {self.pool.timeout}s')
+        except ScriptError:
+            self.finish(kill=True)
+            raise
+        if kind == KIND_OUTPUT:
+            return data
+        if kind == KIND_END:
+            end = json.loads(data)
+            self.status = end['status']
+            self.worker.rss = end['rss']
+            self.finish()
+        return None
+
+    def finish(self, kill: bool = False) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        self.pool.release(self.worker, kill=kill)
+
+
+class ScriptBody(ResponseBody):
+    def __init__(self, run: ScriptRun, first: bytes = b''):
+        """Streams the output of a script after its headers"""
+        self.run = run
+        self.first = first
+
+    async def __aenter__(self) -> 'ScriptBody':
+        return self
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        # the client left before the end, the script is still writing
+        self.run.finish(kill=True)
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self.__iterate()
+
+    async def __iterate(self) -> AsyncIterator[bytes]:
+        if self.first:
+            yield self.first
+        try:
+            while (chunk := await self.run.read()) is not None:
+                yield chunk
+        except ScriptError as e:
+            print(f'Script output cut: {e}')
+
+
+class ScriptResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status: int, headers: list[tuple[str, str]], body: ScriptBody):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class ScriptPool:
+    def __init__(self,
+                 python: str = sys.executable,
+                 workers: int = 4,
+                 max_requests: int = 1000,
+                 max_memory: int = 256 * 1024 * 1024,
+                 timeout: float = 30.0,
+                 preload: list[str] = None):
+        """
+        Interpreters started ahead of the requests, the modules imported by a script stay loaded for the next ones.
+        :param max_requests: Scripts run by a worker before it's replaced
+        :param max_memory: Resident memory in bytes after which a worker is replaced, 0 to disable
+        :param timeout: Seconds a script can run, it's killed after that
+        :param preload: Modules imported by the workers when they start
+        """
+        self.python = python
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.preload = preload or []
+        # the scripts only see these and the CGI variables
+        self.env = {name: os.environ[name] for name in ('PATH', 'SYSTEMROOT', 'LANG') if name in os.environ}
+        self.env['PYTHONIOENCODING'] = 'utf-8'
+        self.requests = 0
+        self.recycled = 0
+        self.timeouts = 0
+        self.closed = False
+        self.__idle: asyncio.Queue = None
+        self.__all: set[ScriptWorker] = set()
+
+    async def __spawn(self) -> None:
+        if self.closed:
+            return
+        worker = ScriptWorker(self.python, self.preload, self.env)
+        try:
+            await worker.start()
+        except OSError as e:
+            print(f'Script worker could not be started: {e!r}')
+            # taken again by the next request, which starts it
+            worker.process = None
+        if self.closed:
+            # replaced while the pool was closing
+            worker.kill()
+            return
+        self.__all.add(worker)
+        self.__idle.put_nowait(worker)
+
+    async def start(self) -> None:
+        """Starts every worker, done by the first request"""
+        if self.__idle is not None:
+            return
+        self.__idle = asyncio.Queue()
+        await asyncio.gather(*(self.__spawn() for _ in range(self.workers)))
+
+    def release(self, worker: ScriptWorker, kill: bool = False) -> None:
+        """Gives a worker back, replaced if it was killed, ran max_requests scripts or uses too much memory"""
+        worker.requests += 1
+        if not kill and worker.running and worker.requests < self.max_requests \
+                and not (self.max_memory and worker.rss > self.max_memory):
+            self.__idle.put_nowait(worker)
+            return
+        if kill:
+            worker.kill()
+        else:
+            worker.stop()
+            self.recycled += 1
+        self.__all.discard(worker)
+        asyncio.ensure_future(self.__spawn())
+
+    async def run(self, script: str, env: dict[str, str], body: bytes = b'') -> ScriptResponse:
+        """Runs a script and waits for its headers, the rest of the output is streamed"""
+        await self.start()
+        worker = await self.__idle.get()
+        if not worker.running:
+            try:
+                await worker.start()
+            except OSError as e:
+                self.__idle.put_nowait(worker)
+                raise ScriptError(f'Script worker could not be started: {e!r}') from e
+        self.requests += 1
+        run = ScriptRun(self, worker, asyncio.get_running_loop().time() + self.timeout)
+        try:
+            try:
+                worker.send(script, env, body)
+                await worker.process.stdin.drain()
+            except OSError as e:
+                raise ScriptError(f'Worker {worker.process.pid} exited: {e!r}') from e
+            head = b''
+            while (chunk := await run.read()) is not None:
+                head += chunk
+                if b'\n' not in head:
+                    continue
+                if not HEADER_LINE.match(head):
+                    # plain output, sent as it is
+                    return ScriptResponse(200, [('Content-Type', 'text/html; charset=utf-8')], ScriptBody(run, head))
+                end, start = find_header_end(head)
+                if end != -1:
+                    status, headers = parse_cgi_headers(head[:end])
+                    return ScriptResponse(status, headers, ScriptBody(run, head[start:]))
+        except ScriptTimeout:
+            self.timeouts += 1
+            raise
+        except BaseException:
+            run.finish(kill=True)
+            raise
+        # ended before a complete header block
+        if HEADER_LINE.match(head):
+            status, headers = parse_cgi_headers(head)
+            return ScriptResponse(status, headers, ScriptBody(run))
+        return ScriptResponse(200, [('Content-Type', 'text/html; charset=utf-8')], ScriptBody(run, head))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'workers': sum(1 for worker in self.__all if worker.running),
+            'idle': self.__idle.qsize() if self.__idle is not None else 0,
+            'requests': self.requests,
+            'recycled': self.recycled,
+            'timeouts': self.timeouts,
+        }
+
+    def close(self) -> None:
+        self.closed = True
+        for worker in self.__all:
+            worker.kill()
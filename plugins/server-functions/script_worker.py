@@ -0,0 +1,142 @@
+"""
+Worker of the .py pages, started by script_pool.ScriptPool: runs the scripts it gets on stdin
+one after the other and sends their output back as frames, the modules they import stay loaded.
+Usage: python script_worker.py [module to preload ...]
+"""
+import io
+import os
+import sys
+import json
+import runpy
+import struct
+import importlib
+import traceback
+
+# kind, length
+FRAME = struct.Struct('<BI')
+
+# pool -> worker
+KIND_REQUEST = 1
+KIND_BODY = 2
+# worker -> pool
+KIND_OUTPUT = 3
+KIND_END = 4
+
+OUTPUT_BUFFER = 8192
+
+
+def read_exactly(fd: int, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def read_frame(fd: int) -> tuple[int, bytes]:
+    kind, length = FRAME.unpack(read_exactly(fd, FRAME.size))
+    return kind, read_exactly(fd, length)
+
+
+def write_frame(fd: int, kind: int, data: bytes = b'') -> None:
+    data = FRAME.pack(kind, len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes, 0 where it can't be known"""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # the peak, in kilobytes except on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class OutputWriter(io.RawIOBase):
+    def __init__(self, fd: int):
+        """The stdout of a script, sent to the pool as output frames"""
+        self.fd = fd
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if data:
+            write_frame(self.fd, KIND_OUTPUT, bytes(data))
+        return len(data)
+
+
+def run(script: str, env: dict[str, str], body: bytes, channel: int) -> int:
+    """Runs a script as __main__ with the CGI environment, returns its exit status"""
+    base_environ = dict(os.environ)
+    base_path = list(sys.path)
+    base_cwd = os.getcwd()
+    output = io.BufferedWriter(OutputWriter(channel), buffer_size=OUTPUT_BUFFER)
+    stdout = io.TextIOWrapper(output, encoding='utf-8', errors='replace', newline='\n')
+    os.environ.update(env)
+    sys.argv = [script]
+    sys.path.insert(0, os.path.dirname(script))
+    sys.stdin = io.TextIOWrapper(io.BytesIO(body), encoding='utf-8', errors='replace')
+    sys.stdout = stdout
+    status = 0
+    try:
+        os.chdir(os.path.dirname(script))
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            stdout.flush()
+        except (OSError, ValueError):
+            pass
+        sys.stdout = sys.__stdout__
+        sys.stdin = sys.__stdin__
+        os.environ.clear()
+        os.environ.update(base_environ)
+        sys.path[:] = base_path
+        os.chdir(base_cwd)
+    return status
+
+
+def serve() -> None:
+    # the pipes belong to the protocol, a script writing to fd 1 ends up in stderr
+    requests = os.dup(0)
+    channel = os.dup(1)
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+
+    for name in sys.argv[1:]:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f'Could not preload {name}: {e!r}', file=sys.stderr)
+
+    while True:
+        try:
+            kind, data = read_frame(requests)
+            if kind != KIND_REQUEST:
+                continue
+            request = json.loads(data)
+            kind, body = read_frame(requests)
+        except EOFError:
+            # closed by the pool
+            return
+        status = run(request['script'], request['env'], body, channel)
+        write_frame(channel, KIND_END, json.dumps({'status': status, 'rss': current_rss()}).encode())
+
+
+if __name__ == '__main__':
+    serve()
@@ -1,5 +1,6 @@
 from plugin_manager import Manager
 from quart import Request, Websocket
+from request_body import RequestBody
 
 manager = Manager()
 
@@ -14,12 +15,42 @@ async def x(request: Request) -> tuple[str, int]:
     return 'X', 200
 
 
-@manager.websocket('/echo')
+@manager.route('/export.csv')
+async def export(request: Request):
+    """Streamed while it's produced, the whole file is never in memory"""
+    async def rows():
+        yield 'id,square\n'
+        for i in range(int(request.args.get('rows', 1000))):
+            yield f'{i},{i * i}\n'
+
+    return rows(), 200, {'Content-Type': 'text/csv', 'Content-Disposition': 'attachment; filename="export.csv"'}
+
+
+@manager.route('/upload', max_body_size=512 * 1024 * 1024)
+async def upload(request: Request, body: RequestBody):
+    """Parsed while it's received, the files are never in memory as a whole"""
+    received = {}
+    async for part in body.parts():
+        if part.is_file:
+            with await part.spool() as file:
+                received[part.name] = {'filename': part.filename, 'size': file.seek(0, 2)}
+        else:
+            received[part.name] = await part.text()
+    return received, 200
+
+
+@manager.websocket('/echo', max_connections=1000, max_message_size=65536, idle_timeout=300)
 async def echo(ws: Websocket) -> None:
     while True:
         data = await ws.receive()
         await ws.send(data)
 
+
+@manager.sse('/events')
+async def events(last_event_id: str | None):
+    """Greets the client, then sends what is published with manager.sse_publish('/events', ...)"""
+    yield {'hello': 'world', 'resumed': last_event_id is not None}
+
 # @manager.on('plugin.pre-load')
 # def on_pre_load():
 #     print('Plugin Loading')
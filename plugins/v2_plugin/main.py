@@ -9,12 +9,12 @@ def on_load():
     print('Plugin Loaded!')
 
 
-@manager.route('/x', enable_lru_cache=True)
+@manager.route('/lazy/x', enable_lru_cache=True)
 async def x(request: Request) -> tuple[str, int]:
     return 'X', 200
 
 
-@manager.websocket('/echo')
+@manager.websocket('/lazy/echo')
 async def echo(ws: Websocket) -> None:
     while True:
         data = await ws.receive()
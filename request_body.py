@@ -0,0 +1,291 @@
+from typing import AsyncIterator
+import os
+import asyncio
+import tempfile
+import quart
+from hypercorn.typing import ASGIReceiveCallable
+from quart import Request
+from quart.asgi import ASGIHTTPConnection
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData, Preamble
+
+# a body (or a part) bigger than this goes to a temporary file when spooled
+SPOOL_THRESHOLD = 1024 * 1024
+MAX_PARTS = 1000
+# bytes of a streamed body buffered while the route is slower than the network
+BUFFER_WINDOW = 1024 * 1024
+
+
+class BodyTooLarge(RequestEntityTooLarge):
+    """Answered with 413 if the route doesn't catch it"""
+
+
+class MalformedBody(BadRequest):
+    """Answered with 400 if the route doesn't catch it"""
+
+
+async def write_spooled(file: tempfile.SpooledTemporaryFile, chunk: bytes, threshold: int) -> None:
+    """Writes to memory while the file is small, to disk in the default executor after that"""
+    if file.tell() + len(chunk) > threshold:
+        await asyncio.get_running_loop().run_in_executor(None, file.write, chunk)
+    else:
+        file.write(chunk)
+
+
+async def spool_chunks(chunks: AsyncIterator[bytes], threshold: int) -> tempfile.SpooledTemporaryFile:
+    file = tempfile.SpooledTemporaryFile(max_size=threshold)
+    try:
+        async for chunk in chunks:
+            await write_spooled(file, chunk, threshold)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file
+
+
+async def save_chunks(chunks: AsyncIterator[bytes], path: str) -> int:
+    """Writes the chunks to path in the default executor, returns the number of bytes"""
+    loop = asyncio.get_running_loop()
+    size = 0
+    file = await loop.run_in_executor(None, open, path, 'wb')
+    try:
+        async for chunk in chunks:
+            await loop.run_in_executor(None, file.write, chunk)
+            size += len(chunk)
+    except BaseException:
+        file.close()
+        os.remove(path)
+        raise
+    await loop.run_in_executor(None, file.close)
+    return size
+
+
+class Part:
+    def __init__(self, reader: 'MultipartReader', name: str, filename: str | None, headers: Headers):
+        """A field or a file of a multipart body, its data must be read before the next part"""
+        self.reader = reader
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.done = False
+
+    @property
+    def content_type(self) -> str | None:
+        return self.headers.get('Content-Type')
+
+    @property
+    def is_file(self) -> bool:
+        return self.filename is not None
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while not self.done:
+            event = await self.reader.next_event()
+            if not isinstance(event, Data):
+                raise MalformedBody(f'Unexpected {type(event).__name__} in the part "{self.name}"')
+            if not event.more_data:
+                self.done = True
+            if event.data:
+                yield event.data
+
+    async def read(self) -> bytes:
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    async def text(self, encoding: str = 'utf-8') -> str:
+        charset = parse_options_header(self.content_type or '')[1].get('charset', encoding)
+        return (await self.read()).decode(charset, errors='replace')
+
+    async def spool(self, threshold: int = SPOOL_THRESHOLD) -> tempfile.SpooledTemporaryFile:
+        """The data in memory if it's small, in a temporary file past threshold"""
+        return await spool_chunks(self.chunks(), threshold)
+
+    async def save(self, path: str) -> int:
+        return await save_chunks(self.chunks(), path)
+
+    async def drain(self) -> None:
+        async for _ in self.chunks():
+            pass
+
+
+class MultipartReader:
+    def __init__(self, chunks: AsyncIterator[bytes], boundary: bytes, max_parts: int = MAX_PARTS):
+        """Feeds the decoder as its events are needed, at most a chunk of the body is held"""
+        self.__chunks = chunks.__aiter__()
+        self.__decoder = MultipartDecoder(boundary, max_parts=max_parts)
+        self.__finished = False
+
+    async def next_event(self):
+        while True:
+            try:
+                event = self.__decoder.next_event()
+            except RequestEntityTooLarge as e:
+                # the decoder has no memory limit, only max_parts
+                raise MalformedBody('Too many parts') from e
+            except ValueError as e:
+                # what's left of a truncated body
+                raise MalformedBody(str(e)) from e
+            if not isinstance(event, NeedData):
+                return event
+            if self.__finished:
+                raise MalformedBody('The multipart body ends before its last boundary')
+            chunk = await anext(self.__chunks, None)
+            if chunk is None:
+                self.__finished = True
+            self.__decoder.receive_data(chunk)
+
+    async def parts(self) -> AsyncIterator[Part]:
+        part: Part | None = None
+        while True:
+            if part is not None and not part.done:
+                # skipped by the route
+                await part.drain()
+            event = await self.next_event()
+            if isinstance(event, (Field, File)):
+                part = Part(self, event.name, event.filename if isinstance(event, File) else None, event.headers)
+                yield part
+            elif isinstance(event, Epilogue):
+                return
+            elif not isinstance(event, Preamble):
+                raise MalformedBody(f'Unexpected {type(event).__name__}')
+
+
+class Body(quart.wrappers.request.Body):
+    def __init__(self, expected_content_length: int | None, max_content_length: int | None):
+        """
+        Quart's body, created with MAX_CONTENT_LENGTH before the route is known.
+        A bigger Content-Length is refused when the body is read, unless the route streams it first:
+        until then what arrives is held back at MAX_CONTENT_LENGTH buffered bytes instead of dropped
+        """
+        super().__init__(None, max_content_length)
+        self.__too_large = expected_content_length is not None and max_content_length is not None \
+            and expected_content_length > max_content_length
+        # bytes buffered after which the receiver waits, None to buffer like Quart
+        self.__window: int | None = None
+        self.__room = asyncio.Event()
+        self.__room.set()
+        if self.__too_large:
+            self.__window = max_content_length
+            self._max_content_length = None
+
+    def stream(self, window: int = BUFFER_WINDOW) -> None:
+        """
+        The route reads the body as it arrives and checks its total size itself (RequestBody),
+        at most window bytes wait in memory while it's slower than the network
+        """
+        self.__too_large = False
+        self.__window = window
+        self._max_content_length = None
+        self.__update_room()
+
+    def set_max_size(self, max_size: int | None) -> None:
+        """The route reads the body as a whole, up to max_size bytes in place of MAX_CONTENT_LENGTH"""
+        self.__too_large = False
+        self.__window = None
+        self._max_content_length = max_size
+        self.__update_room()
+
+    async def wait_for_room(self) -> None:
+        await self.__room.wait()
+
+    def __update_room(self) -> None:
+        if self.__window is not None and len(self._data) >= self.__window and not self._complete.is_set():
+            self.__room.clear()
+        else:
+            self.__room.set()
+
+    def append(self, data: bytes) -> None:
+        super().append(data)
+        self.__update_room()
+
+    def set_complete(self) -> None:
+        super().set_complete()
+        self.__room.set()
+
+    async def __anext__(self) -> bytes:
+        if self.__too_large:
+            raise RequestEntityTooLarge()
+        data = await super().__anext__()
+        self.__update_room()
+        return data
+
+    def __await__(self):
+        if self.__too_large:
+            raise RequestEntityTooLarge()
+        return (yield from super().__await__())
+
+
+class StreamingRequest(quart.Request):
+    body_class = Body
+
+
+class StreamingConnection(ASGIHTTPConnection):
+    async def handle_messages(self, request: quart.Request, receive: ASGIReceiveCallable) -> None:
+        """Quart's receive loop, it waits while a streamed body has a full buffer so the server stops reading"""
+        while True:
+            if isinstance(request.body, Body):
+                await request.body.wait_for_room()
+            message = await receive()
+            if message['type'] == 'http.request':
+                request.body.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    request.body.set_complete()
+            elif message['type'] == 'http.disconnect':
+                return
+
+
+class RequestBody:
+    def __init__(self, request: Request, max_size: int = None, spool_threshold: int = SPOOL_THRESHOLD):
+        """
+        The body of a request, read as it arrives instead of as a whole
+        :param max_size: Bytes after which BodyTooLarge is raised, checked against Content-Length before reading
+        :param spool_threshold: Size after which .spool() writes to a temporary file
+        """
+        self.request = request
+        self.max_size = max_size
+        self.spool_threshold = spool_threshold
+        self.received = 0
+        self.__consumed = False
+
+    @property
+    def content_length(self) -> int | None:
+        return self.request.content_length
+
+    def check_length(self) -> None:
+        if self.max_size is not None and (self.content_length or 0) > self.max_size:
+            raise BodyTooLarge(f'The body is bigger than {self.max_size} bytes')
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """The body as it arrives, it can only be read once"""
+        if self.__consumed:
+            raise RuntimeError('The body was already read')
+        self.__consumed = True
+        self.check_length()
+        async for chunk in self.request.body:
+            self.received += len(chunk)
+            if self.max_size is not None and self.received > self.max_size:
+                # chunked, or more than Content-Length said
+                raise BodyTooLarge(f'The body is bigger than {self.max_size} bytes')
+            if chunk:
+                yield chunk
+
+    async def read(self) -> bytes:
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    async def spool(self) -> tempfile.SpooledTemporaryFile:
+        """The whole body, in memory if it's small, in a temporary file past spool_threshold"""
+        return await spool_chunks(self.chunks(), self.spool_threshold)
+
+    async def save(self, path: str) -> int:
+        return await save_chunks(self.chunks(), path)
+
+    def parts(self, max_parts: int = MAX_PARTS) -> AsyncIterator[Part]:
+        """
+        The parts of a multipart body, parsed as the body arrives
+        :raise MalformedBody: Not a multipart body, or a malformed one
+        """
+        mimetype, options = parse_options_header(self.request.headers.get('Content-Type', ''))
+        if not mimetype.startswith('multipart/') or 'boundary' not in options:
+            raise MalformedBody('Not a multipart body')
+        return MultipartReader(self.chunks(), options['boundary'].encode('latin-1'), max_parts=max_parts).parts()
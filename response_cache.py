@@ -0,0 +1,183 @@
+from typing import Any, Callable, Awaitable
+import sys
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from quart import Request
+
+
+class CacheEntry:
+    __slots__ = ('data', 'return_code', 'size', 'expires', 'stale_until')
+
+    def __init__(self, data: Any, return_code: int, size: int, expires: float, stale_until: float):
+        self.data = data
+        self.return_code = return_code
+        self.size = size
+        self.expires = expires
+        self.stale_until = stale_until
+
+
+def size_of(data: Any) -> int:
+    """Size of the body sent for data, dicts and lists by the length of their JSON like Quart sends them"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, (dict, list)):
+        try:
+            return len(json.dumps(data, separators=(',', ':'), default=str).encode())
+        except (TypeError, ValueError):
+            # not JSON, Quart can't send it either
+            pass
+    return sys.getsizeof(data)
+
+
+class ResponseCache:
+    def __init__(self,
+                 ttl: float = 60.0,
+                 max_entries: int = 1024,
+                 max_bytes: int = 16 * 1024 * 1024,
+                 stale_while_revalidate: float = 0.0,
+                 vary: tuple[str, ...] = ('query',),
+                 methods: tuple[str, ...] = ('GET', 'HEAD')):
+        """
+        Cache of the (data, return_code) values returned by an endpoint
+        :param ttl: Seconds a response is fresh
+        :param max_entries: Maximum number of cached responses
+        :param max_bytes: Maximum total size of the cached data
+        :param stale_while_revalidate: Seconds after the ttl in which the stale response is sent
+                                       while a new one is computed in the background
+        :param vary: Parts of the request the key is made of, besides the view arguments:
+                     'method', 'path', 'query', 'header:<name>', 'cookie:<name>'
+        :param methods: Only these methods are cached
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.vary = vary
+        self.methods = methods
+
+        self.__entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self.__bytes = 0
+        # requests computing a key, the others wait on them
+        self.__pending: dict[tuple, asyncio.Future] = {}
+        self.__background: set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__bytes,
+            'hits': self.hits,
+            'stale-hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def clear(self) -> None:
+        self.__entries.clear()
+        self.__bytes = 0
+
+    def make_key(self, request: Request, kwargs: dict[str, Any]) -> tuple:
+        key = [tuple(sorted(kwargs.items()))]
+        for part in self.vary:
+            match part:
+                case 'method':
+                    key.append(request.method)
+                case 'path':
+                    key.append(request.path)
+                case 'query':
+                    key.append(request.query_string)
+                case _ if part.startswith('header:'):
+                    key.append(request.headers.get(part[7:]))
+                case _ if part.startswith('cookie:'):
+                    key.append(request.cookies.get(part[7:]))
+                case _:
+                    raise ValueError(f'Unknown cache vary "{part}"')
+        return tuple(key)
+
+    async def get_or_compute(self,
+                             request: Request,
+                             kwargs: dict[str, Any],
+                             compute: Callable[[], Awaitable[tuple[Any, int]]]) -> tuple[Any, int]:
+        if request.method not in self.methods:
+            return await compute()
+        key = self.make_key(request, kwargs)
+        now = time.monotonic()
+
+        entry = self.__entries.get(key)
+        if entry is not None:
+            if now < entry.expires:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry.data, entry.return_code
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                if key not in self.__pending:
+                    task = asyncio.ensure_future(self.__compute(key, compute))
+                    self.__background.add(task)
+                    task.add_done_callback(self.__refreshed)
+                return entry.data, entry.return_code
+
+        self.misses += 1
+        while (pending := self.__pending.get(key)) is not None:
+            try:
+                shared = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # the request computing it went away, not this one: computed here or by another waiter
+                continue
+            # None if what was computed can only be sent once (a stream, a response)
+            return shared if shared is not None else await compute()
+        return await self.__compute(key, compute)
+
+    def __refreshed(self, task: asyncio.Task) -> None:
+        self.__background.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            print(f'Response cache refresh failed: {e!r}')
+
+    async def __compute(self, key: tuple, compute: Callable[[], Awaitable[tuple[Any, int]]]) -> tuple[Any, int]:
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[key] = future
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved, waiters get it from the await
+            future.exception()
+            raise
+        finally:
+            del self.__pending[key]
+
+        # responses and streams can only be sent once, with headers it's not cached either
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], (str, bytes, dict, list)):
+            future.set_result(result)
+            if 200 <= result[1] <= 299:
+                self.__store(key, *result)
+        else:
+            future.set_result(None)
+        return result
+
+    def __store(self, key: tuple, data: Any, return_code: int) -> None:
+        size = size_of(data)
+        if size > self.max_bytes:
+            return
+        if (old := self.__entries.pop(key, None)) is not None:
+            self.__bytes -= old.size
+        now = time.monotonic()
+        self.__entries[key] = CacheEntry(data, return_code, size,
+                                         now + self.ttl, now + self.ttl + self.stale_while_revalidate)
+        self.__bytes += size
+        while self.__entries and (len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes):
+            _, old = self.__entries.popitem(last=False)
+            self.__bytes -= old.size
+            self.evictions += 1
@@ -0,0 +1,130 @@
+from typing import Any, AsyncIterator, Iterator
+import asyncio
+import inspect
+import contextvars
+
+# what a sync iterator or a file gives per chunk, the small chunks of an iterator are joined up to this
+CHUNK_SIZE = 64 * 1024
+
+
+def is_stream(data: Any) -> bool:
+    """True for what a route can return instead of the whole body: (async) iterators and file objects"""
+    if isinstance(data, (str, bytes, bytearray, memoryview, dict, list, tuple)):
+        return False
+    return hasattr(data, '__aiter__') or callable(getattr(data, 'read', None)) or isinstance(data, Iterator)
+
+
+def encode(chunk: Any) -> bytes:
+    if isinstance(chunk, str):
+        return chunk.encode()
+    return bytes(chunk)
+
+
+def next_batch(iterator: Iterator[Any], chunk_size: int) -> bytes:
+    """The next items of iterator joined, up to chunk_size bytes, empty at the end"""
+    batch = []
+    size = 0
+    for item in iterator:
+        if item:
+            batch.append(encode(item))
+            size += len(batch[-1])
+        if size >= chunk_size:
+            break
+    return b''.join(batch)
+
+
+async def coalesce(chunks: AsyncIterator[Any], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    The chunks of an async iterator joined while the previous ones are being sent,
+    a producer that yields row by row doesn't cost a send per row,
+    one that waits between its chunks has each of them sent right away.
+    The producer stops when chunk_size bytes are waiting.
+    """
+    buffer = bytearray()
+    ready = asyncio.Event()
+    room = asyncio.Event()
+    room.set()
+    done = False
+
+    async def produce() -> None:
+        nonlocal done
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                buffer.extend(encode(chunk))
+                ready.set()
+                if len(buffer) >= chunk_size:
+                    room.clear()
+                    await room.wait()
+        finally:
+            done = True
+            ready.set()
+
+    # runs in the context of the response, with its request
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            if not buffer and not done:
+                ready.clear()
+                await ready.wait()
+            if buffer:
+                data = bytes(buffer)
+                buffer.clear()
+                room.set()
+                yield data
+            elif done:
+                break
+        # the error of the producer, if any
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+
+async def close(data: Any) -> None:
+    if callable(closer := getattr(data, 'aclose', None)) or callable(closer := getattr(data, 'close', None)):
+        if inspect.isawaitable(result := closer()):
+            await result
+
+
+async def iterate(data: Any, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    The body of a streamed response, at most chunk_size bytes are produced ahead of what is sent.
+    Sync iterators and files are read in the default executor so a slow producer doesn't block the other requests.
+    """
+    loop = asyncio.get_running_loop()
+    # the request context of the route, for the executor too
+    context = contextvars.copy_context()
+    # the read running in the executor, it can't be cancelled
+    pending: asyncio.Future | None = None
+    try:
+        if hasattr(data, '__aiter__'):
+            async for chunk in coalesce(data, chunk_size):
+                yield chunk
+        elif callable(read := getattr(data, 'read', None)):
+            while True:
+                if inspect.iscoroutinefunction(read):
+                    chunk = await read(chunk_size)
+                else:
+                    pending = loop.run_in_executor(None, context.run, read, chunk_size)
+                    chunk = await asyncio.shield(pending)
+                if not chunk:
+                    break
+                yield encode(chunk)
+        else:
+            while True:
+                pending = loop.run_in_executor(None, context.run, next_batch, data, chunk_size)
+                if not (batch := await asyncio.shield(pending)):
+                    break
+                yield batch
+    finally:
+        if pending is not None and not pending.done():
+            # the client left during a read, closing the generator (or the file) while it runs in the
+            # executor would fail with "generator already executing"
+            await asyncio.wait([pending])
+        await close(data)
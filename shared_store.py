@@ -0,0 +1,418 @@
+from typing import Any
+import os
+import time
+import asyncio
+import contextlib
+import mmap
+import struct
+import pickle
+import hashlib
+import multiprocessing
+
+
+class SharedStoreError(Exception):
+    pass
+
+
+class SharedStoreFull(SharedStoreError):
+    pass
+
+
+class SharedStoreLocked(SharedStoreError):
+    pass
+
+
+# used slots, tombstones (deleted or expired slots), pid holding the lock (0: none), before the slots
+STORE_HEADER = struct.Struct('<QQq')
+# state, value type, key length, value length, expiration (0: never), key hash
+SLOT_HEADER = struct.Struct('<BBHIdQ')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+
+EMPTY, USED, DELETED = 0, 1, 2
+# a miss probes until an empty slot, the table is rehashed when the tombstones pass this fraction of the slots
+TOMBSTONE_RATIO = 0.25
+# seconds a worker waits for the lock before SharedStoreLocked is raised
+LOCK_TIMEOUT = 5.0
+# the *_async methods poll the lock, from the first to the longest sleep between two tries
+LOCK_POLL_MIN = 0.0005
+LOCK_POLL_MAX = 0.02
+T_BYTES, T_STR, T_INT, T_FLOAT, T_PICKLE = 0, 1, 2, 3, 4
+
+
+def key_hash(key: bytes) -> int:
+    # the same in every process, unlike hash()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class SharedStore:
+    def __init__(self,
+                 size: int = 16 * 1024 * 1024,
+                 max_key_size: int = 128,
+                 max_value_size: int = 1024):
+        """
+        Key/value store in an anonymous shared mmap, an open addressing hash table of fixed-size slots.
+        Create it before the workers are forked, every worker then sees the same memory.
+        :param size: Memory budget in bytes, the number of slots is size / slot size
+        :param max_key_size: Maximum size of an encoded key
+        :param max_value_size: Maximum size of an encoded value
+        """
+        self.max_key_size = max_key_size
+        self.max_value_size = max_value_size
+        self.slot_size = SLOT_HEADER.size + max_key_size + max_value_size
+        self.slots = size // self.slot_size
+        if self.slots < 1:
+            raise SharedStoreError(f'A size of {size} bytes doesn\'t fit a single slot ({self.slot_size} bytes)')
+
+        self.__memory = mmap.mmap(-1, STORE_HEADER.size + self.slots * self.slot_size)
+        self.__lock = multiprocessing.Lock()
+
+    def __offset(self, index: int) -> int:
+        return STORE_HEADER.size + index * self.slot_size
+
+    def __count(self, used: int, tombstones: int) -> None:
+        current_used, current_tombstones, holder = STORE_HEADER.unpack_from(self.__memory, 0)
+        STORE_HEADER.pack_into(self.__memory, 0, current_used + used, current_tombstones + tombstones, holder)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """
+        The lock shared by the workers, it blocks the caller while it waits: async code uses __locked_async
+        :raise SharedStoreLocked: The lock wasn't released within LOCK_TIMEOUT
+        """
+        if not self.__lock.acquire(timeout=LOCK_TIMEOUT):
+            self.__timed_out()
+        with self.__held():
+            yield
+
+    @contextlib.asynccontextmanager
+    async def __locked_async(self):
+        """The lock shared by the workers, tried without blocking and awaited between the tries"""
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        delay = LOCK_POLL_MIN
+        while not self.__lock.acquire(block=False):
+            if time.monotonic() > deadline:
+                self.__timed_out()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX)
+        with self.__held():
+            yield
+
+    def __timed_out(self):
+        holder = STORE_HEADER.unpack_from(self.__memory, 0)[2]
+        raise SharedStoreLocked(f'The lock is held for more than {LOCK_TIMEOUT}s (pid {holder or "unknown"})')
+
+    @contextlib.contextmanager
+    def __held(self):
+        """
+        Releases the acquired lock on exit, the pid of the holder is kept in the header
+        so that the master can release it if the worker dies with it (recover)
+        """
+        used, tombstones, _ = STORE_HEADER.unpack_from(self.__memory, 0)
+        STORE_HEADER.pack_into(self.__memory, 0, used, tombstones, os.getpid())
+        try:
+            if tombstones > self.slots * TOMBSTONE_RATIO:
+                self.__compact(time.time())
+            yield
+        finally:
+            used, tombstones, _ = STORE_HEADER.unpack_from(self.__memory, 0)
+            STORE_HEADER.pack_into(self.__memory, 0, used, tombstones, 0)
+            self.__lock.release()
+
+    def recover(self, pid: int) -> bool:
+        """
+        Called by the master when a worker exits, releases the lock if the worker died holding it.
+        The slot it was writing keeps its old header (written last), the counters are rebuilt by a rehash
+        :return: True if the lock was released
+        """
+        if STORE_HEADER.unpack_from(self.__memory, 0)[2] != pid:
+            return False
+        # still held for the dead worker, the master is the only process releasing it
+        self.__compact(time.time())
+        self.__lock.release()
+        return True
+
+    def __compact(self, now: float) -> None:
+        """Rehashes the live slots, the tombstones become empty slots again, must be called with the lock held"""
+        memory = self.__memory
+        live = []
+        for index in range(self.slots):
+            offset = self.__offset(index)
+            state, _, _, _, expires, hashed = SLOT_HEADER.unpack_from(memory, offset)
+            if state == USED and not (expires and expires <= now):
+                live.append((hashed, memory[offset:offset + self.slot_size]))
+        for index in range(self.slots):
+            memory[self.__offset(index)] = EMPTY
+        for hashed, slot in live:
+            index = hashed % self.slots
+            while memory[self.__offset(index)] != EMPTY:
+                index = (index + 1) % self.slots
+            offset = self.__offset(index)
+            memory[offset:offset + self.slot_size] = slot
+        holder = STORE_HEADER.unpack_from(memory, 0)[2]
+        STORE_HEADER.pack_into(memory, 0, len(live), 0, holder)
+
+    def __encode_key(self, key: str | bytes) -> bytes:
+        key = key.encode() if isinstance(key, str) else key
+        if len(key) > self.max_key_size:
+            raise SharedStoreError(f'Key longer than {self.max_key_size} bytes')
+        return key
+
+    def __encode_value(self, value: Any) -> tuple[int, bytes]:
+        if isinstance(value, bool):
+            value_type, data = T_PICKLE, pickle.dumps(value)
+        elif isinstance(value, int):
+            value_type, data = T_INT, INT.pack(value)
+        elif isinstance(value, float):
+            value_type, data = T_FLOAT, FLOAT.pack(value)
+        elif isinstance(value, str):
+            value_type, data = T_STR, value.encode()
+        elif isinstance(value, (bytes, bytearray)):
+            value_type, data = T_BYTES, bytes(value)
+        else:
+            value_type, data = T_PICKLE, pickle.dumps(value)
+        if len(data) > self.max_value_size:
+            raise SharedStoreError(f'Value longer than {self.max_value_size} bytes')
+        return value_type, data
+
+    @staticmethod
+    def __decode_value(value_type: int, data: bytes) -> Any:
+        if value_type == T_BYTES:
+            return data
+        if value_type == T_STR:
+            return data.decode()
+        if value_type == T_INT:
+            return INT.unpack(data)[0]
+        if value_type == T_FLOAT:
+            return FLOAT.unpack(data)[0]
+        return pickle.loads(data)
+
+    def __find(self, key: bytes, hashed: int, now: float) -> tuple[int | None, int | None]:
+        """Returns (slot of the key, first free slot), must be called with the lock held"""
+        memory = self.__memory
+        free = None
+        index = hashed % self.slots
+        for _ in range(self.slots):
+            offset = self.__offset(index)
+            state, _, key_len, _, expires, slot_hash = SLOT_HEADER.unpack_from(memory, offset)
+            if state == EMPTY:
+                return None, free if free is not None else index
+            if state == USED and expires and expires <= now:
+                # expired, freed on the way
+                memory[offset] = DELETED
+                state = DELETED
+                self.__count(-1, 1)
+            if state == DELETED:
+                if free is None:
+                    free = index
+            elif slot_hash == hashed and key_len == len(key):
+                key_offset = offset + SLOT_HEADER.size
+                if memory[key_offset:key_offset + key_len] == key:
+                    return index, free
+            index = (index + 1) % self.slots
+        return None, free
+
+    def __read(self, index: int) -> Any:
+        offset = self.__offset(index)
+        _, value_type, key_len, value_len, _, _ = SLOT_HEADER.unpack_from(self.__memory, offset)
+        value_offset = offset + SLOT_HEADER.size + self.max_key_size
+        return self.__decode_value(value_type, self.__memory[value_offset:value_offset + value_len])
+
+    def __write(self, index: int, key: bytes, hashed: int, value_type: int, data: bytes, expires: float) -> None:
+        offset = self.__offset(index)
+        key_offset = offset + SLOT_HEADER.size
+        value_offset = key_offset + self.max_key_size
+        state = self.__memory[offset]
+        self.__memory[key_offset:key_offset + len(key)] = key
+        self.__memory[value_offset:value_offset + len(data)] = data
+        # the header last, the slot is used only once it's complete
+        SLOT_HEADER.pack_into(self.__memory, offset, USED, value_type, len(key), len(data), expires, hashed)
+        if state != USED:
+            self.__count(1, -1 if state == DELETED else 0)
+
+    def __store(self, key: bytes, hashed: int, value: Any, ttl: float | None, now: float,
+                index: int | None, free: int | None) -> None:
+        value_type, data = self.__encode_value(value)
+        if index is None:
+            if free is None:
+                raise SharedStoreFull(f'No free slot left ({self.slots} slots)')
+            index = free
+        self.__write(index, key, hashed, value_type, data, now + ttl if ttl else 0.0)
+
+    def __key(self, key: str | bytes) -> tuple[bytes, int]:
+        key = self.__encode_key(key)
+        return key, key_hash(key)
+
+    def __get(self, key: bytes, hashed: int, default: Any) -> Any:
+        index, _ = self.__find(key, hashed, time.time())
+        if index is None:
+            return default
+        return self.__read(index)
+
+    def __set(self, key: bytes, hashed: int, value: Any, ttl: float | None) -> None:
+        now = time.time()
+        self.__store(key, hashed, value, ttl, now, *self.__find(key, hashed, now))
+
+    def __add(self, key: bytes, hashed: int, value: Any, ttl: float | None) -> bool:
+        now = time.time()
+        index, free = self.__find(key, hashed, now)
+        if index is not None:
+            return False
+        self.__store(key, hashed, value, ttl, now, index, free)
+        return True
+
+    def __incr(self, key: bytes, hashed: int, delta: int, ttl: float | None) -> int:
+        now = time.time()
+        index, free = self.__find(key, hashed, now)
+        if index is None:
+            self.__store(key, hashed, delta, ttl, now, index, free)
+            return delta
+        offset = self.__offset(index)
+        _, value_type, _, _, expires, _ = SLOT_HEADER.unpack_from(self.__memory, offset)
+        if value_type != T_INT:
+            raise SharedStoreError(f'Value of "{key.decode(errors="replace")}" is not an integer')
+        value_offset = offset + SLOT_HEADER.size + self.max_key_size
+        value = INT.unpack_from(self.__memory, value_offset)[0] + delta
+        INT.pack_into(self.__memory, value_offset, value)
+        return value
+
+    def __delete(self, key: bytes, hashed: int) -> bool:
+        index, _ = self.__find(key, hashed, time.time())
+        if index is None:
+            return False
+        self.__memory[self.__offset(index)] = DELETED
+        self.__count(-1, 1)
+        return True
+
+    def get(self, key: str | bytes, default: Any = None) -> Any:
+        key = self.__key(key)
+        with self.__locked():
+            return self.__get(*key, default)
+
+    def set(self, key: str | bytes, value: Any, ttl: float = None) -> None:
+        """Stores a value, it expires after ttl seconds if given"""
+        key = self.__key(key)
+        with self.__locked():
+            self.__set(*key, value, ttl)
+
+    def add(self, key: str | bytes, value: Any, ttl: float = None) -> bool:
+        """Stores a value only if the key is missing, returns True if it was stored"""
+        key = self.__key(key)
+        with self.__locked():
+            return self.__add(*key, value, ttl)
+
+    def incr(self, key: str | bytes, delta: int = 1, ttl: float = None) -> int:
+        """
+        Atomically adds delta to an integer, a missing key counts as 0
+        :param ttl: Expiration set when the key is created, an existing key keeps its own
+        :return: The new value
+        """
+        key = self.__key(key)
+        with self.__locked():
+            return self.__incr(*key, delta, ttl)
+
+    def delete(self, key: str | bytes) -> bool:
+        key = self.__key(key)
+        with self.__locked():
+            return self.__delete(*key)
+
+    # the same operations for the event loop, waiting for the lock doesn't block it
+
+    async def get_async(self, key: str | bytes, default: Any = None) -> Any:
+        key = self.__key(key)
+        async with self.__locked_async():
+            return self.__get(*key, default)
+
+    async def set_async(self, key: str | bytes, value: Any, ttl: float = None) -> None:
+        key = self.__key(key)
+        async with self.__locked_async():
+            self.__set(*key, value, ttl)
+
+    async def add_async(self, key: str | bytes, value: Any, ttl: float = None) -> bool:
+        key = self.__key(key)
+        async with self.__locked_async():
+            return self.__add(*key, value, ttl)
+
+    async def incr_async(self, key: str | bytes, delta: int = 1, ttl: float = None) -> int:
+        key = self.__key(key)
+        async with self.__locked_async():
+            return self.__incr(*key, delta, ttl)
+
+    async def delete_async(self, key: str | bytes) -> bool:
+        key = self.__key(key)
+        async with self.__locked_async():
+            return self.__delete(*key)
+
+    def stats(self) -> dict[str, int]:
+        used = 0
+        now = time.time()
+        with self.__locked():
+            for index in range(self.slots):
+                state, _, _, _, expires, _ = SLOT_HEADER.unpack_from(self.__memory, self.__offset(index))
+                if state == USED and not (expires and expires <= now):
+                    used += 1
+            tombstones = STORE_HEADER.unpack_from(self.__memory, 0)[1]
+        return {
+            'slots': self.slots,
+            'used': used,
+            'tombstones': tombstones,
+            'bytes': self.slots * self.slot_size,
+        }
+
+
+class SharedNamespace:
+    """View of a SharedStore where every key is prefixed, so plugins don't overwrite each other"""
+    def __init__(self, store: SharedStore, namespace: str):
+        self.store = store
+        self.prefix = namespace + ':'
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.store.get(self.prefix + key, default)
+
+    def set(self, key: str, value: Any, ttl: float = None) -> None:
+        self.store.set(self.prefix + key, value, ttl=ttl)
+
+    def add(self, key: str, value: Any, ttl: float = None) -> bool:
+        return self.store.add(self.prefix + key, value, ttl=ttl)
+
+    def incr(self, key: str, delta: int = 1, ttl: float = None) -> int:
+        return self.store.incr(self.prefix + key, delta=delta, ttl=ttl)
+
+    def delete(self, key: str) -> bool:
+        return self.store.delete(self.prefix + key)
+
+    async def get_async(self, key: str, default: Any = None) -> Any:
+        return await self.store.get_async(self.prefix + key, default)
+
+    async def set_async(self, key: str, value: Any, ttl: float = None) -> None:
+        await self.store.set_async(self.prefix + key, value, ttl=ttl)
+
+    async def add_async(self, key: str, value: Any, ttl: float = None) -> bool:
+        return await self.store.add_async(self.prefix + key, value, ttl=ttl)
+
+    async def incr_async(self, key: str, delta: int = 1, ttl: float = None) -> int:
+        return await self.store.incr_async(self.prefix + key, delta=delta, ttl=ttl)
+
+    async def delete_async(self, key: str) -> bool:
+        return await self.store.delete_async(self.prefix + key)
+
+
+store: SharedStore = None
+
+
+def setup(size: int = 16 * 1024 * 1024, max_key_size: int = 128, max_value_size: int = 1024) -> SharedStore:
+    """Creates the store shared by the plugins, call it before forking the workers"""
+    global store
+    store = SharedStore(size=size, max_key_size=max_key_size, max_value_size=max_value_size)
+    return store
+
+
+def recover(pid: int) -> bool:
+    """Releases the lock of the store if the worker pid died holding it"""
+    return store is not None and store.recover(pid)
+
+
+def get_store() -> SharedStore:
+    if store is None:
+        setup()
+    return store
@@ -0,0 +1,54 @@
+from typing import Any
+import json
+import time
+from colors import *
+
+
+class Timeline:
+    def __init__(self):
+        """
+        Durations of the startup phases, a phase lasts until the next one starts or .stop() is called
+        """
+        self.start = time.perf_counter()
+        self.phases: list[tuple[str, float, float]] = []
+        self.__current: tuple[str, float] = None
+
+    def phase(self, name: str) -> None:
+        """Ends the current phase and starts the next one"""
+        self.stop()
+        self.__current = (name, time.perf_counter())
+
+    def stop(self) -> None:
+        if self.__current is not None:
+            name, started = self.__current
+            self.phases.append((name, started - self.start, time.perf_counter() - started))
+            self.__current = None
+
+    @property
+    def total(self) -> float:
+        return sum(duration for _, _, duration in self.phases)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            'total': round(self.total, 6),
+            'phases': [{'name': name, 'start': round(start, 6), 'duration': round(duration, 6)}
+                       for name, start, duration in self.phases],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), separators=(',', ':'))
+
+    def report(self, width: int = 30) -> str:
+        """Breakdown of the phases, each with a bar proportional to its share of the total"""
+        total = self.total or 1.0
+        longest = max((len(name) for name, _, _ in self.phases), default=0)
+        lines = [f'Startup took {FC.LIGHT_GREEN}{self.total * 1000:.1f}ms{OPS.RESET}']
+        for name, _, duration in self.phases:
+            share = duration / total
+            bar = '#' * max(1, round(share * width)) if duration > 0 else ''
+            lines.append(f'  {name: <{longest}} {FC.DARK_CYAN}{duration * 1000: >9.1f}ms{OPS.RESET} '
+                         f'{share * 100: >5.1f}% {FC.DARK_YELLOW}{bar}{OPS.RESET}')
+        return '\n'.join(lines)
+
+
+timeline: Timeline = Timeline()
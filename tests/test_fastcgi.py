@@ -0,0 +1,266 @@
+"""
+FastCGI client against a small local responder, run it from the repository root:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plugins', 'server-functions'))
+
+from fastcgi import (FCGI_ABORT_REQUEST, FCGI_BEGIN_REQUEST, FCGI_END_REQUEST, FCGI_GET_VALUES,
+                     FCGI_GET_VALUES_RESULT, FCGI_PARAMS, FCGI_STDERR, FCGI_STDIN, FCGI_STDOUT,
+                     END_REQUEST_BODY, MAX_CONTENT, RECORD_HEADER, FastCGIConnection, FastCGIError, FastCGIPool,
+                     decode_params, encode_params, encode_record, find_header_end, parse_cgi_headers)
+
+# FCGI_CANT_MPX_CONN
+PROTOCOL_REJECTED = 1
+
+
+def decode_records(data: bytes) -> list[tuple[int, int, bytes]]:
+    records = []
+    position = 0
+    while position < len(data):
+        _, type_, request_id, length, padding = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        records.append((type_, request_id, data[position:position + length]))
+        position += length + padding
+    return records
+
+
+def end_request(request_id: int, protocol_status: int = 0) -> bytes:
+    return encode_record(FCGI_END_REQUEST, request_id, END_REQUEST_BODY.pack(0, protocol_status))
+
+
+class Responder:
+    def __init__(self, handler, values: dict[str, str] = None):
+        """
+        A FastCGI application on a local port, handler(writer, request_id, params, stdin) answers a request
+        :param values: Answer to FCGI_GET_VALUES, None to leave it unanswered
+        """
+        self.handler = handler
+        self.values = values
+        self.aborted: list[int] = []
+        self.address: str = None
+        self.__server: asyncio.Server = None
+        self.__tasks: set[asyncio.Task] = set()
+
+    async def start(self) -> 'Responder':
+        self.__server = await asyncio.start_server(self.__client, '127.0.0.1', 0)
+        self.address = f'127.0.0.1:{self.__server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def stop(self) -> None:
+        self.__server.close()
+        tasks = tuple(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.__server.wait_closed()
+
+    async def __client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        requests: dict[int, dict[str, bytes]] = {}
+        self.__tasks.add(asyncio.current_task())
+        try:
+            while True:
+                _, type_, request_id, length, padding = RECORD_HEADER.unpack(await reader.readexactly(RECORD_HEADER.size))
+                content = (await reader.readexactly(length + padding))[:length]
+                if type_ == FCGI_GET_VALUES:
+                    if self.values is not None:
+                        writer.write(encode_record(FCGI_GET_VALUES_RESULT, 0, encode_params(self.values)))
+                elif type_ == FCGI_BEGIN_REQUEST:
+                    requests[request_id] = {'params': b'', 'stdin': b''}
+                elif type_ == FCGI_PARAMS:
+                    requests[request_id]['params'] += content
+                elif type_ == FCGI_STDIN and content:
+                    requests[request_id]['stdin'] += content
+                elif type_ == FCGI_STDIN:
+                    current = requests.pop(request_id)
+                    task = asyncio.ensure_future(self.handler(writer, request_id, decode_params(current['params']),
+                                                              current['stdin']))
+                    self.__tasks.add(task)
+                    task.add_done_callback(self.__tasks.discard)
+                elif type_ == FCGI_ABORT_REQUEST:
+                    self.aborted.append(request_id)
+                    writer.write(end_request(request_id))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # the client left, or stop()
+            pass
+        finally:
+            self.__tasks.discard(asyncio.current_task())
+            writer.close()
+
+
+async def echo(writer: asyncio.StreamWriter, request_id: int, params: dict[str, str], stdin: bytes) -> None:
+    writer.write(encode_record(FCGI_STDERR, request_id, b'a warning'))
+    writer.write(encode_record(FCGI_STDOUT, request_id,
+                               f'Status: 201 Created\r\nX-Method: {params["REQUEST_METHOD"]}\r\n\r\n'.encode()))
+    writer.write(encode_record(FCGI_STDOUT, request_id, stdin))
+    writer.write(end_request(request_id))
+
+
+async def delayed(writer: asyncio.StreamWriter, request_id: int, params: dict[str, str], stdin: bytes) -> None:
+    await asyncio.sleep(float(params['DELAY']))
+    writer.write(encode_record(FCGI_STDOUT, request_id, f'\r\n{params["NAME"]}'.encode()))
+    writer.write(end_request(request_id))
+
+
+async def endless(writer: asyncio.StreamWriter, request_id: int, params: dict[str, str], stdin: bytes) -> None:
+    writer.write(encode_record(FCGI_STDOUT, request_id, b'Content-Type: text/plain\r\n\r\nfirst'))
+
+
+async def cut(writer: asyncio.StreamWriter, request_id: int, params: dict[str, str], stdin: bytes) -> None:
+    writer.write(encode_record(FCGI_STDOUT, request_id, b'Content-Type: text/plain\r\n\r\npart'))
+    await writer.drain()
+    writer.transport.abort()
+
+
+async def rejected(writer: asyncio.StreamWriter, request_id: int, params: dict[str, str], stdin: bytes) -> None:
+    writer.write(end_request(request_id, PROTOCOL_REJECTED))
+
+
+async def read_body(body) -> bytes:
+    async with body:
+        return b''.join([chunk async for chunk in body])
+
+
+class CodecTest(unittest.TestCase):
+    def test_record_padding(self):
+        records = encode_record(FCGI_STDOUT, 3, b'abc')
+        self.assertEqual(len(records) % 8, 0)
+        self.assertEqual(decode_records(records), [(FCGI_STDOUT, 3, b'abc')])
+
+    def test_record_split(self):
+        content = os.urandom(MAX_CONTENT * 2 + 10)
+        records = decode_records(encode_record(FCGI_STDIN, 1, content))
+        self.assertEqual([len(data) for _, _, data in records], [MAX_CONTENT, MAX_CONTENT, 10])
+        self.assertEqual(b''.join(data for _, _, data in records), content)
+
+    def test_empty_record(self):
+        self.assertEqual(decode_records(encode_record(FCGI_PARAMS, 1)), [(FCGI_PARAMS, 1, b'')])
+
+    def test_params(self):
+        params = {'SCRIPT_FILENAME': '/srv/index.php', 'LONG': 'x' * 300, 'L' * 200: '', 'QUERY_STRING': 'a=é'}
+        self.assertEqual(decode_params(encode_params(params)), params)
+
+    def test_cgi_headers(self):
+        self.assertEqual(parse_cgi_headers(b'Status: 404 Not Found\r\nContent-Type: text/html\r\n'),
+                         (404, [('Content-Type', 'text/html')]))
+        self.assertEqual(parse_cgi_headers(b'Location: /next\n'), (302, [('Location', '/next')]))
+        self.assertEqual(parse_cgi_headers(b'Status: 200\nLocation: /next\n'), (200, [('Location', '/next')]))
+        self.assertEqual(parse_cgi_headers(b''), (200, []))
+        with self.assertRaises(FastCGIError):
+            parse_cgi_headers(b'no separator\r\n')
+        with self.assertRaises(FastCGIError):
+            parse_cgi_headers(b'Status: abc\r\n')
+
+    def test_header_end(self):
+        self.assertEqual(find_header_end(b'A: 1\r\n\r\nbody'), (4, 8))
+        self.assertEqual(find_header_end(b'A: 1\n\nbody\r\n\r\n'), (4, 6))
+        self.assertEqual(find_header_end(b'A: 1\r\n'), (-1, -1))
+
+
+class ConnectionTest(unittest.IsolatedAsyncioTestCase):
+    async def start(self, handler, values: dict[str, str] = None) -> Responder:
+        responder = await Responder(handler, values).start()
+        self.addAsyncCleanup(responder.stop)
+        return responder
+
+    async def connect(self, responder: Responder, timeout: float = 0.5) -> FastCGIConnection:
+        connection = await FastCGIConnection(responder.address).connect(timeout=timeout)
+        self.addCleanup(connection.close)
+        return connection
+
+    async def test_values_negotiated(self):
+        responder = await self.start(echo, {'FCGI_MAX_REQS': '8', 'FCGI_MPXS_CONNS': '1'})
+        self.assertEqual((await self.connect(responder)).max_requests, 8)
+
+    async def test_no_multiplexing(self):
+        responder = await self.start(echo, {'FCGI_MAX_REQS': '8', 'FCGI_MPXS_CONNS': '0'})
+        self.assertEqual((await self.connect(responder)).max_requests, 1)
+
+    async def test_values_unanswered(self):
+        responder = await self.start(echo)
+        connection = await self.connect(responder, timeout=0.1)
+        self.assertEqual(connection.max_requests, 1)
+        self.assertTrue(connection.available)
+
+    async def test_multiplexed_requests(self):
+        responder = await self.start(delayed, {'FCGI_MAX_REQS': '2', 'FCGI_MPXS_CONNS': '1'})
+        connection = await self.connect(responder)
+        slow = await connection.request({'DELAY': '0.1', 'NAME': 'slow'})
+        fast = await connection.request({'DELAY': '0', 'NAME': 'fast'})
+        self.assertNotEqual(slow.id_, fast.id_)
+        self.assertFalse(connection.available)
+        with self.assertRaises(FastCGIError):
+            await connection.request({'DELAY': '0', 'NAME': 'third'})
+
+        self.assertEqual(await fast.read(), b'\r\nfast')
+        self.assertFalse(slow.ended.done())
+        self.assertEqual(await slow.read(), b'\r\nslow')
+        self.assertIsNone(await slow.read())
+        self.assertTrue(connection.available)
+
+
+class PoolTest(unittest.IsolatedAsyncioTestCase):
+    async def pool(self, handler) -> tuple[FastCGIPool, Responder]:
+        responder = await Responder(handler).start()
+        self.addAsyncCleanup(responder.stop)
+        pool = FastCGIPool(addresses=[responder.address], connect_timeout=0.1, response_timeout=1.0)
+        self.addCleanup(pool.close)
+        return pool, responder
+
+    async def test_response(self):
+        pool, _ = await self.pool(echo)
+        response = await pool.request({'REQUEST_METHOD': 'POST'}, b'the body')
+        self.assertEqual(response.status, 201)
+        self.assertEqual(response.headers, [('X-Method', 'POST')])
+        self.assertEqual(await read_body(response.body), b'the body')
+        self.assertEqual(response.stderr, b'a warning')
+
+    async def test_streamed_stdin(self):
+        pool, _ = await self.pool(echo)
+
+        async def chunks():
+            for i in range(3):
+                yield f'chunk {i};'.encode()
+
+        response = await pool.request({'REQUEST_METHOD': 'PUT'}, chunks())
+        self.assertEqual(await read_body(response.body), b'chunk 0;chunk 1;chunk 2;')
+
+    async def test_abort(self):
+        pool, responder = await self.pool(endless)
+        response = await pool.request({})
+        async with response.body:
+            async for chunk in response.body:
+                self.assertEqual(chunk, b'first')
+                break
+        self.assertEqual(response.body.current.ended.done(), False)
+        await asyncio.wait_for(response.body.current.ended, 1.0)
+        self.assertEqual(responder.aborted, [response.body.current.id_])
+        # the slot is free again once the application ended the request
+        await asyncio.sleep(0)
+        self.assertTrue(pool.connections[0].available)
+
+    async def test_connection_lost(self):
+        pool, _ = await self.pool(cut)
+        response = await pool.request({})
+        with self.assertRaises(FastCGIError):
+            await read_body(response.body)
+
+    async def test_rejected(self):
+        pool, _ = await self.pool(rejected)
+        with self.assertRaises(FastCGIError):
+            await pool.request({})
+        self.assertEqual(pool.failures, 1)
+
+    async def test_no_application(self):
+        pool = FastCGIPool(addresses=['127.0.0.1:1'], connect_timeout=0.1)
+        self.addCleanup(pool.close)
+        with self.assertRaises(FastCGIError):
+            await pool.request({})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Public-ip and reachability checks against a local HTTP server, the kind of endpoint
+PMGS_PUBLIC_IP_URL points the server to. Run it from the repository root:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plugins', 'server-functions'))
+
+from reachability import HTTPCheckError, ResultCache, fetch_public_ip, http_get, probe
+
+TOKEN = 'a1b2c3'
+
+
+class LocalServer:
+    def __init__(self, routes: dict[str, tuple[int, bytes] | bytes | None]):
+        """
+        Answers GET requests from routes: (status, body), raw bytes sent as they are,
+        or None to never answer. Unknown paths get a 404
+        """
+        self.routes = routes
+        self.url: str = None
+        self.__server: asyncio.Server = None
+        self.__tasks: set[asyncio.Task] = set()
+
+    async def start(self) -> 'LocalServer':
+        self.__server = await asyncio.start_server(self.__client, '127.0.0.1', 0)
+        self.url = f'http://127.0.0.1:{self.__server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def stop(self) -> None:
+        self.__server.close()
+        tasks = tuple(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.__server.wait_closed()
+
+    async def __client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.__tasks.add(asyncio.current_task())
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            path = head.split(b' ', 2)[1].decode()
+            answer = self.routes.get(path, (404, b'not found'))
+            if answer is None:
+                await asyncio.Event().wait()
+            if isinstance(answer, tuple):
+                status, body = answer
+                answer = f'HTTP/1.0 {status} X\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body
+            writer.write(answer)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # the client left, or stop()
+            pass
+        finally:
+            self.__tasks.discard(asyncio.current_task())
+            writer.close()
+
+
+class CheckTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = await LocalServer({
+            '/ip': (200, b'203.0.113.7\n'),
+            '/empty': (200, b'  \n'),
+            '/unavailable': (503, b'203.0.113.7'),
+            '/slow': None,
+            '/garbage': b'not http at all',
+            '/big': (200, b'x' * 100000),
+            f'/.pmgs/reachability/{TOKEN}': (200, TOKEN.encode()),
+            '/.pmgs/reachability/other': (200, b'something else'),
+        }).start()
+        self.addAsyncCleanup(self.server.stop)
+
+    async def test_http_get(self):
+        self.assertEqual(await http_get(f'{self.server.url}/ip'), (200, b'203.0.113.7\n'))
+        self.assertEqual(await http_get(f'{self.server.url}/unavailable'), (503, b'203.0.113.7'))
+
+    async def test_http_get_max_body(self):
+        status, body = await http_get(f'{self.server.url}/big', max_body=1000)
+        self.assertEqual((status, body), (200, b'x' * 1000))
+
+    async def test_http_get_timeout(self):
+        started = time.monotonic()
+        with self.assertRaises(HTTPCheckError):
+            await http_get(f'{self.server.url}/slow', timeout=0.2)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    async def test_http_get_errors(self):
+        with self.assertRaises(HTTPCheckError):
+            await http_get(f'{self.server.url}/garbage')
+        with self.assertRaises(HTTPCheckError):
+            await http_get('ftp://127.0.0.1/')
+        with self.assertRaises(HTTPCheckError):
+            # nothing listens on port 1
+            await http_get('http://127.0.0.1:1/', timeout=1.0)
+
+    async def test_fetch_public_ip(self):
+        self.assertEqual(await fetch_public_ip(f'{self.server.url}/ip'), '203.0.113.7')
+        self.assertIsNone(await fetch_public_ip(f'{self.server.url}/unavailable'))
+        self.assertIsNone(await fetch_public_ip(f'{self.server.url}/empty'))
+        self.assertIsNone(await fetch_public_ip(f'{self.server.url}/slow', timeout=0.2))
+        self.assertIsNone(await fetch_public_ip(f'{self.server.url}/garbage'))
+
+    async def test_probe(self):
+        self.assertTrue(await probe(f'{self.server.url}/.pmgs/reachability/{TOKEN}', TOKEN))
+        # something else answers on that address
+        self.assertFalse(await probe(f'{self.server.url}/.pmgs/reachability/other', TOKEN))
+        self.assertFalse(await probe(f'{self.server.url}/.pmgs/reachability/unknown', TOKEN))
+        self.assertFalse(await probe(f'{self.server.url}/slow', TOKEN, timeout=0.2))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache', 'reachability.json')
+
+    def test_round_trip(self):
+        cache = ResultCache(self.path)
+        self.assertIsNone(cache.read(8080))
+        cache.write('203.0.113.7', 8080, True)
+        result = cache.read(8080)
+        self.assertEqual((result['public_ip'], result['port'], result['reachable']), ('203.0.113.7', 8080, True))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['reachability.json'])
+
+    def test_other_port(self):
+        cache = ResultCache(self.path)
+        cache.write('203.0.113.7', 8080, True)
+        self.assertIsNone(cache.read(443))
+
+    def test_ttl(self):
+        ResultCache(self.path).write('203.0.113.7', 8080, False)
+        with open(self.path, 'r') as file:
+            result = json.load(file)
+        result['checked'] -= 120
+        with open(self.path, 'w') as file:
+            json.dump(result, file)
+        self.assertIsNone(ResultCache(self.path, ttl=60).read(8080))
+        self.assertIsNotNone(ResultCache(self.path, ttl=600).read(8080))
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as file:
+            file.write('{not json')
+        self.assertIsNone(ResultCache(self.path).read(8080))
+
+
+if __name__ == '__main__':
+    unittest.main()
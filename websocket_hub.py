@@ -0,0 +1,243 @@
+from typing import Any
+import json
+import time
+import asyncio
+from quart import Websocket
+
+
+def encode_message(message: Any) -> str | bytes:
+    """Encodes a message once for every client, dicts and lists are sent as JSON"""
+    if isinstance(message, (str, bytes)):
+        return message
+    if isinstance(message, bytearray):
+        return bytes(message)
+    return json.dumps(message, separators=(',', ':'))
+
+
+class MessageTooLarge(ConnectionError):
+    """Raised by Connection.receive after the connection was closed with 1009"""
+
+
+class Connection:
+    def __init__(self,
+                 ws: Websocket,
+                 endpoint: str,
+                 send_queue_size: int = 64,
+                 send_queue_bytes: int = None,
+                 slow_consumer: str = 'drop',
+                 max_message_size: int = None,
+                 idle_timeout: float = None):
+        """
+        A registered websocket, everything sent to it goes through a bounded queue emptied by its own task
+        :param ws: The websocket (not the quart proxy)
+        :param endpoint: Url rule of the socket
+        :param send_queue_size: Messages waiting to be sent
+        :param send_queue_bytes: Bytes waiting to be sent, None for no limit
+        :param slow_consumer: What to do when the queue is full, 'drop' the message or 'disconnect' the client
+        :param max_message_size: Received messages larger than this close the connection (1009)
+        :param idle_timeout: Seconds without a received message after which the connection is closed (1001)
+        """
+        if slow_consumer not in ('drop', 'disconnect'):
+            raise ValueError(f'Unknown slow consumer policy "{slow_consumer}"')
+        self.ws = ws
+        self.endpoint = endpoint
+        self.send_queue_bytes = send_queue_bytes
+        self.slow_consumer = slow_consumer
+        self.max_message_size = max_message_size
+        self.idle_timeout = idle_timeout
+        self.topics: set[str] = set()
+        self.dropped = 0
+        self.queued_bytes = 0
+        self.last_activity = time.monotonic()
+        self.closed = False
+
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=send_queue_size)
+        # set when queued bytes were sent, or when nothing will be sent anymore
+        self.__sent = asyncio.Event()
+        self.handler_task: asyncio.Task = asyncio.current_task()
+        self.sender_task: asyncio.Task = asyncio.ensure_future(self.__sender())
+        self.sender_task.add_done_callback(lambda _: self.__sent.set())
+
+    def push(self, data: str | bytes) -> bool:
+        """Queues an already encoded message without waiting, returns False if it was not queued"""
+        if self.closed:
+            return False
+        if self.send_queue_bytes is None or self.queued_bytes + len(data) <= self.send_queue_bytes:
+            try:
+                self.queue.put_nowait(data)
+                self.queued_bytes += len(data)
+                return True
+            except asyncio.QueueFull:
+                pass
+        self.dropped += 1
+        if self.slow_consumer == 'disconnect':
+            self.disconnect(1013, 'Slow consumer')
+        return False
+
+    async def send(self, data: str | bytes) -> None:
+        """Queues a message, waiting while the queue is full or holds more than send_queue_bytes"""
+        if self.closed:
+            raise ConnectionError('Websocket closed')
+        # a message bigger than the limit still goes once the queue is empty
+        while self.send_queue_bytes is not None and self.queued_bytes and \
+                self.queued_bytes + len(data) > self.send_queue_bytes:
+            self.__sent.clear()
+            await self.__sent.wait()
+            if self.closed:
+                raise ConnectionError('Websocket closed')
+        await self.queue.put(data)
+        self.queued_bytes += len(data)
+
+    async def receive(self) -> str | bytes:
+        data = await self.ws.receive()
+        self.last_activity = time.monotonic()
+        if self.max_message_size is not None and len(data) > self.max_message_size:
+            await self.close(1009, 'Message too big')
+            raise MessageTooLarge(f'Message of {len(data)} bytes, the limit is {self.max_message_size}')
+        return data
+
+    def disconnect(self, code: int = 1000, reason: str = '') -> None:
+        """Closes the connection from another task, the handler is cancelled"""
+        if self.closed:
+            return
+        asyncio.ensure_future(self.__close_and_cancel(code, reason))
+        self.closed = True
+        self.sender_task.cancel()
+
+    async def close(self, code: int = 1000, reason: str = '') -> None:
+        self.closed = True
+        self.sender_task.cancel()
+        try:
+            await self.ws.close(code, reason)
+        except Exception:
+            pass
+
+    async def __close_and_cancel(self, code: int, reason: str) -> None:
+        await self.close(code, reason)
+        if self.handler_task is not None and not self.handler_task.done():
+            self.handler_task.cancel()
+
+    async def __sender(self) -> None:
+        try:
+            while True:
+                data = await self.queue.get()
+                await self.ws.send(data)
+                self.queued_bytes -= len(data)
+                self.__sent.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # the client went away, the handler gets the error on its next receive
+            self.closed = True
+
+
+class Hub:
+    """Registry of the open websockets, with topics they can subscribe to"""
+    def __init__(self):
+        self.endpoints: dict[str, set[Connection]] = {}
+        self.topics: dict[str, set[Connection]] = {}
+        self.sent = 0
+        self.dropped = 0
+        # worker_bus.Bus, forwards publish and broadcast to the other workers
+        self.bus = None
+        self.reap_interval = 1.0
+        self.reaped = 0
+        self.__reaper: asyncio.Task = None
+
+    def count(self, endpoint: str) -> int:
+        return len(self.endpoints.get(endpoint, ()))
+
+    def register(self, connection: Connection) -> Connection:
+        self.endpoints.setdefault(connection.endpoint, set()).add(connection)
+        if connection.idle_timeout is not None and (self.__reaper is None or self.__reaper.done()):
+            self.__reaper = asyncio.ensure_future(self.__reap())
+        return connection
+
+    async def __reap(self) -> None:
+        """One task closes the idle connections of every endpoint, it stops when none is left"""
+        while self.endpoints:
+            await asyncio.sleep(self.reap_interval)
+            now = time.monotonic()
+            for connections in tuple(self.endpoints.values()):
+                for connection in tuple(connections):
+                    if connection.idle_timeout is not None and now - connection.last_activity > connection.idle_timeout:
+                        self.reaped += 1
+                        connection.disconnect(1001, 'Idle timeout')
+
+    def unregister(self, connection: Connection) -> None:
+        connection.closed = True
+        connection.sender_task.cancel()
+        if (connections := self.endpoints.get(connection.endpoint)) is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.endpoints[connection.endpoint]
+        for topic in connection.topics:
+            if (subscribers := self.topics.get(topic)) is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.topics[topic]
+        connection.topics.clear()
+
+    def subscribe(self, connection: Connection, topic: str) -> None:
+        self.topics.setdefault(topic, set()).add(connection)
+        connection.topics.add(topic)
+
+    def unsubscribe(self, connection: Connection, topic: str) -> None:
+        connection.topics.discard(topic)
+        if (subscribers := self.topics.get(topic)) is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.topics[topic]
+
+    def __fan_out(self, connections: set[Connection] | None, data: str | bytes, exclude: Connection = None) -> int:
+        if not connections:
+            return 0
+        sent = 0
+        # copied, a disconnect can change the set
+        for connection in tuple(connections):
+            if connection is not exclude and connection.push(data):
+                sent += 1
+        self.sent += sent
+        self.dropped += len(connections) - sent - (exclude in connections)
+        return sent
+
+    def publish(self, topic: str, message: Any, exclude: Connection = None, forward: bool = True) -> int:
+        """
+        Sends a message to every subscriber of topic, in every worker if the bus is running
+        :param forward: Send it to the other workers too
+        :return: The number of clients of this worker it was queued for
+        """
+        data = encode_message(message)
+        if forward and self.bus is not None:
+            self.bus.publish(topic, data)
+        return self.__fan_out(self.topics.get(topic), data, exclude)
+
+    def broadcast(self, endpoint: str, message: Any, exclude: Connection = None, forward: bool = True) -> int:
+        """Sends a message to every client connected to endpoint, see publish"""
+        data = encode_message(message)
+        if forward and self.bus is not None:
+            self.bus.broadcast(endpoint, data)
+        return self.__fan_out(self.endpoints.get(endpoint), data, exclude)
+
+    def stats(self) -> dict[str, Any]:
+        """Counters of this worker, queued counts what is waiting in the send queues"""
+        endpoints = {}
+        for endpoint, connections in self.endpoints.items():
+            endpoints[endpoint] = {
+                'connections': len(connections),
+                'queued-messages': sum(connection.queue.qsize() for connection in connections),
+                'queued-bytes': sum(connection.queued_bytes for connection in connections),
+            }
+        return {
+            'connections': sum(stats['connections'] for stats in endpoints.values()),
+            'queued-messages': sum(stats['queued-messages'] for stats in endpoints.values()),
+            'queued-bytes': sum(stats['queued-bytes'] for stats in endpoints.values()),
+            'topics': len(self.topics),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'reaped': self.reaped,
+            'endpoints': endpoints,
+        }
+
+
+hub: Hub = Hub()
@@ -0,0 +1,330 @@
+from typing import Callable
+import socket
+import struct
+import queue
+import asyncio
+import selectors
+import threading
+import websocket_hub
+import event_stream
+
+# frame length, then kind, data type and name length
+FRAME_LENGTH = struct.Struct('<I')
+FRAME_HEADER = struct.Struct('<BBH')
+
+KIND_TOPIC, KIND_ENDPOINT, KIND_EVENT = 0, 1, 2
+DATA_STR, DATA_BYTES = 0, 1
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# written to the wakeup socket of the relay thread
+WAKEUP_STOP, WAKEUP_RENEW = b'\0', b'\1'
+
+
+class BusError(Exception):
+    pass
+
+
+def encode_frame(kind: int, name: str, data: str | bytes) -> bytes:
+    """Serializes a message once, the same bytes are sent to every worker"""
+    name = name.encode()
+    if isinstance(data, str):
+        data_type, data = DATA_STR, data.encode()
+    else:
+        data_type = DATA_BYTES
+    length = FRAME_HEADER.size + len(name) + len(data)
+    if length > MAX_FRAME_SIZE:
+        raise BusError(f'Message larger than {MAX_FRAME_SIZE} bytes')
+    return b''.join((FRAME_LENGTH.pack(length), FRAME_HEADER.pack(kind, data_type, len(name)), name, data))
+
+
+def decode_frame(frame: bytes) -> tuple[int, str, str | bytes]:
+    """Decodes a frame without its length prefix"""
+    kind, data_type, name_length = FRAME_HEADER.unpack_from(frame)
+    name_end = FRAME_HEADER.size + name_length
+    name = frame[FRAME_HEADER.size:name_end].decode()
+    data = frame[name_end:]
+    return kind, name, data.decode() if data_type == DATA_STR else data
+
+
+class Broker:
+    def __init__(self, workers: int, max_buffer: int = 8 * 1024 * 1024):
+        """
+        Relays the frames of a worker to every other worker, runs in the master process.
+        Each worker has a unix socket pair, the worker end is inherited by fork and closed in the master
+        (detach) so the exit of the worker ends the stream, a restarted worker gets a new pair (renew).
+        :param workers: Number of workers
+        :param max_buffer: Bytes waiting to be sent to a worker, frames are dropped past this
+        """
+        self.max_buffer = max_buffer
+        self.relayed = 0
+        self.dropped = 0
+        self.__pairs: dict[int, tuple[socket.socket, socket.socket]] = {}
+        for worker_id in range(workers):
+            self.__pairs[worker_id] = self.__socket_pair()
+        self.__incoming: dict[int, bytearray] = {worker_id: bytearray() for worker_id in self.__pairs}
+        self.__outgoing: dict[int, bytearray] = {worker_id: bytearray() for worker_id in self.__pairs}
+        # workers whose end of the stream was reached, nothing is queued for them
+        self.__exited: set[int] = set()
+        # (worker id, master end, worker end, done) swapped in by the relay thread
+        self.__renewals: queue.SimpleQueue = queue.SimpleQueue()
+        self.__selector: selectors.BaseSelector = None
+        self.__thread: threading.Thread = None
+        self.__wakeup_r, self.__wakeup_w = socket.socketpair()
+
+    @staticmethod
+    def __socket_pair() -> tuple[socket.socket, socket.socket]:
+        master, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        master.setblocking(False)
+        return master, worker
+
+    def worker_socket(self, worker_id: int) -> socket.socket:
+        """Called in the forked worker, closes the sockets of the others"""
+        for other_id, (master, worker) in self.__pairs.items():
+            master.close()
+            if other_id != worker_id:
+                worker.close()
+        if self.__selector is not None:
+            # the copy of the epoll of the relay thread, there's no relay thread in the worker
+            self.__selector.close()
+        self.__wakeup_r.close()
+        self.__wakeup_w.close()
+        return self.__pairs[worker_id][1]
+
+    def detach(self, worker_id: int) -> None:
+        """Called in the master once the worker is forked, only the worker keeps its end"""
+        self.__pairs[worker_id][1].close()
+
+    def renew(self, worker_id: int) -> None:
+        """
+        Called in the master before a worker is forked again, gives it a new pair.
+        A partial frame of the exited worker and what was queued for it are dropped with the old one,
+        they would desynchronize the stream of the new worker
+        """
+        master, worker = self.__socket_pair()
+        if self.__thread is None:
+            self.__swap(worker_id, master, worker)
+            return
+        done = threading.Event()
+        self.__renewals.put((worker_id, master, worker, done))
+        self.__wakeup_w.send(WAKEUP_RENEW)
+        done.wait()
+
+    def start(self) -> None:
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__wakeup_r, selectors.EVENT_READ, None)
+        for worker_id, (master, _) in self.__pairs.items():
+            if worker_id not in self.__exited:
+                self.__selector.register(master, selectors.EVENT_READ, worker_id)
+        self.__thread = threading.Thread(target=self.__relay, name='worker-bus', daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        if self.__thread is not None:
+            self.__wakeup_w.send(WAKEUP_STOP)
+            self.__thread.join(5.0)
+            self.__thread = None
+        for master, worker in self.__pairs.values():
+            master.close()
+            worker.close()
+        self.__wakeup_r.close()
+        self.__wakeup_w.close()
+
+    def __relay(self) -> None:
+        while True:
+            for key, events in self.__selector.select():
+                worker_id = key.data
+                if worker_id is None:
+                    if WAKEUP_STOP in self.__wakeup_r.recv(64):
+                        self.__selector.close()
+                        return
+                    while not self.__renewals.empty():
+                        renewed_id, master, worker, done = self.__renewals.get()
+                        self.__swap(renewed_id, master, worker)
+                        done.set()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.__read(worker_id, key.fileobj)
+                if events & selectors.EVENT_WRITE and worker_id not in self.__exited:
+                    self.__flush(worker_id)
+
+    def __swap(self, worker_id: int, master: socket.socket, worker: socket.socket) -> None:
+        """Runs in the relay thread, or before it starts"""
+        old_master, old_worker = self.__pairs[worker_id]
+        if self.__selector is not None and worker_id not in self.__exited:
+            self.__selector.unregister(old_master)
+        old_master.close()
+        old_worker.close()
+        self.__pairs[worker_id] = (master, worker)
+        self.__incoming[worker_id] = bytearray()
+        self.__outgoing[worker_id] = bytearray()
+        self.__exited.discard(worker_id)
+        if self.__selector is not None:
+            self.__selector.register(master, selectors.EVENT_READ, worker_id)
+
+    def __read(self, worker_id: int, sock: socket.socket) -> None:
+        try:
+            data = sock.recv(256 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        buffer = self.__incoming[worker_id]
+        if not data:
+            # the worker exited, the pair is replaced when it's restarted
+            self.__selector.unregister(sock)
+            self.__exited.add(worker_id)
+            buffer.clear()
+            self.__outgoing[worker_id].clear()
+            return
+        buffer += data
+
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= FRAME_LENGTH.size:
+            length = FRAME_LENGTH.unpack_from(buffer, offset)[0]
+            end = offset + FRAME_LENGTH.size + length
+            if end > len(buffer):
+                break
+            frames.append(bytes(buffer[offset:end]))
+            offset = end
+        del buffer[:offset]
+        if frames:
+            data = b''.join(frames)
+            for other_id in self.__pairs:
+                if other_id != worker_id:
+                    self.__queue(other_id, data, len(frames))
+
+    def __queue(self, worker_id: int, data: bytes, frames: int) -> None:
+        outgoing = self.__outgoing[worker_id]
+        if worker_id in self.__exited or len(outgoing) + len(data) > self.max_buffer:
+            self.dropped += frames
+            return
+        was_empty = not outgoing
+        outgoing += data
+        self.relayed += frames
+        if was_empty:
+            self.__flush(worker_id)
+
+    def __flush(self, worker_id: int) -> None:
+        master = self.__pairs[worker_id][0]
+        outgoing = self.__outgoing[worker_id]
+        try:
+            sent = master.send(outgoing)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            sent = len(outgoing)
+        del outgoing[:sent]
+        self.__selector.modify(master,
+                               selectors.EVENT_READ | selectors.EVENT_WRITE if outgoing else selectors.EVENT_READ,
+                               worker_id)
+
+
+class Bus:
+    def __init__(self, sock: socket.socket, max_buffer: int = 8 * 1024 * 1024):
+        """
+        Worker end of the broker, frames are written without blocking and read by a task of the server loop
+        :param sock: The socket given by Broker.worker_socket
+        :param max_buffer: Bytes waiting to be sent to the broker, messages are dropped past this
+        """
+        self.sock = sock
+        self.max_buffer = max_buffer
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.__writer: asyncio.StreamWriter = None
+        self.__task: asyncio.Task = None
+
+    @property
+    def running(self) -> bool:
+        return self.__writer is not None
+
+    async def start(self, on_frame: Callable[[int, str, str | bytes], None]) -> None:
+        """Starts reading, on_frame is called with (kind, name, data) for each message of the other workers"""
+        reader, self.__writer = await asyncio.open_unix_connection(sock=self.sock, limit=MAX_FRAME_SIZE)
+        self.__task = asyncio.ensure_future(self.__reader(reader, on_frame))
+
+    async def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+
+    def publish(self, topic: str, data: str | bytes) -> bool:
+        return self.send(encode_frame(KIND_TOPIC, topic, data))
+
+    def broadcast(self, endpoint: str, data: str | bytes) -> bool:
+        return self.send(encode_frame(KIND_ENDPOINT, endpoint, data))
+
+    def event(self, channel: str, id_: str, formatted: bytes) -> bool:
+        """Server-sent event, already formatted, the id goes first for the history of the channel"""
+        return self.send(encode_frame(KIND_EVENT, channel, id_.encode() + b'\n' + formatted))
+
+    def send(self, frame: bytes) -> bool:
+        if self.__writer is None:
+            return False
+        if self.__writer.transport.get_write_buffer_size() + len(frame) > self.max_buffer:
+            self.dropped += 1
+            return False
+        self.__writer.write(frame)
+        self.sent += 1
+        return True
+
+    async def __reader(self, reader: asyncio.StreamReader, on_frame: Callable[[int, str, str | bytes], None]) -> None:
+        while True:
+            try:
+                length = FRAME_LENGTH.unpack(await reader.readexactly(FRAME_LENGTH.size))[0]
+                frame = await reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            self.received += 1
+            try:
+                on_frame(*decode_frame(frame))
+            except Exception as e:
+                print(f'Worker bus message failed: {e!r}')
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'dropped': self.dropped,
+        }
+
+
+bus: Bus = None
+
+
+def deliver(kind: int, name: str, data: str | bytes) -> None:
+    if kind == KIND_TOPIC:
+        websocket_hub.hub.publish(name, data, forward=False)
+    elif kind == KIND_ENDPOINT:
+        websocket_hub.hub.broadcast(name, data, forward=False)
+    elif kind == KIND_EVENT:
+        id_, formatted = data.split(b'\n', 1)
+        event_stream.broadcaster.deliver(name, id_.decode(), formatted)
+
+
+def setup(sock: socket.socket, max_buffer: int = 8 * 1024 * 1024) -> Bus:
+    """Sets the bus of this worker, started with the server by start()"""
+    global bus
+    bus = Bus(sock, max_buffer=max_buffer)
+    return bus
+
+
+async def start() -> None:
+    """before_serving handler, connects the bus to websocket_hub and event_stream"""
+    if bus is None or bus.running:
+        return
+    await bus.start(deliver)
+    websocket_hub.hub.bus = bus
+    event_stream.broadcaster.bus = bus
+
+
+async def stop() -> None:
+    if bus is not None:
+        websocket_hub.hub.bus = None
+        event_stream.broadcaster.bus = None
+        await bus.stop()